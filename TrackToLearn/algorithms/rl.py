@@ -2,6 +2,8 @@ import numpy as np
 import torch
 
 from TrackToLearn.environments.env import BaseEnv
+from TrackToLearn.environments.torch_tracking_env import (
+    TorchTrackingEnvironment)
 from TrackToLearn.utils.torch_utils import get_device
 
 class RLAlgorithm(object):
@@ -55,6 +57,26 @@ class RLAlgorithm(object):
 
         self.rng = rng
 
+    def _to_env_actions(
+        self,
+        action: torch.Tensor,
+        env: BaseEnv,
+    ):
+        """ Device-resident environments take the actions as they are.
+        Other environments take them as a numpy array.
+        """
+        if isinstance(env, TorchTrackingEnvironment):
+            return action
+        return action.to(device='cpu', copy=True).numpy()
+
+    def _sum_rewards(self, reward) -> float:
+        """ Sum the rewards of a step, which may be a tensor if they come
+        from a device-resident environment.
+        """
+        if torch.is_tensor(reward):
+            return reward.sum().item()
+        return sum(reward)
+
     def validation_episode(
         self,
         initial_state,
@@ -83,18 +105,17 @@ class RLAlgorithm(object):
 
         running_reward = 0
         state = initial_state
-        done = False
-        while not np.all(done):
+        while len(state) > 0:
             # Select action according to policy + noise to make tracking
             # probabilistic
             with torch.no_grad():
                 action = self.agent.select_action(state, probabilistic=prob)
             # Perform action
             next_state, reward, done, *_ = env.step(
-                action.to(device='cpu', copy=True).numpy())
+                self._to_env_actions(action, env))
 
             # Keep track of reward
-            running_reward += sum(reward)
+            running_reward += self._sum_rewards(reward)
 
             # "Harvesting" here means removing "done" trajectories
             # from state. This line also set the next_state as the
@@ -104,3 +125,57 @@ class RLAlgorithm(object):
         # env.render()
 
         return running_reward
+
+    def continuous_validation_episode(
+        self,
+        initial_state,
+        env: BaseEnv,
+        prob: float = 1.,
+    ):
+        """
+        Main loop for the algorithm when tracking with continuous batching.
+        Streamlines that stop are replaced by new ones by the environment
+        until its seed pool is exhausted. See
+        `TrackingEnvironment.continuous_reset`.
+
+        Parameters
+        ----------
+        initial_state: np.ndarray
+            Initial state of the environment
+        env: BaseEnv
+            The environment actions are applied on. Provides the state fed to
+            the RL algorithm
+
+        Yields
+        ------
+        tractogram: Tractogram
+            Tractogram containing the streamlines that stopped at the last
+            step
+        running_reward: float
+            Cummulative reward since the last yield
+        """
+
+        running_reward = 0
+        state = initial_state
+        while len(state) > 0:
+            # Select action according to policy + noise to make tracking
+            # probabilistic
+            with torch.no_grad():
+                action = self.agent.select_action(state, probabilistic=prob)
+            # Perform action
+            next_state, reward, done, *_ = env.step(
+                self._to_env_actions(action, env))
+
+            # Keep track of reward
+            running_reward += self._sum_rewards(reward)
+
+            # "Harvesting" here means removing "done" trajectories
+            # from state.
+            env.harvest()
+            # Replace the "done" trajectories by new ones. This line also
+            # sets the next_state as the state
+            tractogram, state = env.refill()
+
+            if len(tractogram) > 0:
+                yield tractogram, running_reward
+                running_reward = 0
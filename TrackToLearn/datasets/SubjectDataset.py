@@ -1,4 +1,5 @@
 import h5py
+import numpy as np
 
 from torch.utils.data import Dataset
 
@@ -13,13 +14,19 @@ class SubjectDataset(Dataset):
     """
 
     def __init__(
-        self, file_path: str, dataset_split: str,
+        self, file_path: str, dataset_split: str, dtype=None, sparse=False,
     ):
         """
         Args:
+            dtype: If set, dtype in which to load the input volume and the
+                peaks. float32 otherwise.
+            sparse: Whether to load the input volume and the peaks as
+                `SparseVolume` and the masks as uint8.
         """
         self.file_path = file_path
         self.split = dataset_split
+        self.dtype = dtype or np.float32
+        self.sparse = sparse
         with h5py.File(self.file_path, 'r') as f:
             self.subjects = list(f[dataset_split].keys())
 
@@ -37,7 +44,7 @@ class SubjectDataset(Dataset):
         subject_id = self.subjects[index]
 
         tracto_data = SubjectData.from_hdf_subject(
-            self.archives, subject_id)
+            self.archives, subject_id, self.dtype, self.sparse)
 
         tracto_data.input_dv.subject_id = subject_id
         input_volume = tracto_data.input_dv
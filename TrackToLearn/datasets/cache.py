@@ -0,0 +1,154 @@
+import hashlib
+import os
+
+import numpy as np
+
+from typing import Callable
+
+
+class VolumeCache(object):
+    """ On-disk cache of volumes derived from input files (e.g. SH converted
+    to another basis, peaks or spline coefficients of masks), so that
+    repeated runs on the same subject do not recompute them.
+
+    Each volume is stored as a `.npy` file named after a key hashing the
+    contents of the inputs and the parameters of the computation, and is
+    loaded back as a memory map. When the cache grows over its maximum size,
+    the least recently used volumes are deleted.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        max_size: float = 10.,
+    ):
+        """
+        Parameters
+        ----------
+        cache_dir: str
+            Directory in which to store the volumes. Created if needed.
+        max_size: float
+            Maximum size of the cache, in GB.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size * 1024 ** 3)
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def hash_file(path: str) -> str:
+        """ Hash the contents of a file.
+
+        Parameters
+        ----------
+        path: str
+            Path to the file.
+
+        Returns
+        -------
+        digest: str
+            SHA-1 digest of the file.
+        """
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    @staticmethod
+    def key(*parts) -> str:
+        """ Build the key of a volume from its inputs and parameters.
+        Arrays are hashed by content, everything else by `repr`.
+
+        Parameters
+        ----------
+        *parts:
+            Inputs and parameters of the computation.
+
+        Returns
+        -------
+        key: str
+            Key of the volume.
+        """
+        h = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                h.update(repr((part.dtype.str, part.shape)).encode())
+                h.update(np.ascontiguousarray(part).data)
+            else:
+                h.update(repr(part).encode())
+        return h.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, '{}.npy'.format(key))
+
+    def get(
+        self,
+        key: str,
+        compute: Callable[[], np.ndarray],
+    ) -> np.ndarray:
+        """ Load a volume from the cache, or compute and store it.
+
+        Parameters
+        ----------
+        key: str
+            Key of the volume, see `key`.
+        compute: Callable
+            Function computing the volume on a cache miss.
+
+        Returns
+        -------
+        volume: `numpy.ndarray`
+            The volume. On a hit, it is a copy-on-write memory map of the
+            cached file.
+        """
+        path = self._path(key)
+
+        if os.path.exists(path):
+            try:
+                volume = np.load(path, mmap_mode='c')
+                # Mark as recently used
+                os.utime(path)
+                return volume
+            except (OSError, ValueError):
+                # Evicted by another run or partially written, recompute
+                pass
+
+        volume = compute()
+
+        # Write to a temporary file first so that concurrent runs never see
+        # a partial volume
+        tmp_path = os.path.join(
+            self.cache_dir, '.{}.{}.tmp'.format(key, os.getpid()))
+        with open(tmp_path, 'wb') as f:
+            np.save(f, volume)
+        os.replace(tmp_path, path)
+
+        self._evict()
+        return volume
+
+    def _evict(self):
+        """ Delete the least recently used volumes until the cache fits in
+        its maximum size.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npy'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
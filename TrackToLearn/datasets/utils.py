@@ -1,6 +1,10 @@
 import nibabel as nib
 import numpy as np
+import torch
 
+from multiprocessing import Pool
+
+from dipy.core.sphere import Sphere
 from dipy.data import get_sphere
 from dipy.reconst.csdeconv import sph_harm_ind_list
 from scilpy.reconst.utils import get_sh_order_and_fullness
@@ -11,30 +15,119 @@ class MRIDataVolume(object):
     """
     Class used to encapsulate MRI metadata alongside a data volume,
     such as the vox2rasmm affine or the subject_id.
+
+    The data can also be given as a function computing it, in which case
+    the volume is lazy: the function is only called the first time the data
+    is accessed. This is used for volumes derived from other ones (e.g.
+    peaks or prefiltered masks) which are not needed by every consumer.
+
+    A volume may only hold a box of the voxel grid of its subject (see
+    `crop`). Voxel `v` of the volume is then voxel `v + origin` of the
+    subject, and `affine_vox2rasmm` is the affine of the subject.
     """
 
     def __init__(
-        self, data=None, affine_vox2rasmm=None
+        self, data=None, affine_vox2rasmm=None, compute=None, origin=None,
+        grid_shape=None,
     ):
         self._data = data
+        self._compute = compute
         self.affine_vox2rasmm = affine_vox2rasmm
+        # Position of the volume in the grid of the subject, and shape of
+        # the grid if known
+        self.origin = np.zeros(3, dtype=int) if origin is None \
+            else np.asarray(origin, dtype=int)
+        self.grid_shape = grid_shape
 
     @classmethod
-    def from_hdf_group(cls, hdf, group, default=None):
-        """ Create an MRIDataVolume from an HDF group object """
+    def from_hdf_group(
+        cls, hdf, group, default=None, dtype=np.float32, sparse=False
+    ):
+        """ Create an MRIDataVolume from an HDF group object. If `sparse`,
+        the data is read as a `SparseVolume`. """
         try:
-            data = np.array(hdf[group]['data'], dtype=np.float32)
+            if sparse:
+                data = SparseVolume.from_dense(hdf[group]['data'], dtype)
+            else:
+                data = np.array(hdf[group]['data'], dtype=dtype)
             affine_vox2rasmm = np.array(
                 hdf[group].attrs['vox2rasmm'], dtype=np.float32)
         except KeyError:
             print('Missing {} from dataset'.format(group))
-            data = np.zeros_like(hdf[default]['data'], dtype=np.float32)
+            data = np.zeros_like(hdf[default]['data'], dtype=dtype)
             affine_vox2rasmm = np.array(
                 hdf[default].attrs['vox2rasmm'], dtype=np.float32)
         return cls(data=data, affine_vox2rasmm=affine_vox2rasmm)
 
+    def derive(self, fn):
+        """ Lazy volume computed from the data of this one. Neither volume
+        is materialized until the data of the derived one is accessed.
+
+        Parameters
+        ----------
+        fn: Callable
+            Function taking the data of this volume and returning the data
+            of the derived one.
+
+        Returns
+        -------
+        volume: MRIDataVolume
+            Derived volume, with the same affine and origin.
+        """
+        return MRIDataVolume(
+            affine_vox2rasmm=self.affine_vox2rasmm,
+            compute=lambda: fn(self.data),
+            origin=self.origin, grid_shape=self.grid_shape)
+
+    def crop(self, bbox):
+        """ Volume restricted to a box of its voxels. The cropped volume
+        keeps the affine of the subject and its origin is moved to the
+        start of the box. A lazy volume is cropped when it is computed.
+
+        Parameters
+        ----------
+        bbox: tuple of slice
+            Box to keep, see `bounding_box`.
+
+        Returns
+        -------
+        volume: MRIDataVolume
+            Cropped volume, or this one if the box holds all its voxels.
+        """
+        grid_shape = self.grid_shape
+        if self.is_loaded:
+            if all(s.start == 0 and s.stop == n
+                   for s, n in zip(bbox, self.data.shape)):
+                return self
+            if grid_shape is None:
+                grid_shape = self.data.shape[:3]
+
+        def crop(data):
+            if isinstance(data, SparseVolume):
+                return data.crop(bbox)
+            # Copy so that the whole volume can be freed
+            return np.array(data[bbox])
+
+        volume = MRIDataVolume(
+            affine_vox2rasmm=self.affine_vox2rasmm,
+            origin=self.origin + [s.start for s in bbox],
+            grid_shape=grid_shape)
+        if self.is_loaded:
+            volume._data = crop(self.data)
+        else:
+            volume._compute = lambda: crop(self.data)
+        return volume
+
+    @property
+    def is_loaded(self):
+        """ Whether the data is in memory """
+        return self._compute is None
+
     @property
     def data(self):
+        if self._compute is not None:
+            self._data = self._compute()
+            self._compute = None
         return self._data
 
     @property
@@ -43,6 +136,147 @@ class MRIDataVolume(object):
         return self.data.shape
 
 
+class SparseVolume(object):
+    """ 4D volume of which only the non-empty voxels are stored.
+
+    The values of the voxels with at least one non-zero channel are kept
+    in a compact array, and a dense grid holds the row of each voxel in
+    this array. Empty voxels all point to a first row of zeros, so that
+    indexing the volume gives the same values as the dense one. Since the
+    signal and the peaks are usually zero outside of the brain, this takes
+    a fraction of the memory of the dense volume: 4 bytes per voxel for the
+    grid instead of 4 bytes per channel.
+
+    The arrays are either `numpy.ndarray` or `torch.Tensor`, see
+    `to_torch`.
+    """
+
+    def __init__(self, index, values):
+        """
+        Parameters
+        ----------
+        index: array of int32 of shape (X, Y, Z)
+            Row of `values` holding each voxel, 0 for empty voxels.
+        values: array of shape (n_voxels + 1, C)
+            Values of the non-empty voxels, after a row of zeros.
+        """
+        self.index = index
+        self.values = values
+
+    @classmethod
+    def from_dense(cls, data, dtype=None, chunk_size=16):
+        """ Keep the non-empty voxels of a dense volume. The volume is read
+        by slabs, so that an HDF5 dataset or a memory map never has to be
+        entirely loaded in memory.
+
+        Parameters
+        ----------
+        data: array-like of shape (X, Y, Z, C)
+            Dense volume, e.g. a `numpy.ndarray` or an `h5py.Dataset`.
+        dtype: np.dtype
+            Type of the stored values. Type of `data` if not set.
+        chunk_size: int
+            Number of slices read at once along the first axis.
+
+        Returns
+        -------
+        volume: SparseVolume
+            Sparse copy of the volume.
+        """
+        dtype = data.dtype if dtype is None else dtype
+        index = np.zeros(data.shape[:3], dtype=np.int32)
+        rows = [np.zeros((1, data.shape[-1]), dtype=dtype)]
+        n_rows = 1
+        for x in range(0, data.shape[0], chunk_size):
+            slab = np.asarray(data[x:x + chunk_size], dtype=dtype)
+            nonempty = np.any(slab != 0, axis=-1)
+            count = int(np.count_nonzero(nonempty))
+            index[x:x + chunk_size][nonempty] = np.arange(
+                n_rows, n_rows + count, dtype=np.int32)
+            rows.append(slab[nonempty])
+            n_rows += count
+        return cls(index, np.concatenate(rows))
+
+    def to_torch(self, device='cpu', dtype=None):
+        """ Copy of the volume with its arrays on a torch device.
+
+        Parameters
+        ----------
+        device: torch.device
+            Device on which to copy the volume.
+        dtype: torch.dtype
+            Type of the values on the device. Same as the host if not set.
+
+        Returns
+        -------
+        volume: SparseVolume
+            Volume made of tensors.
+        """
+        return SparseVolume(
+            torch.as_tensor(self.index, device=device),
+            torch.as_tensor(self.values, device=device).to(dtype=dtype))
+
+    def crop(self, bbox):
+        """ Sparse volume restricted to a box of its voxels. Only the values
+        of the voxels in the box are kept.
+
+        Parameters
+        ----------
+        bbox: tuple of slice
+            Box to keep, see `bounding_box`.
+
+        Returns
+        -------
+        volume: SparseVolume
+            Cropped volume.
+        """
+        index = self.index[bbox]
+        rows, inverse = np.unique(index, return_inverse=True)
+        inverse = inverse.reshape(index.shape).astype(np.int32)
+        # Empty voxels still point to the row of zeros
+        if rows[0] != 0:
+            rows = np.concatenate(([0], rows))
+            inverse += 1
+        return SparseVolume(inverse, self.values[rows])
+
+    def to_dense(self):
+        """ Dense copy of the volume.
+
+        Returns
+        -------
+        data: array of shape (X, Y, Z, C)
+        """
+        return self[...]
+
+    def __getitem__(self, key):
+        """ Values of the voxels at `key`, which indexes the three spatial
+        axes like for the dense volume. """
+        rows = self.index[key]
+        if torch.is_tensor(rows):
+            rows = rows.long()
+        return self.values[rows]
+
+    @property
+    def shape(self):
+        return tuple(self.index.shape) + (self.values.shape[-1],)
+
+    @property
+    def ndim(self):
+        return 4
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def nbytes(self):
+        """ Memory taken by the volume, in bytes """
+        if torch.is_tensor(self.values):
+            return self.index.element_size() * self.index.nelement() + \
+                self.values.element_size() * self.values.nelement()
+        return self.index.nbytes + self.values.nbytes
+
+
 class SubjectData(object):
     """
     Tractography-related data (input information, tracking mask, peaks and
@@ -66,15 +300,25 @@ class SubjectData(object):
         self.reference = reference
 
     @classmethod
-    def from_hdf_subject(cls, hdf_file, subject_id):
-        """ Create a SubjectData object from an HDF group object """
+    def from_hdf_subject(
+        cls, hdf_file, subject_id, dtype=np.float32, sparse=False
+    ):
+        """ Create a SubjectData object from an HDF group object. The input
+        volume and the peaks are loaded with `dtype`. If `sparse`, they are
+        loaded as `SparseVolume` and the masks as uint8. """
         hdf_subject = hdf_file[subject_id]
-        input_dv = MRIDataVolume.from_hdf_group(hdf_subject, 'input_volume')
-
-        peaks = MRIDataVolume.from_hdf_group(hdf_subject, 'peaks_volume')
-        tracking = MRIDataVolume.from_hdf_group(hdf_subject, 'tracking_volume')
+        input_dv = MRIDataVolume.from_hdf_group(
+            hdf_subject, 'input_volume', dtype=dtype, sparse=sparse)
+
+        peaks = MRIDataVolume.from_hdf_group(
+            hdf_subject, 'peaks_volume', dtype=dtype, sparse=sparse)
+        # Masks are binarized by the environment anyway
+        mask_dtype = np.uint8 if sparse else np.float32
+        tracking = MRIDataVolume.from_hdf_group(
+            hdf_subject, 'tracking_volume', dtype=mask_dtype)
         seeding = MRIDataVolume.from_hdf_group(
-            hdf_subject, 'seeding_volume', 'tracking_volume')
+            hdf_subject, 'seeding_volume', 'tracking_volume',
+            dtype=mask_dtype)
         anatomy = MRIDataVolume.from_hdf_group(
             hdf_subject, 'anat_volume', 'tracking_volume')
 
@@ -85,6 +329,33 @@ class SubjectData(object):
             seeding=seeding, reference=reference, peaks=peaks)
 
 
+def bounding_box(mask: np.ndarray, margin: int = 0) -> tuple:
+    """ Smallest box holding the non-zero voxels of a mask, grown by a
+    margin and clipped to the mask.
+
+    Parameters
+    ----------
+    mask: `numpy.ndarray` of shape (X, Y, Z)
+        Mask to bound.
+    margin: int
+        Number of voxels added on each side of the box.
+
+    Returns
+    -------
+    bbox: tuple of slice
+        Box along each axis. The whole mask if it is empty.
+    """
+    bbox = []
+    for axis in range(mask.ndim):
+        others = tuple(a for a in range(mask.ndim) if a != axis)
+        nonzero = np.flatnonzero(np.any(mask, axis=others))
+        if len(nonzero) == 0:
+            return tuple(slice(0, n) for n in mask.shape)
+        bbox.append(slice(max(nonzero[0] - margin, 0),
+                          min(nonzero[-1] + 1 + margin, mask.shape[axis])))
+    return tuple(bbox)
+
+
 def convert_length_mm2vox(
     length_mm: float, affine_vox2rasmm: np.ndarray
 ) -> float:
@@ -177,3 +448,168 @@ def set_sh_order_basis(
             sh, sphere, input_basis=sh_basis, nbr_processes=1)
 
     return sh
+
+
+def get_sphere_neighbors(sphere: Sphere) -> np.ndarray:
+    """ Neighbors of each vertex of a sphere, padded to the largest number
+    of neighbors with the index of the vertex itself.
+
+    Parameters
+    ----------
+    sphere: Sphere
+        Sphere whose edges define the neighborhood of each vertex.
+
+    Returns
+    -------
+    neighbors: `numpy.ndarray` of int of shape (n_vertices, max_degree)
+        Indices of the neighbors of each vertex.
+    """
+
+    n_vertices = len(sphere.vertices)
+    edges = sphere.edges
+
+    # Both ends of an edge are neighbors of each other
+    src = np.concatenate((edges[:, 0], edges[:, 1]))
+    dst = np.concatenate((edges[:, 1], edges[:, 0]))
+    order = np.argsort(src, kind='stable')
+    src, dst = src[order], dst[order]
+
+    degree = np.bincount(src, minlength=n_vertices)
+    first = np.cumsum(degree) - degree
+
+    neighbors = np.repeat(
+        np.arange(n_vertices)[:, None], degree.max(), axis=1)
+    neighbors[src, np.arange(len(src)) - first[src]] = dst
+    return neighbors
+
+
+def _extract_peaks_chunk(args) -> tuple:
+    """ Extract the peaks of a chunk of voxels. See `extract_peaks`. """
+
+    (sh, b_matrix, neighbors, vertices, npeaks, relative_peak_threshold,
+     min_separation_angle) = args
+    N = len(sh)
+
+    # Evaluate the SF of every voxel at once. Negative values are clipped to
+    # zero, like scilpy's `get_maximas` with an absolute threshold of 0.
+    # The SF is laid out vertex-major so that gathering the SF of the
+    # neighbors of every vertex only copies contiguous rows.
+    sf = np.ascontiguousarray(np.dot(sh, b_matrix).T)
+    sf[sf < 0.] = 0.
+
+    # Like dipy's `local_maxima`, a peak is greater than or equal to all of
+    # its neighbors and greater than at least one of them. Vertices are
+    # compared to their k-th neighbor all at once.
+    not_smaller = np.ones(sf.shape, dtype=bool)
+    greater = np.zeros(sf.shape, dtype=bool)
+    for k in range(neighbors.shape[1]):
+        neighbors_sf = sf[neighbors[:, k]]
+        not_smaller &= sf >= neighbors_sf
+        greater |= sf > neighbors_sf
+    is_peak = np.logical_and(not_smaller, greater)
+
+    # Sort the peaks of each voxel by decreasing value. Ties are ordered
+    # by decreasing index, like dipy does.
+    n_candidates = int(np.max(np.sum(is_peak, axis=0), initial=0))
+    values = np.where(is_peak, sf, -np.inf).T
+    order = np.argsort(values, axis=-1, kind='stable')[:, ::-1]
+    order = order[:, :n_candidates]
+    values = np.take_along_axis(values, order, axis=-1)
+
+    # Only keep peaks above a fraction of the largest one
+    sf_min = np.maximum(np.min(sf, axis=0), 0.)[:, None]
+    candidates = np.logical_and(
+        np.isfinite(values),
+        (values - sf_min) >= relative_peak_threshold * (
+            values[:, :1] - sf_min))
+
+    # Greedily keep the largest peaks that are not too close to an already
+    # kept one, up to `npeaks` peaks
+    cos_similarity = np.cos(np.deg2rad(min_separation_angle))
+    peak_dirs = np.zeros((N, npeaks, 3))
+    peak_values = np.zeros((N, npeaks))
+    counts = np.zeros(N, dtype=int)
+    for i in range(n_candidates):
+        directions = vertices[order[:, i]]
+        similarity = np.abs(
+            np.einsum('npk,nk->np', peak_dirs, directions))
+        keep = np.logical_and.reduce((
+            candidates[:, i],
+            counts < npeaks,
+            np.all(similarity <= cos_similarity, axis=-1)))
+
+        kept = np.flatnonzero(keep)
+        peak_dirs[kept, counts[kept]] = directions[kept]
+        peak_values[kept, counts[kept]] = values[kept, i]
+        counts[kept] += 1
+
+    return peak_dirs, peak_values
+
+
+def extract_peaks(
+    data: np.ndarray,
+    sphere: Sphere,
+    b_matrix: np.ndarray,
+    npeaks: int = 5,
+    relative_peak_threshold: float = 0.1,
+    min_separation_angle: float = 25.,
+    chunk_size: int = 2048,
+    num_processes: int = 1,
+):
+    """ Extract the peaks of fODFs, in every voxel with SH coefficients.
+    Gives the same peaks as calling scilpy's `get_maximas` (with an absolute
+    threshold of 0) on each voxel, but evaluates the SF and finds local
+    maxima for chunks of voxels at once, optionally in parallel.
+
+    Parameters
+    ----------
+    data: `numpy.ndarray` of shape (X, Y, Z, n_coefs)
+        SH coefficients.
+    sphere: Sphere
+        Sphere on which the fODFs are evaluated.
+    b_matrix: `numpy.ndarray` of shape (n_coefs, n_vertices)
+        SH to SF matrix, from `dipy.reconst.shm.sh_to_sf_matrix`.
+    npeaks: int
+        Maximum number of peaks per voxel.
+    relative_peak_threshold: float
+        Only peaks larger than this fraction of the largest one are kept.
+    min_separation_angle: float
+        Minimum angle in degrees between two peaks. If two peaks are too
+        close, only the larger one is kept.
+    chunk_size: int
+        Number of voxels processed at once.
+    num_processes: int
+        Number of processes over which to split the chunks. Processes
+        tracking in parallel should split the CPUs between them.
+
+    Returns
+    -------
+    peak_dirs: `numpy.ndarray` of shape (X, Y, Z, npeaks, 3)
+        Directions of the peaks, sorted by decreasing value.
+    peak_values: `numpy.ndarray` of shape (X, Y, Z, npeaks)
+        Values of the peaks.
+    """
+
+    shape_3d = data.shape[:-1]
+    peak_dirs = np.zeros((shape_3d + (npeaks, 3)))
+    peak_values = np.zeros((shape_3d + (npeaks, )))
+
+    mask = np.sum(data, axis=-1) != 0
+    sh = data[mask]
+
+    neighbors = get_sphere_neighbors(sphere)
+    chunks = [(sh[i:i + chunk_size], b_matrix, neighbors, sphere.vertices,
+               npeaks, relative_peak_threshold, min_separation_angle)
+              for i in range(0, len(sh), chunk_size)]
+
+    if num_processes > 1 and len(chunks) > 1:
+        with Pool(min(num_processes, len(chunks))) as pool:
+            results = pool.map(_extract_peaks_chunk, chunks)
+    else:
+        results = [_extract_peaks_chunk(chunk) for chunk in chunks]
+
+    if len(results) > 0:
+        peak_dirs[mask] = np.concatenate([r[0] for r in results])
+        peak_values[mask] = np.concatenate([r[1] for r in results])
+
+    return peak_dirs, peak_values
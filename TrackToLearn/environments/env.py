@@ -1,4 +1,3 @@
-import functools
 from typing import Callable, Dict, Tuple
 
 import nibabel as nib
@@ -7,32 +6,44 @@ import torch
 from dipy.core.sphere import HemiSphere
 from dipy.data import get_sphere
 from dipy.direction.peaks import reshape_peaks_for_visualization
-from dipy.tracking import utils as track_utils
+from dipy.io.utils import get_reference_info
 from dwi_ml.data.processing.volume.interpolation import \
     interpolate_volume_in_neighborhood
 from dwi_ml.data.processing.space.neighborhood import \
     get_neighborhood_vectors_axes
-from scilpy.reconst.utils import (find_order_from_nb_coeff,
-                                  get_maximas)
+from scilpy.reconst.utils import find_order_from_nb_coeff
 from dipy.reconst.shm import sh_to_sf_matrix
 from torch.utils.data import DataLoader
 
 from TrackToLearn.datasets.SubjectDataset import SubjectDataset
+from TrackToLearn.datasets.cache import VolumeCache
 from TrackToLearn.datasets.utils import (MRIDataVolume,
+                                         SparseVolume,
+                                         bounding_box,
                                          convert_length_mm2vox,
+                                         extract_peaks,
                                          set_sh_order_basis,
                                          get_sh_order_and_fullness)
+from TrackToLearn.environments.interpolation import NeighborhoodSampler
 from TrackToLearn.environments.local_reward import PeaksAlignmentReward
 from TrackToLearn.environments.oracle_reward import OracleReward
 from TrackToLearn.environments.reward import RewardFunction
+from TrackToLearn.environments.seed_source import SeedSource
 from TrackToLearn.environments.stopping_criteria import (
-    BinaryStoppingCriterion, OracleStoppingCriterion,
+    BinaryStoppingCriterion, CurvatureStoppingCriterion,
+    LengthStoppingCriterion, OracleStoppingCriterion,
     StoppingFlags)
-from TrackToLearn.environments.utils import (  # is_looping,
-    is_too_curvy, is_too_long)
+from TrackToLearn.environments.streamline_buffer import StreamlineView
 from TrackToLearn.utils.utils import normalize_vectors
 
-# from dipy.io.utils import get_reference_info
+# Precisions in which the input signal can be stored, as dtypes on the host
+# and on the device of the env. NumPy has no bfloat16, so bf16 volumes are
+# only reduced on the device.
+STORAGE_DTYPES = {
+    'fp32': (None, torch.float32),
+    'fp16': (np.float16, torch.float16),
+    'bf16': (None, torch.bfloat16),
+}
 
 def collate_fn(data):
     return data
@@ -48,11 +59,9 @@ class BaseEnv(object):
     and seeds.
 
     Since many streamlines are propagated in parallel, the environment is
-    similar to VectorizedEnvironments in the Gym definition. However, the
-    environment is not vectorized in the sense that it does not reset
-    trajectories (streamlines) independently.
-
-    TODO: reset trajectories independently ?
+    similar to VectorizedEnvironments in the Gym definition. Trajectories
+    (streamlines) are only reset independently when tracking with
+    continuous batching (see `TrackingEnvironment.continuous_reset`).
 
     """
 
@@ -80,6 +89,11 @@ class BaseEnv(object):
 
         """
 
+        # The signal is interpolated in float32 but can be stored in half
+        # precision
+        host_dtype, self.storage_dtype = \
+            STORAGE_DTYPES[env_dto.get('storage_precision', 'fp32')]
+
         # If the subject data is a string, it is assumed to be a path to
         # an HDF5 file. Otherwise, it is assumed to be a list of volumes
         if type(subject_data) is str:
@@ -87,7 +101,8 @@ class BaseEnv(object):
             self.split = split_id
 
             self.dataset = SubjectDataset(
-                self.dataset_file, self.split)
+                self.dataset_file, self.split, host_dtype,
+                env_dto.get('sparse_volumes', False))
             self.loader = DataLoader(self.dataset, 1, shuffle=True,
                                      collate_fn=collate_fn,
                                      num_workers=2)
@@ -109,6 +124,17 @@ class BaseEnv(object):
         self.theta = env_dto['theta']
         # Number of seeds per voxel
         self.npv = env_dto['npv']
+        # Order of the seeds and number of seeds tracked at once, see
+        # `SeedSource`
+        self.seed_order = env_dto.get('seed_order', 'random')
+        self.seed_batch_size = env_dto.get('seed_batch_size')
+        # How the signal is interpolated around streamlines, see
+        # `NeighborhoodSampler`
+        self.state_sampler = env_dto.get('state_sampler', 'dwi_ml')
+        self.max_stacked_size = env_dto.get('max_stacked_size', 2.)
+        # Margin, in voxels, kept around the masks when cropping volumes.
+        # Volumes are not cropped if not set.
+        self.crop_margin = env_dto.get('crop_margin')
         # Whether to use CMC or binary stopping criterion
         self.binary_stopping_threshold = env_dto['binary_stopping_threshold']
 
@@ -121,6 +147,9 @@ class BaseEnv(object):
         # Oracle parameters
         self.oracle_checkpoint = env_dto['oracle_checkpoint']
         self.oracle_stopping_criterion = env_dto['oracle_stopping_criterion']
+        self.oracle_cadence = env_dto.get('oracle_cadence', 1)
+        self.oracle_inference = env_dto.get('oracle_inference', 'fp32')
+        self.oracle_server = env_dto.get('oracle_server', None)
 
         # Tractometer parameters
         self.scoring_data = env_dto['scoring_data']
@@ -137,6 +166,9 @@ class BaseEnv(object):
         self.device = env_dto['device']
         self.target_sh_order = env_dto['target_sh_order']
 
+        # On-disk cache of derived volumes
+        self.cache = BaseEnv._get_cache(env_dto)
+
         # Load one subject as an example
         self.load_subject()
 
@@ -160,27 +192,47 @@ class BaseEnv(object):
                  peaks, reference) = next(self.loader_iter)[0]
             
             self.subject_id = sub_id
-            # Affines
             self.reference = reference
-            self.affine_vox2rasmm = input_volume.affine_vox2rasmm
-            self.affine_rasmm2vox = np.linalg.inv(self.affine_vox2rasmm)
-
-            # Volumes and masks
-            self.data_volume = torch.from_numpy(
-                input_volume.data).to(self.device, dtype=torch.float32)
         else:
             (input_volume, tracking_mask, seeding_mask, peaks,
              reference) = self.subject_data
 
-            self.affine_vox2rasmm = input_volume.affine_vox2rasmm
-            self.affine_rasmm2vox = np.linalg.inv(self.affine_vox2rasmm)
-
-            # Volumes and masks
-            self.data_volume = torch.from_numpy(
-                input_volume.data).to(self.device, dtype=torch.float32)
-
             self.reference = reference
 
+        # Volumes are cropped around the masks. Streamlines stay in the
+        # voxel space of the subject, the origin of the volumes is
+        # subtracted from their coordinates when interpolating.
+        if self.crop_margin is not None:
+            input_volume, tracking_mask, seeding_mask, peaks = \
+                BaseEnv._crop_volumes(
+                    (input_volume, tracking_mask, seeding_mask, peaks),
+                    tracking_mask, seeding_mask, self.crop_margin)
+            if not hasattr(self, 'dataset_file'):
+                # Do not keep the whole volumes around
+                self.subject_data = (input_volume, tracking_mask,
+                                     seeding_mask, peaks, reference)
+        self.volume_origin = input_volume.origin
+        self.grid_shape = tracking_mask.grid_shape
+
+        # Affines
+        self.affine_vox2rasmm = input_volume.affine_vox2rasmm
+        self.affine_rasmm2vox = np.linalg.inv(self.affine_vox2rasmm)
+        # From the voxel space of the streamlines to the voxel-corner space
+        # of the reference, where the oracle scores streamlines. Composed
+        # once instead of going through a StatefulTractogram at each call.
+        self.affine_vox2oracle = None
+        if self.oracle_checkpoint:
+            affine_ref2rasmm, _, _, _ = get_reference_info(self.reference)
+            self.affine_vox2oracle = np.dot(
+                np.linalg.inv(affine_ref2rasmm), self.affine_vox2rasmm)
+            self.affine_vox2oracle[:3, 3] += 0.5
+
+        # Volumes and masks
+        self.data_volume = self._signal_to_device(input_volume.data)
+        self.volume_bbox = tuple(
+            slice(o, o + n) for o, n in zip(
+                self.volume_origin, self.data_volume.shape[:3]))
+
         # The SH target order is taken from the hyperparameters in the case of tracking.
         # Otherwise, the SH target order is taken from the input volume by default.
         if self.target_sh_order is None:
@@ -211,12 +263,35 @@ class BaseEnv(object):
             (torch.zeros((1, 3)),
              get_neighborhood_vectors_axes(1, self.add_neighborhood_vox))
         ).to(self.device)
-
-        # Tracking seeds
-        self.seeds = track_utils.random_seeds_from_mask(
+        # Streamlines are moved to the voxel space of the signal, which may
+        # be cropped
+        self.signal_origin = torch.as_tensor(
+            self.volume_origin, dtype=torch.float32, device=self.device)
+
+        # In-project sampler, precomputed once per subject. dwi_ml cannot
+        # interpolate sparse volumes.
+        self.neighborhood_sampler = None
+        if self.state_sampler == 'torch' or \
+                isinstance(self.data_volume, SparseVolume):
+            self.neighborhood_sampler = NeighborhoodSampler(
+                self.data_volume, self.neighborhood_directions,
+                self.max_stacked_size, self.signal_origin)
+
+        # Tracking seeds, generated on demand. The seed of their generator
+        # is drawn from the env's RNG so that seeds are reproducible. When
+        # seeds are grouped spatially, each group holds the seeds of whole
+        # voxels, at most `seed_batch_size`, and is one batch, see
+        # `SeedSource.batches`.
+        block_size = 4096
+        if self.seed_order == 'morton' and self.seed_batch_size:
+            block_size = max(1, self.seed_batch_size // self.npv)
+        self.seeds = SeedSource(
             self.seeding_data,
-            np.eye(4),
-            seeds_count=self.npv)
+            self.npv,
+            random_seed=self.rng.randint(2 ** 31),
+            block_size=block_size,
+            order=self.seed_order,
+            origin=seeding_mask.origin)
         # print(
         #     '{} has {} seeds.'.format(self.__class__.__name__,
         #                               len(self.seeds)))
@@ -227,58 +302,144 @@ class BaseEnv(object):
 
         # Stopping criteria is a dictionary that maps `StoppingFlags`
         # to functions that indicate whether streamlines should stop or not
+        self.stopping_criteria = self._get_stopping_criteria(mask_data)
+
+        # ==========================================
+        # Reward function
+        # =========================================
+
+        # Reward function and reward factors
+        if self.compute_reward:
+            self.reward_function = self._get_reward_function()
+
+    @staticmethod
+    def _crop_volumes(
+        volumes: tuple,
+        tracking_mask: MRIDataVolume,
+        seeding_mask: MRIDataVolume,
+        margin: int,
+    ) -> tuple:
+        """ Crop volumes to the bounding box of the tracking and seeding
+        masks, grown by a margin. See `MRIDataVolume.crop`.
+
+        Parameters
+        ----------
+        volumes: tuple of MRIDataVolume
+            Volumes to crop, on the grid of the masks.
+        tracking_mask: MRIDataVolume
+            Tracking mask of the subject.
+        seeding_mask: MRIDataVolume
+            Seeding mask of the subject.
+        margin: int
+            Number of voxels kept around the masks. Streamlines should
+            never get closer than the support of the interpolation to the
+            border of the box.
+
+        Returns
+        -------
+        volumes: tuple of MRIDataVolume
+            Cropped volumes, in the same order.
+        """
+        bbox = bounding_box(np.logical_or(
+            tracking_mask.data, seeding_mask.data), margin)
+        return tuple(volume.crop(bbox) for volume in volumes)
+
+    def _signal_to_device(self, data):
+        """ Copy the input signal to the device of the environment, in the
+        storage precision.
+
+        Parameters
+        ----------
+        data: `numpy.ndarray` or `SparseVolume`
+            Signal of the subject.
+
+        Returns
+        -------
+        data_volume: `torch.Tensor` or `SparseVolume`
+            Signal on the device, sparse if `data` is.
+        """
+        if isinstance(data, SparseVolume):
+            return data.to_torch(self.device, self.storage_dtype)
+        return torch.from_numpy(data).to(
+            self.device, dtype=self.storage_dtype)
+
+    def _get_stopping_criteria(
+        self,
+        mask_data: np.ndarray,
+    ) -> Dict[StoppingFlags, Callable]:
+        """ Build the stopping criteria of the current subject.
+
+        Parameters
+        ----------
+        mask_data: `numpy.ndarray`
+            Tracking mask of the subject.
+
+        Returns
+        -------
+        stopping_criteria: dict of `StoppingFlags` -> Callable
+            Stopping criterion associated with each flag.
+        """
 
-        # TODO: Make all stopping criteria classes.
         # TODO?: Use dipy's stopping criteria instead of custom ones ?
-        self.stopping_criteria = {}
+        stopping_criteria = {}
 
         # Length criterion
-        self.stopping_criteria[StoppingFlags.STOPPING_LENGTH] = \
-            functools.partial(is_too_long,
-                              max_nb_steps=self.max_nb_steps)
+        stopping_criteria[StoppingFlags.STOPPING_LENGTH] = \
+            LengthStoppingCriterion(self.max_nb_steps)
 
         # Angle between segment (curvature criterion)
-        self.stopping_criteria[
+        stopping_criteria[
             StoppingFlags.STOPPING_CURVATURE] = \
-            functools.partial(is_too_curvy, max_theta=self.theta)
+            CurvatureStoppingCriterion(self.theta)
 
         # Stopping criterion according to an oracle
         if self.oracle_checkpoint and self.oracle_stopping_criterion:
-            self.stopping_criteria[
+            stopping_criteria[
                 StoppingFlags.STOPPING_ORACLE] = OracleStoppingCriterion(
                 self.oracle_checkpoint,
                 self.min_nb_steps * 5,
-                self.reference,
-                self.affine_vox2rasmm,
-                self.device)
+                self.affine_vox2oracle,
+                self.device,
+                self.oracle_cadence,
+                self.oracle_inference,
+                self.oracle_server)
 
         # Mask criterion (either binary or CMC)
         binary_criterion = BinaryStoppingCriterion(
             mask_data,
-            self.binary_stopping_threshold)
-        self.stopping_criteria[StoppingFlags.STOPPING_MASK] = \
+            self.binary_stopping_threshold,
+            self.cache,
+            self.volume_origin,
+            self.grid_shape)
+        stopping_criteria[StoppingFlags.STOPPING_MASK] = \
             binary_criterion
 
-        # ==========================================
-        # Reward function
-        # =========================================
+        return stopping_criteria
 
-        # Reward function and reward factors
-        if self.compute_reward:
-            # Reward streamline according to alignment with local peaks
-            peaks_reward = PeaksAlignmentReward(self.peaks)
-            oracle_reward = OracleReward(self.oracle_checkpoint,
-                                         self.min_nb_steps,
-                                         self.reference,
-                                         self.affine_vox2rasmm,
-                                         self.device)
-
-            # Combine all reward factors into the reward function
-            self.reward_function = RewardFunction(
-                [peaks_reward,
-                 oracle_reward],
-                [self.alignment_weighting,
-                 self.oracle_bonus])
+    def _get_reward_function(self) -> RewardFunction:
+        """ Build the reward function of the current subject.
+
+        Returns
+        -------
+        reward_function: RewardFunction
+            Weighted sum of the reward factors.
+        """
+
+        # Reward streamline according to alignment with local peaks
+        peaks_reward = PeaksAlignmentReward(self.peaks)
+        oracle_reward = OracleReward(self.oracle_checkpoint,
+                                     self.min_nb_steps,
+                                     self.affine_vox2oracle,
+                                     self.device,
+                                     self.oracle_inference,
+                                     self.oracle_server)
+
+        # Combine all reward factors into the reward function
+        return RewardFunction(
+            [peaks_reward,
+             oracle_reward],
+            [self.alignment_weighting,
+             self.oracle_bonus])
 
     @classmethod
     def from_dataset(
@@ -339,7 +500,12 @@ class BaseEnv(object):
                 in_seed,
                 in_mask,
                 sh_basis,
-                target_sh_order)
+                target_sh_order,
+                BaseEnv._get_cache(env_dto),
+                STORAGE_DTYPES[env_dto.get('storage_precision', 'fp32')][0],
+                env_dto.get('sparse_volumes', False),
+                env_dto.get('crop_margin'),
+                env_dto.get('num_processes', 1))
 
         subj_files = (input_volume, tracking_mask, seeding_mask,
                       peaks_volume, reference)
@@ -354,13 +520,18 @@ class BaseEnv(object):
         in_mask,
         sh_basis,
         target_sh_order=6,
+        cache=None,
+        dtype=None,
+        sparse=False,
+        crop_margin=None,
+        num_processes=1,
     ):
         """ Load data volumes and masks from files. This is useful for
         tracking from a trained model.
 
         If the signal is not in descoteaux07 basis, it will be converted. The
         WM mask will be loaded and concatenated to the signal. Additionally,
-        peaks will be computed from the signal.
+        peaks will be computed from the signal when they are first needed.
 
         Parameters
         ----------
@@ -374,6 +545,20 @@ class BaseEnv(object):
             Basis of the SH coefficients.
         target_sh_order: int
             Target SH order. Should come from the hyperparameters file.
+        cache: VolumeCache
+            If set, the converted signal and the peaks are loaded from (or
+            stored in) this cache.
+        dtype: np.dtype
+            If set, the signal and the peaks are stored with this dtype
+            (e.g. `np.float16` to halve their memory).
+        sparse: bool
+            If set, the signal and the peaks are stored as `SparseVolume`
+            and the masks as uint8.
+        crop_margin: int
+            If set, the volumes are cropped to the bounding box of the
+            masks grown by this many voxels. See `_crop_volumes`.
+        num_processes: int
+            Number of processes extracting the peaks, see `extract_peaks`.
 
         Returns
         -------
@@ -397,32 +582,133 @@ class BaseEnv(object):
                   'ran robustly. You are entering undefined behavior '
                   'territory.')
 
-        data = set_sh_order_basis(signal.get_fdata(dtype=np.float32),
-                                  sh_basis,
-                                  target_order=target_sh_order,
-                                  target_basis='descoteaux07')
+        def convert_signal():
+            data = set_sh_order_basis(signal.get_fdata(dtype=np.float32),
+                                      sh_basis,
+                                      target_order=target_sh_order,
+                                      target_basis='descoteaux07')
+            if dtype is not None:
+                data = data.astype(dtype)
+            return data
+
+        def compute_peaks(data):
+            if dtype is None:
+                return cls._compute_peaks(
+                    data, npeaks=5, num_processes=num_processes)
+            # Peaks are extracted in single precision
+            return cls._compute_peaks(
+                data.astype(np.float32), npeaks=5,
+                num_processes=num_processes).astype(dtype)
+
+        if cache is not None:
+            signal_hash = cache.hash_file(signal_file)
+            data = cache.get(
+                cache.key(signal_hash, 'sh', sh_basis, target_sh_order,
+                          dtype),
+                convert_signal)
+        else:
+            data = convert_signal()
+
+        # Load rest of volumes
+        seeding = nib.load(in_seed)
+        tracking = nib.load(in_mask)
+        seeding_data = seeding.get_fdata()
+        tracking_data = tracking.get_fdata()
+        if sparse:
+            # Masks are binarized by the environment anyway
+            seeding_data = seeding_data.astype(np.uint8)
+            tracking_data = tracking_data.astype(np.uint8)
+        signal_volume = MRIDataVolume(data, signal.affine)
+        seeding_volume = MRIDataVolume(seeding_data, seeding.affine)
+        tracking_volume = MRIDataVolume(tracking_data, tracking.affine)
+
+        # Crop as soon as possible so that the whole volumes are freed
+        bbox = None
+        if crop_margin is not None:
+            bbox = bounding_box(
+                np.logical_or(tracking_data, seeding_data), crop_margin)
+            signal_volume, seeding_volume, tracking_volume = (
+                volume.crop(bbox) for volume in
+                (signal_volume, seeding_volume, tracking_volume))
+
+        if sparse:
+            # Only the voxels with a signal are kept
+            signal_volume = signal_volume.derive(SparseVolume.from_dense)
+
+        def load_peaks(data):
+            def peaks_from_signal():
+                return compute_peaks(data.to_dense() if sparse else data)
+
+            if cache is not None:
+                # Peaks of a cropped signal are only valid for that box
+                crop = () if bbox is None else (bbox,)
+                peaks = cache.get(
+                    cache.key(signal_hash, 'peaks', sh_basis,
+                              target_sh_order, dtype, *crop),
+                    peaks_from_signal)
+            else:
+                peaks = peaks_from_signal()
+            return SparseVolume.from_dense(peaks) if sparse else peaks
+
+        # Peaks are only computed if a consumer (e.g. the peaks alignment
+        # reward) needs them
+        peaks_volume = signal_volume.derive(load_peaks)
+
+        return (signal_volume, peaks_volume, tracking_volume, seeding_volume)
+
+    @staticmethod
+    def _get_cache(env_dto: dict) -> VolumeCache:
+        """ Build the cache of derived volumes, if a cache directory is
+        set.
+
+        Parameters
+        ----------
+        env_dto: dict
+            DTO containing env. parameters
+
+        Returns
+        -------
+        cache: VolumeCache
+            Cache of derived volumes, or None.
+        """
+        if not env_dto.get('cache_dir'):
+            return None
+        return VolumeCache(env_dto['cache_dir'], env_dto['cache_size'])
+
+    @staticmethod
+    def _compute_peaks(
+        data: np.ndarray,
+        npeaks: int = 5,
+        num_processes: int = 1,
+    ) -> np.ndarray:
+        """ Compute the peaks of fODFs, scaled by their value relative to the
+        largest peak of their voxel.
+
+        Parameters
+        ----------
+        data: `numpy.ndarray` of shape (X, Y, Z, n_coefs)
+            SH coefficients, in descoteaux07 basis.
+        npeaks: int
+            Maximum number of peaks per voxel.
+        num_processes: int
+            Number of processes extracting the peaks, see `extract_peaks`.
+
+        Returns
+        -------
+        peak_dirs: `numpy.ndarray` of shape (X, Y, Z, npeaks * 3)
+            Scaled peaks.
+        """
 
         # Compute peaks from signal
         # Does not work if signal is not fODFs
-        npeaks = 5
-        odf_shape_3d = data.shape[:-1]
-        peak_dirs = np.zeros((odf_shape_3d + (npeaks, 3)))
-        peak_values = np.zeros((odf_shape_3d + (npeaks, )))
-
         sphere = HemiSphere.from_sphere(get_sphere("repulsion724")
                                         ).subdivide(0)
 
         b_matrix, _ = sh_to_sf_matrix(sphere, find_order_from_nb_coeff(data), "descoteaux07")
 
-        for idx in np.argwhere(np.sum(data, axis=-1)):
-            idx = tuple(idx)
-            directions, values, indices = get_maximas(data[idx],
-                                                      sphere, b_matrix,
-                                                      0.1, 0)
-            if values.shape[0] != 0:
-                n = min(npeaks, values.shape[0])
-                peak_dirs[idx][:n] = directions[:n]
-                peak_values[idx][:n] = values[:n]
+        peak_dirs, peak_values = extract_peaks(
+            data, sphere, b_matrix, npeaks, relative_peak_threshold=0.1,
+            num_processes=num_processes)
 
         X, Y, Z, N, P = peak_dirs.shape
         peak_values = np.divide(peak_values, peak_values[..., 0, None],
@@ -431,22 +717,20 @@ class BaseEnv(object):
         peak_dirs[...] *= peak_values[..., :, None]
         peak_dirs = reshape_peaks_for_visualization(peak_dirs)
 
-        # Load rest of volumes
-        seeding = nib.load(in_seed)
-        tracking = nib.load(in_mask)
-        signal_data = data
-        signal_volume = MRIDataVolume(
-            signal_data, signal.affine)
+        return peak_dirs
 
-        peaks_volume = MRIDataVolume(
-            peak_dirs, signal.affine)
+    def reseed(self, seed: int):
+        """ Reset the random number generator of the environment, e.g. so
+        that a subset of the seeds is tracked the same way no matter what
+        was tracked before.
 
-        seeding_volume = MRIDataVolume(
-            seeding.get_fdata(), seeding.affine)
-        tracking_volume = MRIDataVolume(
-            tracking.get_fdata(), tracking.affine)
+        Parameters
+        ----------
+        seed: int
+            New seed of the random number generator.
+        """
 
-        return (signal_volume, peaks_volume, tracking_volume, seeding_volume)
+        self.rng.seed(seed)
 
     def get_state_size(self):
         """ Returns the size of the state space by computing the size of
@@ -501,72 +785,76 @@ class BaseEnv(object):
 
         return actions
 
+    def _allocate_state(
+        self,
+        n_streamlines: int,
+    ) -> torch.Tensor:
+        """ Preallocate the state of `n_streamlines` streamlines. The state
+        is then filled in place by `_format_state` as streamlines grow.
+
+        Parameters
+        ----------
+        n_streamlines: int
+            Number of streamlines tracked at once.
+
+        Returns
+        -------
+        state: `torch.Tensor`
+            Zeroed observations of the state, incl. previous directions.
+        """
+        signal_size = \
+            self.data_volume.shape[-1] * len(self.neighborhood_directions)
+        return torch.zeros(
+            (n_streamlines, signal_size + (self.n_dirs * 3)),
+            device=self.device)
+
     def _format_state(
         self,
-        streamlines: np.ndarray
-    ) -> np.ndarray:
+        streamlines: StreamlineView
+    ):
         """
         From the last streamlines coordinates, extract the corresponding
-        SH coefficients
+        SH coefficients and write them, along with the previous directions
+        of the streamlines, in their rows of `self.state`.
 
         Parameters
         ----------
-        streamlines: `numpy.ndarry`
+        streamlines: `StreamlineView`
             Streamlines from which to get the coordinates
-
-        Returns
-        -------
-        inputs: `numpy.ndarray`
-            Observations of the state, incl. previous directions.
         """
-        N, L, P = streamlines.shape
+        N = len(streamlines)
 
         if N <= 0:
-            return []
+            return
 
         # Get the last point of each streamline
-        segments = streamlines[:, -1, :][:, None, :]
-
-        # Reshape to get a list of coordinates
-        N, H, P = segments.shape
-        flat_coords = np.reshape(segments, (N * H, P))
-        coords = torch.as_tensor(flat_coords).to(self.device)
+        coords = torch.as_tensor(streamlines.last_points()).to(self.device)
 
         # Get the SH coefficients at the last point of each streamline
         # The neighborhood is used to get the SH coefficients around
         # the last point
-        signal, _ = interpolate_volume_in_neighborhood(
-            self.data_volume,
-            coords,
-            self.neighborhood_directions)
+        if self.neighborhood_sampler is not None:
+            signal = self.neighborhood_sampler(coords)
+        else:
+            signal, _ = interpolate_volume_in_neighborhood(
+                self.data_volume,
+                coords - self.signal_origin,
+                self.neighborhood_directions)
         N, S = signal.shape
 
-        # Placeholder for the final imputs
-        inputs = torch.zeros((N, S + (self.n_dirs * P)), device=self.device)
         # Fill the first part of the inputs with the SH coefficients
-        inputs[:, :S] = signal
-
-        # Placeholder for the previous directions
-        previous_dirs = np.zeros((N, self.n_dirs, P), dtype=np.float32)
-        if L > 1:
-            # Compute directions from the streamlines
-            dirs = np.diff(streamlines, axis=1)
-            # Fetch the N last directions
-            previous_dirs[:, :min(dirs.shape[1], self.n_dirs), :] = \
-                dirs[:, :-(self.n_dirs+1):-1, :]
-
-        # Flatten the directions to fit in the inputs and send to device
-        dir_inputs = torch.reshape(
-            torch.from_numpy(previous_dirs).to(self.device),
-            (N, self.n_dirs * P))
-        # Fill the second part of the inputs with the previous directions
-        inputs[:, S:] = dir_inputs
-
-        return inputs
+        self.state[streamlines.idx, :S] = signal
+
+        # Previous directions are kept up to date by the streamline buffer,
+        # the most recent first. Flatten them to fit in the inputs.
+        previous_dirs = torch.as_tensor(
+            streamlines.previous_dirs()).to(self.device)
+        self.state[streamlines.idx, S:] = torch.reshape(
+            previous_dirs, (N, -1))
 
     def _compute_stopping_flags(
         self,
-        streamlines: np.ndarray,
+        streamlines: StreamlineView,
         stopping_criteria: Dict[StoppingFlags, Callable]
     ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
         """ Checks which streamlines should stop and which ones should
@@ -574,8 +862,8 @@ class BaseEnv(object):
 
         Parameters
         ----------
-        streamlines : `numpy.ndarray` of shape (n_streamlines, n_points, 3)
-            Streamline coordinates in voxel space
+        streamlines : `StreamlineView`
+            Streamlines in voxel space
         stopping_criteria : dict of int->Callable
             List of functions that take as input streamlines, and output a
             boolean numpy array indicating which streamlines should stop
@@ -613,6 +901,24 @@ class BaseEnv(object):
         """
         if self.compute_reward:
             self.reward_function.reset()
+        self._reset_stopping_criteria()
+
+    def _reset_stopping_criteria(self, idx=None):
+        """ Clear what the stopping criteria keep about the streamlines of
+        some rows, e.g. the last scores of the oracle, when new streamlines
+        are started in them.
+
+        Parameters
+        ----------
+        idx: `numpy.ndarray` or `torch.Tensor` of int
+            Rows in which new streamlines are started. Every row if not
+            set.
+        """
+        # The stopping criteria only exist once a subject is loaded
+        stopping_criteria = getattr(self, 'stopping_criteria', {})
+        oracle = stopping_criteria.get(StoppingFlags.STOPPING_ORACLE)
+        if oracle is not None:
+            oracle.reset(idx)
 
     def step():
         """
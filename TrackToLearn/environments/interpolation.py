@@ -1,4 +1,7 @@
 import numpy as np
+import torch
+
+from TrackToLearn.datasets.utils import SparseVolume
 
 # from numba import njit
 
@@ -24,3 +27,241 @@ def nearest_neighbor_interpolation(
     output = volume[tuple(indices)]
 
     return output
+
+
+def torch_nearest_neighbor_interpolation(
+    volume: torch.Tensor,
+    coords: torch.Tensor,
+) -> torch.Tensor:
+    """ Same as `nearest_neighbor_interpolation`, for volumes and
+    coordinates on the same torch device.
+
+    Parameters
+    ----------
+    volume: `torch.Tensor` of shape (X, Y, Z, C)
+        Volume to interpolate.
+    coords: `torch.Tensor` of shape (N, 3)
+        Coordinates in voxel space.
+
+    Returns
+    -------
+    output: `torch.Tensor` of shape (N, C)
+        Values of the nearest voxels.
+    """
+
+    if volume.ndim <= 3 or volume.ndim >= 5:
+        raise ValueError("Volume must be 4D!")
+
+    # Clip indices to make sure we don't go out-of-bounds
+    upper = torch.as_tensor(volume.shape[:3], device=coords.device) - 1
+    indices = torch.clamp(
+        torch.round(coords).long(), torch.zeros_like(upper), upper)
+    return volume[indices[:, 0], indices[:, 1], indices[:, 2]]
+
+
+def _cubic_bspline_weights(t: torch.Tensor) -> torch.Tensor:
+    """ Weights of the four cubic B-spline coefficients surrounding a
+    point, `t` being the distance to the coefficient on its left.
+    """
+    t2 = t * t
+    t3 = t2 * t
+    return torch.stack((
+        (1. - t) ** 3,
+        3. * t3 - 6. * t2 + 4.,
+        -3. * t3 + 3. * t2 + 3. * t + 1.,
+        t3), dim=-1) / 6.
+
+
+def torch_spline_interpolation(
+    coefficients: torch.Tensor,
+    coords: torch.Tensor,
+) -> torch.Tensor:
+    """ Evaluate an order 3 spline at `coords`. Equivalent to
+    `scipy.ndimage.map_coordinates(coefficients, coords.T, prefilter=False)`
+    with scipy's default `mode='constant'` and `cval=0`: coefficients are
+    mirrored at the edges and points outside the volume evaluate to zero.
+
+    Parameters
+    ----------
+    coefficients: `torch.Tensor` of shape (X, Y, Z)
+        Spline coefficients, as obtained by prefiltering a volume with
+        `scipy.ndimage.spline_filter(volume, order=3)`.
+    coords: `torch.Tensor` of shape (N, 3)
+        Coordinates, in index space of `coefficients`.
+
+    Returns
+    -------
+    values: `torch.Tensor` of shape (N,)
+        Interpolated values.
+    """
+
+    shape = torch.as_tensor(coefficients.shape, device=coords.device)
+    coords = coords.to(coefficients.dtype)
+
+    left = torch.floor(coords)
+    # (N, 3, 4) weights and indices of the coefficients around each point
+    weights = _cubic_bspline_weights(coords - left)
+    indices = left.long()[..., None] + torch.arange(
+        -1, 3, device=coords.device)
+
+    # Mirror indices falling outside the volume
+    upper = (shape - 1)[None, :, None]
+    indices = torch.abs(indices)
+    indices = torch.where(indices > upper, 2 * upper - indices, indices)
+    indices = torch.clamp(indices, torch.zeros_like(upper), upper)
+
+    # Gather the 4x4x4 neighbouring coefficients of every point
+    flat_indices = (
+        (indices[:, 0, :, None, None] * shape[1] +
+         indices[:, 1, None, :, None]) * shape[2] +
+        indices[:, 2, None, None, :])
+    neighbours = coefficients.reshape(-1)[flat_indices]
+
+    values = torch.einsum(
+        'na,nb,nc,nabc->n',
+        weights[:, 0], weights[:, 1], weights[:, 2], neighbours)
+
+    # No interpolation is done outside the volume
+    outside = torch.any((coords < 0) | (coords > (shape - 1)), dim=-1)
+    return torch.where(outside, torch.zeros_like(values), values)
+
+
+# Offsets of the 8 corners of the voxel cell surrounding a point
+_CELL_CORNERS = torch.tensor(
+    [[0, 0, 0], [0, 0, 1], [0, 1, 0], [0, 1, 1],
+     [1, 0, 0], [1, 0, 1], [1, 1, 0], [1, 1, 1]])
+
+
+class NeighborhoodSampler(object):
+    """ Trilinear interpolation of a 4D volume at points and at a fixed
+    neighbourhood around them, all at once. Equivalent to dwi_ml's
+    `interpolate_volume_in_neighborhood`: coordinates are in voxel space
+    with the origin at the corner of the voxels, and points outside the
+    volume take the value of the nearest edge.
+
+    If the volume is small enough, the values of the 8 corners of every
+    voxel cell are precomputed and stacked, so that the whole state is one
+    gather of contiguous rows instead of 8 scattered gathers per point.
+    The stacked volume takes 8 times the memory of the volume.
+
+    The volume may be stored in half precision, values are interpolated
+    in float32. It may also be a `SparseVolume`, in which case corners are
+    gathered through its index grid and are never stacked.
+    """
+
+    def __init__(
+        self,
+        volume: torch.Tensor,
+        neighborhood: torch.Tensor,
+        max_stacked_size: float = 0.,
+        origin: torch.Tensor = None,
+    ):
+        """
+        Parameters
+        ----------
+        volume: `torch.Tensor` or `SparseVolume` of shape (X, Y, Z, C)
+            Volume to interpolate.
+        neighborhood: `torch.Tensor` of shape (M, 3)
+            Offsets, in voxels, of the points to interpolate around each
+            coordinate, usually starting with the origin.
+        max_stacked_size: float
+            Stack the corners of the volume if it fits in this size, in GB.
+        origin: `torch.Tensor` of shape (3,)
+            If the volume is cropped, voxel of the subject at which it
+            starts. Coordinates are in the voxel space of the subject.
+        """
+        self.volume = volume
+        self.sparse = isinstance(volume, SparseVolume)
+        device = volume.values.device if self.sparse else volume.device
+        self.neighborhood = neighborhood.to(device, torch.float32)
+        self.corners = _CELL_CORNERS.to(device)
+        self.shape = torch.as_tensor(volume.shape[:3], device=device)
+        self.origin = torch.zeros(3, device=device) if origin is None \
+            else origin.to(device, torch.float32)
+
+        self.stacked = None
+        if not self.sparse:
+            stacked_size = 8 * volume.element_size() * \
+                int(torch.prod(self.shape + 1)) * volume.shape[-1]
+            if stacked_size <= max_stacked_size * 1024 ** 3:
+                self.stacked = self._stack_corners(volume)
+
+    def _stack_corners(self, volume: torch.Tensor) -> torch.Tensor:
+        """ Stack the values of the 8 corners of every voxel cell. Cells
+        start one voxel before the volume so that points between the edge
+        and the center of the first voxels also have a cell.
+
+        Returns
+        -------
+        stacked: `torch.Tensor` of shape (X + 1, Y + 1, Z + 1, 8, C)
+            Corners of cell `i` are the voxels `i - 1` and `i` along each
+            axis, clipped to the volume.
+        """
+        # Volume padded with its edges
+        padded = volume
+        for axis in range(3):
+            idx = torch.clamp(torch.arange(
+                -1, volume.shape[axis] + 1, device=volume.device),
+                0, volume.shape[axis] - 1)
+            padded = torch.index_select(padded, axis, idx)
+
+        X, Y, Z = volume.shape[:3]
+        return torch.stack(
+            [padded[a:a + X + 1, b:b + Y + 1, c:c + Z + 1]
+             for a, b, c in self.corners.tolist()], dim=3)
+
+    def __call__(self, coords: torch.Tensor) -> torch.Tensor:
+        """ Interpolate the volume around each point.
+
+        Parameters
+        ----------
+        coords: `torch.Tensor` of shape (N, 3)
+            Coordinates in voxel space, origin at the corner.
+
+        Returns
+        -------
+        values: `torch.Tensor` of shape (N, M * C)
+            Interpolated values at each point of the neighbourhood of each
+            coordinate, neighbours first.
+        """
+        N = coords.shape[0]
+        C = self.volume.shape[-1]
+
+        # The origin is subtracted last so that points are rounded like
+        # in the whole volume
+        points = (coords.to(torch.float32)[:, None] +
+                  self.neighborhood[None] - self.origin).reshape(-1, 3) - 0.5
+        lower = torch.floor(points)
+        d = points - lower
+        lower = lower.long()
+
+        # (N * M, 8) weights of the corners of the cell of each point
+        weights = torch.where(
+            self.corners[None] == 1, d[:, None], 1. - d[:, None]).prod(-1)
+
+        if self.stacked is not None:
+            # Beyond the padding, every corner is the edge of the volume
+            cells = torch.clamp(lower + 1, torch.zeros_like(self.shape),
+                                self.shape)
+            stride = self.shape + 1
+            flat = (cells[:, 0] * stride[1] + cells[:, 1]) * stride[2] + \
+                cells[:, 2]
+            values = torch.index_select(
+                self.stacked.reshape(-1, 8, C), 0, flat)
+        else:
+            corners = torch.clamp(
+                lower[:, None] + self.corners[None],
+                torch.zeros_like(self.shape), self.shape - 1)
+            flat = ((corners[..., 0] * self.shape[1] + corners[..., 1]) *
+                    self.shape[2] + corners[..., 2]).reshape(-1)
+            if self.sparse:
+                rows = torch.index_select(
+                    self.volume.index.reshape(-1), 0, flat).long()
+                values = torch.index_select(self.volume.values, 0, rows)
+            else:
+                values = torch.index_select(
+                    self.volume.reshape(-1, C), 0, flat)
+            values = values.reshape(-1, 8, C)
+
+        values = torch.bmm(weights[:, None], values.to(torch.float32))
+        return values.reshape(N, -1)
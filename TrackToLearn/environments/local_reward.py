@@ -1,9 +1,12 @@
 import numpy as np
+import torch
 
 from TrackToLearn.environments.interpolation import (
-    nearest_neighbor_interpolation)
-from TrackToLearn.datasets.utils import MRIDataVolume
+    nearest_neighbor_interpolation, torch_nearest_neighbor_interpolation)
+from TrackToLearn.datasets.utils import MRIDataVolume, SparseVolume
 from TrackToLearn.environments.reward import Reward
+from TrackToLearn.environments.streamline_buffer import (
+    StreamlineView, TorchStreamlineView)
 from TrackToLearn.utils.utils import normalize_vectors
 
 
@@ -24,35 +27,48 @@ class PeaksAlignmentReward(Reward):
     ):
         self.name = 'peaks_reward'
 
-        self.peaks = peaks.data
+        # Peaks may be lazy, only materialize them when first needed
+        self._peaks = peaks
+        # Peaks may be cropped from the grid of the subject
+        self.origin = peaks.origin.astype(np.float32)
+
+    @property
+    def peaks(self):
+        return self._peaks.data
 
     def __call__(
         self,
-        streamlines: np.ndarray,
+        streamlines: StreamlineView,
         dones: np.ndarray
     ):
         """
         Parameters
         ----------
-        streamlines : `numpy.ndarray` of shape (n_streamlines, n_points, 3)
-            Streamline coordinates in voxel space
+        streamlines : `StreamlineView`
+            Streamlines in voxel space.
 
         Returns
         -------
         rewards: 1D boolean `numpy.ndarray` of shape (n_streamlines,)
             Array containing the reward
         """
-        N, L, _ = streamlines.shape
+        N = len(streamlines)
+        lengths = streamlines.lengths
 
-        if streamlines.shape[1] < 2:
+        if np.all(lengths < 2):
             # Not enough segments to compute curvature
-            return np.ones(len(streamlines), dtype=np.uint8)
+            return np.ones(N, dtype=np.uint8)
+
+        # Only the last two segments are needed
+        tail = streamlines.tail(3)
 
         X, Y, Z, P = self.peaks.shape
-        idx = streamlines[:, -2].astype(np.int32)
+        idx = (tail[:, -2] - self.origin).astype(np.int32)
 
         # Get peaks at streamline end
         v = nearest_neighbor_interpolation(self.peaks, idx)
+        # Peaks may be stored in half precision
+        v = v.astype(np.promote_types(v.dtype, np.float32), copy=False)
 
         v = np.reshape(v, (N * 5, P // 5))
 
@@ -66,7 +82,7 @@ class PeaksAlignmentReward(Reward):
 
         # Get last streamline segments
 
-        dirs = np.diff(streamlines, axis=1)
+        dirs = np.diff(tail, axis=1)
         u = dirs[:, -1]
         # Normalize segments
         with np.errstate(divide='ignore', invalid='ignore'):
@@ -87,7 +103,7 @@ class PeaksAlignmentReward(Reward):
         factors = np.ones((N))
 
         # Weight alignment with peaks with alignment to itself
-        if streamlines.shape[1] >= 3:
+        if np.any(lengths >= 3):
             # Get previous to last segment
             w = dirs[:, -2]
 
@@ -100,8 +116,88 @@ class PeaksAlignmentReward(Reward):
 
             # Calculate alignment between two segments
             np.einsum('ik,ik->i', u, w, out=factors)
+            # Streamlines with a single segment are not penalized
+            factors[lengths < 3] = 1.
+
+        # Penalize angle with last step
+        rewards *= factors
+        rewards[lengths < 2] = 1.
+
+        return rewards
+
+
+class TorchPeaksAlignmentReward(PeaksAlignmentReward):
+
+    """ Same as `PeaksAlignmentReward`, for streamlines on a torch device.
+    The peaks are kept on the device.
+    """
+
+    def __init__(
+        self,
+        peaks: MRIDataVolume,
+        device: torch.device = 'cpu',
+    ):
+        super().__init__(peaks)
+
+        def to_device(peaks):
+            # Half precision peaks stay in half precision on the device
+            dtype = torch.float16 if peaks.dtype == np.float16 \
+                else torch.float32
+            if isinstance(peaks, SparseVolume):
+                return peaks.to_torch(device, dtype)
+            return torch.as_tensor(peaks, device=device, dtype=dtype)
+
+        self._peaks = self._peaks.derive(to_device)
+        self.origin = torch.as_tensor(self.origin, device=device)
+
+    def __call__(
+        self,
+        streamlines: TorchStreamlineView,
+        dones: torch.Tensor
+    ):
+        """
+        Parameters
+        ----------
+        streamlines : `TorchStreamlineView`
+            Streamlines in voxel space.
+
+        Returns
+        -------
+        rewards: 1D `torch.Tensor` of shape (n_streamlines,)
+            Tensor containing the reward
+        """
+        N = len(streamlines)
+        lengths = streamlines.lengths
+
+        # Only the last two segments are needed
+        tail = streamlines.tail(3)
+
+        X, Y, Z, P = self.peaks.shape
+        idx = torch.trunc(tail[:, -2] - self.origin)
+
+        # Get peaks at streamline end and normalize them
+        v = torch_nearest_neighbor_interpolation(self.peaks, idx).float()
+        v = torch.reshape(v, (N, 5, P // 5))
+        v = torch.nan_to_num(v / torch.linalg.norm(v, dim=-1, keepdim=True))
+
+        # Get last streamline segments and normalize them
+        dirs = torch.diff(tail, dim=1)
+        u = dirs[:, -1]
+        u = torch.nan_to_num(u / torch.linalg.norm(u, dim=-1, keepdim=True))
+
+        # Get alignment with the most aligned peak
+        dot = torch.abs(torch.einsum('ijk,ik->ij', v, u))
+        rewards = torch.amax(dot, dim=-1)
+
+        # Weight alignment with peaks with alignment to itself
+        w = dirs[:, -2]
+        w = torch.nan_to_num(w / torch.linalg.norm(w, dim=-1, keepdim=True))
+        factors = torch.sum(u * w, dim=-1)
+        # Streamlines with a single segment are not penalized
+        factors[lengths < 3] = 1.
 
         # Penalize angle with last step
         rewards *= factors
+        rewards[lengths < 2] = 1.
 
         return rewards
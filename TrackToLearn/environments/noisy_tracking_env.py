@@ -1,3 +1,5 @@
+from functools import partial
+
 import numpy as np
 
 from scipy.ndimage import map_coordinates, spline_filter
@@ -30,9 +32,14 @@ class NoisyTrackingEnvironment(TrackingEnvironment):
         super().__init__(dataset_file, split_id, env_dto)
 
         self.noise = env_dto['noise']
+        # The FA map is only prefiltered if noise is added
         self.fa_map = None
         if env_dto['fa_map']:
-            self.fa_map = spline_filter(env_dto['fa_map'].data, order=3)
+            self.fa_map = env_dto['fa_map'].derive(
+                partial(spline_filter, order=3))
+            # Prefiltered before being cropped like the other volumes
+            if self.crop_margin is not None:
+                self.fa_map = self.fa_map.crop(self.volume_bbox)
         self.max_action = 1.
 
     def step(
@@ -63,12 +70,12 @@ class NoisyTrackingEnvironment(TrackingEnvironment):
         directions = actions
 
         if self.fa_map is not None and self.noise > 0.:
-            idx = self.streamlines[self.continue_idx,
-                                   self.length-1].astype(np.int32)
+            idx = (self.streamlines[self.continue_idx].last_points() -
+                   self.volume_origin).astype(np.int32)
 
             # Get FA at streamline end
             fa = map_coordinates(
-                self.fa_map, idx.T - 0.5, prefilter=False)
+                self.fa_map.data, idx.T - 0.5, prefilter=False)
             noise = ((1. - fa) * self.noise)
         else:
             noise = self.rng.normal(0., self.noise, size=directions.shape)
@@ -1,11 +1,11 @@
-import nibabel as nib
 import numpy as np
 
-from dipy.io.stateful_tractogram import StatefulTractogram, Space, Tractogram
-
 from TrackToLearn.environments.reward import Reward
+from TrackToLearn.environments.streamline_buffer import StreamlineView
+from TrackToLearn.environments.utils import to_oracle_space
 
 from TrackToLearn.oracles.oracle import OracleSingleton
+from TrackToLearn.oracles.oracle_server import OracleClient
 
 
 class OracleReward(Reward):
@@ -18,9 +18,10 @@ class OracleReward(Reward):
         self,
         checkpoint: str,
         min_nb_steps: int,
-        reference: nib.Nifti1Image,
-        affine_vox2rasmm: np.ndarray,
-        device: str
+        affine_vox2oracle: np.ndarray,
+        device: str,
+        inference: str = 'fp32',
+        server: str = None,
     ):
         # Name for stats
         self.name = 'oracle_reward'
@@ -31,15 +32,20 @@ class OracleReward(Reward):
         if checkpoint:
             self.checkpoint = checkpoint
             # The oracle is declared as a singleton to prevent loading the
-            # weights in memory multiple times.
-            self.model = OracleSingleton(checkpoint, device)
+            # weights in memory multiple times. It may also be shared with
+            # other processes by a server.
+            if server:
+                self.model = OracleClient(server)
+            else:
+                self.model = OracleSingleton(
+                    checkpoint, device, inference=inference)
         else:
             self.checkpoint = None
 
-        self.reference = reference
-        self.affine_vox2rasmm = affine_vox2rasmm
+        # Affine from the voxel space of the streamlines to the
+        # voxel-corner space of the reference anat
+        self.affine_vox2oracle = affine_vox2oracle
 
-        # Reference anat
         self.device = device
 
     def reward(self, streamlines, dones):
@@ -69,25 +75,20 @@ class OracleReward(Reward):
 
     def __call__(
         self,
-        streamlines: np.ndarray,
+        streamlines: StreamlineView,
         dones: np.ndarray,
     ):
 
-        N, L, P = streamlines.shape
-        if L > self.min_nb_steps and sum(dones.astype(int)) > 0:
+        N = len(streamlines)
+        # Only streamlines that just stopped and are long enough are scored
+        scored = np.logical_and(
+            dones, streamlines.lengths > self.min_nb_steps)
+        if np.any(scored):
 
             # Change ref of streamlines. This is weird on the ISMRM2015
             # dataset as the diff and anat are not in the same space,
             # but it should be fine on other datasets.
-            tractogram = Tractogram(
-                streamlines=streamlines.copy()[dones])
-            tractogram.apply_affine(self.affine_vox2rasmm)
-            sft = StatefulTractogram(
-                streamlines=tractogram.streamlines,
-                reference=self.reference,
-                space=Space.RASMM)
-            sft.to_vox()
-            sft.to_corner()
-
-            return self.reward(sft.streamlines, dones)
+            return self.reward(
+                to_oracle_space(streamlines[scored], self.affine_vox2oracle),
+                scored)
         return np.zeros((N))
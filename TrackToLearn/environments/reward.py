@@ -1,4 +1,7 @@
 import numpy as np
+import torch
+
+from TrackToLearn.environments.streamline_buffer import StreamlineView
 
 
 class Reward(object):
@@ -8,7 +11,7 @@ class Reward(object):
 
     def __call__(
         self,
-        streamlines: np.ndarray,
+        streamlines: StreamlineView,
         dones: np.ndarray
     ):
         self.name = "Undefined"
@@ -50,8 +53,8 @@ class RewardFunction():
 
         Parameters
         ----------
-        streamlines : `numpy.ndarray` of shape (n_streamlines, n_points, 3)
-            Streamline coordinates in voxel space
+        streamlines : `StreamlineView`
+            Streamlines in voxel space.
         dones: `numpy.ndarray` of shape (n_streamlines)
             Whether tracking is over for each streamline or not.
 
@@ -84,3 +87,42 @@ class RewardFunction():
 
         for f in self.factors:
             f.reset()
+
+
+class TorchRewardFunction(RewardFunction):
+
+    """ Same as `RewardFunction`, for reward factors returning tensors on a
+    torch device.
+    """
+
+    def __init__(
+        self,
+        factors,
+        weights,
+        device: torch.device = 'cpu',
+    ):
+        """
+        """
+        super().__init__(factors, weights)
+
+        self.device = device
+
+    def __call__(self, streamlines, dones):
+        """ See `RewardFunction.__call__`.
+        """
+
+        N = len(streamlines)
+
+        rewards_factors = torch.zeros((self.F, N), device=self.device)
+
+        for i, (w, f) in enumerate(zip(self.weights, self.factors)):
+            if w > 0:
+                rewards_factors[i] = w * f(streamlines, dones)
+
+        info = {}
+        for i, f in enumerate(self.factors):
+            info[f.name] = rewards_factors[i].mean().item()
+
+        reward = torch.sum(rewards_factors, dim=0)
+
+        return reward, info
@@ -0,0 +1,267 @@
+import numpy as np
+
+
+class SeedSource(object):
+    """ Seeds uniformly distributed in the voxels of a seeding mask, like
+    dipy's `random_seeds_from_mask`, but generated on demand instead of all
+    at once.
+
+    Only the (shuffled) indices of the mask voxels are kept in memory. The
+    voxels are split into blocks, and the seeds of a block are generated
+    from their own random stream whenever they are requested, so that any
+    range of seeds can be produced in any order and always gives the same
+    seeds for a given `random_seed`. Since voxels are shuffled, consecutive
+    seeds are spread over the whole mask and a partially tracked tractogram
+    looks uniform.
+
+    With `order='morton'`, voxels are instead sorted along a Morton
+    (Z-order) curve before being split into blocks, and only the order of
+    the blocks is random. If blocks hold as many seeds as are tracked at
+    once, each batch of streamlines then starts in a compact region of the
+    volume and their interpolations hit the same part of the memory. Blocks
+    hold `block_size * npv` seeds; `batches` gives batches that never span
+    two of them.
+
+    The source behaves like a `numpy.ndarray` of shape (n_seeds, 3) when
+    indexed with slices or integer arrays.
+    """
+
+    def __init__(
+        self,
+        mask: np.ndarray,
+        npv: int = 1,
+        random_seed: int = None,
+        block_size: int = 4096,
+        order: str = 'random',
+        origin: np.ndarray = None,
+    ):
+        """
+        Parameters
+        ----------
+        mask: `numpy.ndarray` of shape (X, Y, Z)
+            Seeding mask. Seeds are placed in its non-zero voxels.
+        npv: int
+            Number of seeds per voxel.
+        random_seed: int
+            Seed of the random number generator.
+        block_size: int
+            Number of voxels whose seeds are generated at once.
+        order: str
+            Order of the voxels, 'random' or 'morton'.
+        origin: `numpy.ndarray` of shape (3,)
+            If the mask is cropped from the grid of the subject, voxel of
+            the subject at which it starts. Seeds are in the voxel space of
+            the subject.
+        """
+        self.shape = mask.shape
+        self.origin = np.zeros(3, dtype=int) if origin is None \
+            else np.asarray(origin, dtype=int)
+        self.npv = npv
+        self.random_seed = random_seed
+        self.block_size = block_size
+        self.order = order
+
+        rng = np.random.default_rng(random_seed)
+        voxels = np.flatnonzero(mask)
+        if voxels.size == 0 or voxels[-1] < np.iinfo(np.int32).max:
+            voxels = voxels.astype(np.int32)
+        if order == 'random':
+            rng.shuffle(voxels)
+        elif order == 'morton':
+            coords = np.stack(
+                np.unravel_index(voxels, mask.shape), axis=-1) + self.origin
+            voxels = voxels[np.argsort(_morton_codes(coords), kind='stable')]
+            # Shuffle the full blocks, the last one stays last
+            n_full = len(voxels) // block_size
+            blocks = rng.permutation(n_full)
+            voxels[:n_full * block_size] = voxels[:n_full * block_size] \
+                .reshape(n_full, block_size)[blocks].ravel()
+        else:
+            raise ValueError('Unknown seed order {}.'.format(order))
+        self.voxels = voxels
+        # Entropy of the streams of the blocks
+        self._entropy = int(rng.integers(2 ** 63))
+
+        # Range of the seeds of the source, see `subset`
+        self.start = 0
+        self.stop = len(voxels) * npv
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __array__(self, dtype=None):
+        seeds = self[:]
+        return seeds if dtype is None else seeds.astype(dtype)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                return self._generate(
+                    self.start + start, self.start + max(start, stop))
+            key = np.arange(start, stop, step)
+
+        idx = np.asarray(key)
+        if idx.dtype == bool:
+            idx = np.flatnonzero(idx)
+        if idx.ndim == 0:
+            return self[idx.reshape(1)][0]
+
+        idx = self.start + np.where(idx < 0, idx + len(self), idx)
+
+        # Generate each block only once
+        block_len = self.block_size * self.npv
+        blocks = idx // block_len
+        seeds = np.empty((len(idx), 3))
+        for block in np.unique(blocks):
+            in_block = blocks == block
+            seeds[in_block] = self._block(block)[
+                idx[in_block] - block * block_len]
+        return seeds
+
+    def _block(self, block: int) -> np.ndarray:
+        """ Seeds of a block of voxels. The seeds of every voxel of the
+        block are generated once before any voxel gets its second seed,
+        like with dipy.
+
+        Parameters
+        ----------
+        block: int
+            Index of the block.
+
+        Returns
+        -------
+        seeds: `numpy.ndarray` of shape (n_voxels * npv, 3)
+            Seeds of the block, in voxel space.
+        """
+        voxels = self.voxels[
+            block * self.block_size:(block + 1) * self.block_size]
+        rng = np.random.default_rng([self._entropy, int(block)])
+
+        coords = np.stack(
+            np.unravel_index(voxels, self.shape), axis=-1) + self.origin
+        seeds = np.tile(coords, (self.npv, 1)) + \
+            rng.random((len(voxels) * self.npv, 3)) - 0.5
+        return seeds
+
+    def _generate(self, start: int, stop: int) -> np.ndarray:
+        """ Seeds `start` to `stop` (excluded) of the whole source.
+
+        Parameters
+        ----------
+        start: int
+            First seed.
+        stop: int
+            Last seed, excluded.
+
+        Returns
+        -------
+        seeds: `numpy.ndarray` of shape (stop - start, 3)
+            Seeds, in voxel space.
+        """
+        if stop <= start:
+            return np.zeros((0, 3))
+
+        block_len = self.block_size * self.npv
+        first, last = start // block_len, (stop - 1) // block_len
+        seeds = np.concatenate(
+            [self._block(b) for b in range(first, last + 1)])
+        offset = first * block_len
+        return seeds[start - offset:stop - offset]
+
+    def subset(self, start: int, stop: int):
+        """ Source restricted to a range of its seeds. The seeds are not
+        generated.
+
+        Parameters
+        ----------
+        start: int
+            First seed of the range.
+        stop: int
+            Last seed of the range, excluded.
+
+        Returns
+        -------
+        source: SeedSource
+            Source of the seeds in the range.
+        """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        source = object.__new__(SeedSource)
+        source.__dict__.update(self.__dict__)
+        source.start = self.start + start
+        source.stop = self.start + max(start, stop)
+        return source
+
+    def split(self, n: int) -> list:
+        """ Split the source in `n` ranges of (almost) equal sizes, like
+        `numpy.array_split`.
+
+        Parameters
+        ----------
+        n: int
+            Number of ranges.
+
+        Returns
+        -------
+        sources: list of SeedSource
+            Sources of each range, in order.
+        """
+        bounds = [len(self) * i // n for i in range(n + 1)]
+        return [self.subset(a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+
+    def batches(self, batch_size: int) -> list:
+        """ Split the seeds in batches of at most `batch_size` seeds, in
+        order. With `order='morton'`, batches are also cut at the edges of
+        the blocks, so that none spans two of them.
+
+        Parameters
+        ----------
+        batch_size: int
+            Largest number of seeds of a batch.
+
+        Returns
+        -------
+        batches: list of tuple of int
+            First and last (excluded) seed of each batch.
+        """
+        edges = [0, len(self)]
+        if self.order == 'morton':
+            block_len = self.block_size * self.npv
+            first = -(-self.start // block_len) * block_len
+            edges[1:1] = [
+                e - self.start for e in range(first, self.stop, block_len)
+                if e > self.start]
+
+        batches = []
+        for a, b in zip(edges[:-1], edges[1:]):
+            batches.extend(
+                (s, min(s + batch_size, b))
+                for s in range(a, b, batch_size))
+        return batches
+
+
+def _morton_codes(coords: np.ndarray) -> np.ndarray:
+    """ Position of voxels along a Morton (Z-order) curve, obtained by
+    interleaving the bits of their coordinates.
+
+    Parameters
+    ----------
+    coords: `numpy.ndarray` of int of shape (n_voxels, 3)
+        Coordinates of the voxels, each below 2 ** 21.
+
+    Returns
+    -------
+    codes: `numpy.ndarray` of uint64 of shape (n_voxels,)
+        Morton code of each voxel.
+    """
+    codes = np.zeros(len(coords), dtype=np.uint64)
+    for axis in range(3):
+        x = coords[:, axis].astype(np.uint64)
+        # Spread the 21 bits of x so that there are two zeros between each
+        x = (x | (x << np.uint64(32))) & np.uint64(0x1f00000000ffff)
+        x = (x | (x << np.uint64(16))) & np.uint64(0x1f0000ff0000ff)
+        x = (x | (x << np.uint64(8))) & np.uint64(0x100f00f00f00f00f)
+        x = (x | (x << np.uint64(4))) & np.uint64(0x10c30c30c30c30c3)
+        x = (x | (x << np.uint64(2))) & np.uint64(0x1249249249249249)
+        codes |= x << np.uint64(axis)
+    return codes
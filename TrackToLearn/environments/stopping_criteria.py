@@ -1,10 +1,20 @@
 from enum import Enum
+from functools import partial
 
 import numpy as np
-from dipy.io.stateful_tractogram import Space, StatefulTractogram, Tractogram
+import torch
 from scipy.ndimage import map_coordinates, spline_filter
 
+from TrackToLearn.datasets.cache import VolumeCache
+from TrackToLearn.datasets.utils import MRIDataVolume
+from TrackToLearn.environments.interpolation import (
+    torch_spline_interpolation)
+from TrackToLearn.environments.streamline_buffer import (
+    StreamlineView, TorchStreamlineView)
+from TrackToLearn.environments.utils import (
+    is_too_curvy, to_oracle_space, torch_to_oracle_space)
 from TrackToLearn.oracles.oracle import OracleSingleton
+from TrackToLearn.oracles.oracle_server import OracleClient
 
 
 class StoppingFlags(Enum):
@@ -35,6 +45,129 @@ def count_flags(flags, ref_flag):
     return is_flag_set(flags, ref_flag).sum()
 
 
+class LengthStoppingCriterion(object):
+    """
+    Defines if a streamline has reached the maximum number of steps.
+    """
+
+    def __init__(
+        self,
+        max_nb_steps: int,
+    ):
+        """
+        Parameters
+        ----------
+        max_nb_steps : int
+            Maximum number of steps a streamline can have.
+        """
+        self.max_nb_steps = max_nb_steps
+
+    def __call__(
+        self,
+        streamlines: StreamlineView,
+    ):
+        """ Checks which streamlines have exceeded the maximum number of
+        steps.
+
+        Parameters
+        ----------
+        streamlines : `StreamlineView`
+            Streamlines in voxel space.
+
+        Returns
+        -------
+        too_long : 1D boolean `numpy.ndarray` of shape (n_streamlines,)
+            Array telling whether a streamline is too long or not.
+        """
+        return streamlines.lengths >= self.max_nb_steps
+
+
+class CurvatureStoppingCriterion(object):
+    """
+    Defines if the angle between the last two segments of a streamline is
+    too high.
+    """
+
+    def __init__(
+        self,
+        max_theta: float,
+    ):
+        """
+        Parameters
+        ----------
+        max_theta : float
+            Maximum angle in degrees that two consecutive segments can have
+            between each other.
+        """
+        self.max_theta = max_theta
+
+    def __call__(
+        self,
+        streamlines: StreamlineView,
+    ):
+        """ Checks which streamlines have exceeded the maximum angle between
+        their last two segments.
+
+        Parameters
+        ----------
+        streamlines : `StreamlineView`
+            Streamlines in voxel space.
+
+        Returns
+        -------
+        too_curvy : 1D boolean `numpy.ndarray` of shape (n_streamlines,)
+            Array telling whether a streamline is too curvy or not.
+        """
+        too_curvy = np.zeros(len(streamlines), dtype=bool)
+        # Not enough segments to compute curvature
+        long_enough = streamlines.lengths >= 3
+        if np.any(long_enough):
+            too_curvy[long_enough] = is_too_curvy(
+                streamlines[long_enough].tail(3), self.max_theta)
+        return too_curvy
+
+
+class TorchCurvatureStoppingCriterion(CurvatureStoppingCriterion):
+    """
+    Same as `CurvatureStoppingCriterion`, for streamlines on a torch device.
+    """
+
+    def __call__(
+        self,
+        streamlines: TorchStreamlineView,
+    ):
+        """ Checks which streamlines have exceeded the maximum angle between
+        their last two segments.
+
+        Parameters
+        ----------
+        streamlines : `TorchStreamlineView`
+            Streamlines in voxel space.
+
+        Returns
+        -------
+        too_curvy : 1D boolean `torch.Tensor` of shape (n_streamlines,)
+            Tensor telling whether a streamline is too curvy or not.
+        """
+        # Streamlines with fewer than three points are padded with their
+        # first point, so their angle is NaN and never too high.
+        tail = streamlines.tail(3)
+        u = tail[:, -1] - tail[:, -2]
+        v = tail[:, -2] - tail[:, -3]
+        u = u / torch.linalg.norm(u, dim=-1, keepdim=True)
+        v = v / torch.linalg.norm(v, dim=-1, keepdim=True)
+
+        angles = torch.arccos(torch.sum(u * v, dim=-1))
+        return angles > np.deg2rad(self.max_theta)
+
+
+def _spline_coefficients(mask: np.ndarray) -> np.ndarray:
+    """ Order 3 spline coefficients of a mask, to be interpolated with
+    `map_coordinates(..., prefilter=False)`.
+    """
+    return spline_filter(np.ascontiguousarray(mask, dtype=float), order=3)
+
+
 class BinaryStoppingCriterion(object):
     """
     Defines if a streamline is outside a mask using NN interp.
@@ -44,6 +177,9 @@ class BinaryStoppingCriterion(object):
         self,
         mask: np.ndarray,
         threshold: float = 0.5,
+        cache: VolumeCache = None,
+        origin: np.ndarray = None,
+        grid_shape: tuple = None,
     ):
         """
         Parameters
@@ -54,101 +190,275 @@ class BinaryStoppingCriterion(object):
         threshold : float
             Voxels with a value higher or equal than this threshold are
             considered as part of the interior of the mask.
+        cache : VolumeCache
+            If set, the spline coefficients of the mask are loaded from (or
+            stored in) this cache.
+        origin : `numpy.ndarray` of shape (3,)
+            If the mask is cropped from the grid of the subject, voxel of
+            the subject at which it starts. See `MRIDataVolume.crop`.
+        grid_shape : tuple
+            Shape of the grid of the subject, if the mask is cropped. The
+            spline coefficients are computed over the whole grid, where the
+            mask is zero outside of the box, so that they do not depend on
+            the crop.
         """
-        self.mask = spline_filter(
-            np.ascontiguousarray(mask, dtype=float), order=3)
+        origin = np.zeros(3, dtype=int) if origin is None else origin
+
+        def prefilter(mask):
+            box = tuple(slice(o, o + n) for o, n in zip(origin, mask.shape))
+            if grid_shape is not None:
+                full_mask = np.zeros(grid_shape, dtype=mask.dtype)
+                full_mask[box] = mask
+                mask = full_mask
+            compute = partial(_spline_coefficients, mask)
+            if cache is None:
+                coefficients = compute()
+            else:
+                coefficients = cache.get(cache.key(mask, 'spline', 3), compute)
+            if grid_shape is not None:
+                coefficients = np.array(coefficients[box])
+            return coefficients
+
+        # The mask is only prefiltered when first needed
+        self._mask = MRIDataVolume(mask).derive(prefilter)
         self.threshold = threshold
+        self.origin = np.asarray(origin, dtype=np.float32)
+
+    @property
+    def mask(self):
+        return self._mask.data
 
     def __call__(
         self,
-        streamlines: np.ndarray,
+        streamlines: StreamlineView,
     ):
         """ Checks which streamlines have their last coordinates outside a
         mask.
 
         Parameters
         ----------
-        streamlines : `numpy.ndarray` of shape (n_streamlines, n_points, 3)
-            Streamline coordinates in voxel space
+        streamlines : `StreamlineView`
+            Streamlines in voxel space.
         Returns
         -------
         outside : 1D boolean `numpy.ndarray` of shape (n_streamlines,)
             Array telling whether a streamline's last coordinate is outside the
             mask or not.
         """
-        coords = streamlines[:, -1, :].T - 0.5
+        coords = (streamlines.last_points() - self.origin).T - 0.5
         return map_coordinates(
             self.mask, coords, prefilter=False
         ) < self.threshold
 
 
+class TorchBinaryStoppingCriterion(BinaryStoppingCriterion):
+    """
+    Same as `BinaryStoppingCriterion`, for streamlines on a torch device.
+    The spline coefficients of the mask are kept on the device.
+    """
+
+    def __init__(
+        self,
+        mask: np.ndarray,
+        threshold: float = 0.5,
+        device: torch.device = 'cpu',
+        cache: VolumeCache = None,
+        origin: np.ndarray = None,
+        grid_shape: tuple = None,
+    ):
+        """
+        Parameters
+        ----------
+        mask : 3D `numpy.ndarray`
+            3D image defining a stopping mask. The interior of the mask is
+            defined by values higher or equal than `threshold` .
+        threshold : float
+            Voxels with a value higher or equal than this threshold are
+            considered as part of the interior of the mask.
+        device : torch.device
+            Device on which the streamlines are.
+        cache : VolumeCache
+            See `BinaryStoppingCriterion`.
+        origin : `numpy.ndarray` of shape (3,)
+            See `BinaryStoppingCriterion`.
+        grid_shape : tuple
+            See `BinaryStoppingCriterion`.
+        """
+        super().__init__(mask, threshold, cache, origin, grid_shape)
+        self._mask = self._mask.derive(partial(
+            torch.as_tensor, dtype=torch.float32, device=device))
+        self.origin = torch.as_tensor(self.origin, device=device)
+
+    def __call__(
+        self,
+        streamlines: TorchStreamlineView,
+    ):
+        """ Checks which streamlines have their last coordinates outside a
+        mask.
+
+        Parameters
+        ----------
+        streamlines : `TorchStreamlineView`
+            Streamlines in voxel space.
+        Returns
+        -------
+        outside : 1D boolean `torch.Tensor` of shape (n_streamlines,)
+            Tensor telling whether a streamline's last coordinate is outside
+            the mask or not.
+        """
+        coords = streamlines.last_points() - self.origin - 0.5
+        return torch_spline_interpolation(
+            self.mask, coords) < self.threshold
+
+
 class OracleStoppingCriterion(object):
     """
     Defines if a streamline should stop according to the oracle.
 
+    Scoring every live streamline at every step multiplies the cost of the
+    oracle by the length of the episodes. Instead, a streamline is scored
+    once it is long enough, then again every time it has grown by
+    `cadence` points, and its last score is kept per row of the streamline
+    buffer in between. Streamlines tracked together are scored on the same
+    steps, which keeps the batches of the oracle large. The scores of rows
+    in which new streamlines are started must be cleared with `reset`.
+
+    Works on both `StreamlineView` and `TorchStreamlineView`. Streamlines
+    of a `TorchStreamlineView` are resampled on the device of the oracle
+    straight from the buffer, see `OracleSingleton.predict_padded`.
     """
 
     def __init__(
         self,
         checkpoint: str,
         min_nb_steps: int,
-        reference: str,
-        affine_vox2rasmm: np.ndarray,
-        device: str
+        affine_vox2oracle: np.ndarray,
+        device: str,
+        cadence: int = 1,
+        inference: str = 'fp32',
+        server: str = None,
     ):
+        """
+        Parameters
+        ----------
+        checkpoint: str
+            Checkpoint of the oracle.
+        min_nb_steps: int
+            Minimum number of points of a streamline before it is scored.
+        affine_vox2oracle: `numpy.ndarray` of shape (4, 4)
+            Affine from the voxel space of the streamlines to the
+            voxel-corner space of the reference anatomy.
+        device: str
+            Device of the oracle.
+        cadence: int
+            Number of points a streamline grows by between two scores.
+        inference: str
+            Precision of the oracle, see `OracleSingleton`.
+        server: str
+            Address of an `OracleServer` to score streamlines with instead
+            of loading the oracle.
+        """
 
         self.name = 'oracle_reward'
 
         if checkpoint:
             self.checkpoint = checkpoint
-            self.model = OracleSingleton(checkpoint, device)
+            if server:
+                self.model = OracleClient(server)
+            else:
+                self.model = OracleSingleton(
+                    checkpoint, device, inference=inference)
         else:
             self.checkpoint = None
 
-        self.affine_vox2rasmm = affine_vox2rasmm
-        self.reference = reference
+        self.affine_vox2oracle = affine_vox2oracle
         self.min_nb_steps = min_nb_steps
         self.device = device
+        self.cadence = cadence
+
+        # Last score of each row of the buffer and number of points of the
+        # streamline when it was scored, grown as rows are seen
+        self.scores = np.ones(0, dtype=np.float32)
+        self.scored_lengths = np.zeros(0, dtype=int)
+        # Number of streamlines scored by the oracle, for statistics
+        self.n_scored = 0
+
+    def reset(self, rows=None):
+        """ Forget the scores of the streamlines of some rows of the
+        buffer, e.g. when new streamlines are started in them.
+
+        Parameters
+        ----------
+        rows : `numpy.ndarray` or `torch.Tensor` of int
+            Rows to clear. Every row is cleared if not set.
+        """
+        if rows is None:
+            self.scores = np.ones(0, dtype=np.float32)
+            self.scored_lengths = np.zeros(0, dtype=int)
+            return
+
+        if torch.is_tensor(rows):
+            rows = rows.cpu().numpy()
+        rows = rows[rows < len(self.scores)]
+        self.scores[rows] = 1.
+        self.scored_lengths[rows] = 0
 
     def __call__(
         self,
-        streamlines: np.ndarray,
+        streamlines: StreamlineView,
     ):
         """
         Parameters
         ----------
-        streamlines : `numpy.ndarray` of shape (n_streamlines, n_points, 3)
-            Streamline coordinates in voxel space
+        streamlines : `StreamlineView` or `TorchStreamlineView`
+            Streamlines in voxel space.
 
         Returns
         -------
-        dones: 1D boolean `numpy.ndarray` of shape (n_streamlines,)
-            Array indicating if streamlines are done.
+        dones: 1D boolean `numpy.ndarray` or `torch.Tensor` of shape
+        (n_streamlines,)
+            Array indicating if streamlines are done, a tensor on the
+            device of the streamlines for a `TorchStreamlineView`.
         """
         if not self.checkpoint:
             return None
 
-        # Resample streamlines to a fixed number of points. This should be
-        # set by the model ? TODO?
-        N, L, P = streamlines.shape
-        if L > self.min_nb_steps:
-
-            tractogram = Tractogram(
-                streamlines=streamlines.copy())
+        lengths, rows = streamlines.lengths, streamlines.idx
+        on_device = torch.is_tensor(lengths)
+        if on_device:
+            device = lengths.device
+            lengths, rows = lengths.cpu().numpy(), rows.cpu().numpy()
 
-            tractogram.apply_affine(self.affine_vox2rasmm)
+        if len(rows) > 0 and rows.max() >= len(self.scores):
+            n_rows = rows.max() + 1
+            self.scores = np.concatenate(
+                (self.scores, np.ones(n_rows - len(self.scores),
+                                      dtype=np.float32)))
+            self.scored_lengths = np.concatenate(
+                (self.scored_lengths,
+                 np.zeros(n_rows - len(self.scored_lengths), dtype=int)))
 
-            sft = StatefulTractogram(
-                streamlines=tractogram.streamlines,
-                reference=self.reference,
-                space=Space.RASMM)
+        # Only streamlines long enough are judged by the oracle, and only
+        # if they grew enough since their last score.
+        to_score = np.logical_and(
+            lengths > self.min_nb_steps,
+            lengths - self.scored_lengths[rows] >= self.cadence)
+        if np.any(to_score):
 
-            sft.to_vox()
-            sft.to_corner()
-            predictions = self.model.predict(sft.streamlines)
+            if on_device:
+                predictions = self.model.predict_padded(
+                    *torch_to_oracle_space(
+                        streamlines[torch.as_tensor(to_score, device=device)],
+                        self.affine_vox2oracle))
+            else:
+                predictions = self.model.predict(to_oracle_space(
+                    streamlines[to_score], self.affine_vox2oracle))
 
-            scores = np.zeros_like(predictions)
-            scores[predictions < 0.5] = 1
-            return scores.astype(bool)
+            self.scores[rows[to_score]] = predictions
+            self.scored_lengths[rows[to_score]] = lengths[to_score]
+            self.n_scored += len(predictions)
 
-        return np.array([False] * N)
+        dones = self.scores[rows] < 0.5
+        if on_device:
+            return torch.as_tensor(dones, device=device)
+        return dones
@@ -0,0 +1,385 @@
+import numpy as np
+import torch
+
+from nibabel.streamlines import ArraySequence
+
+
+class StreamlineBuffer(object):
+    """ Padded buffer holding the streamlines being tracked by an
+    environment, alongside the number of points of each streamline.
+
+    Stopping criteria, reward factors and the state computation rarely need
+    more than the last few points of each streamline. Indexing the buffer
+    (`buffer[idx]`) returns a `StreamlineView` which only gathers the points
+    a consumer asks for, instead of copying the whole history of every
+    streamline at every step.
+
+    The last `n_dirs` directions of each streamline are also kept in a ring
+    buffer which is updated as points are added, so that the previous
+    directions fed to the agent do not have to be recomputed from the
+    points at every step.
+    """
+
+    def __init__(
+        self,
+        n_streamlines: int,
+        max_nb_points: int,
+        n_dirs: int = 0,
+        dtype=np.float32,
+    ):
+        """
+        Parameters
+        ----------
+        n_streamlines: int
+            Number of streamlines (rows) in the buffer.
+        max_nb_points: int
+            Maximum number of points a streamline can have.
+        n_dirs: int
+            Number of previous directions to keep for each streamline.
+        dtype: np.dtype
+            Type of the coordinates.
+        """
+        self.data = np.zeros((n_streamlines, max_nb_points, 3), dtype=dtype)
+        self.lengths = np.zeros(n_streamlines, dtype=np.int32)
+        self.dirs = np.zeros((n_streamlines, n_dirs, 3), dtype=dtype)
+
+    @classmethod
+    def from_seeds(
+        cls,
+        seeds: np.ndarray,
+        max_nb_points: int,
+        n_dirs: int = 0,
+        dtype=np.float32,
+    ):
+        """ Initialize a buffer where each streamline is only its seed.
+
+        Parameters
+        ----------
+        seeds: `numpy.ndarray` of shape (n_streamlines, 3)
+            Seeds of the streamlines, in voxel space.
+        max_nb_points: int
+            Maximum number of points a streamline can have.
+        n_dirs: int
+            Number of previous directions to keep for each streamline.
+
+        Returns
+        -------
+        buffer: StreamlineBuffer
+            Buffer containing the seeds as first points.
+        """
+        buffer = cls(len(seeds), max_nb_points, n_dirs, dtype)
+        buffer.data[:, 0, :] = seeds
+        buffer.lengths[:] = 1
+        return buffer
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, idx):
+        return StreamlineView(self, np.asarray(idx))
+
+    def reset_rows(self, idx: np.ndarray, seeds: np.ndarray):
+        """ Restart the streamlines at `idx` from new seeds.
+
+        Parameters
+        ----------
+        idx: `numpy.ndarray` of int
+            Rows of the buffer to restart.
+        seeds: `numpy.ndarray` of shape (len(idx), 3)
+            New seeds, in voxel space.
+        """
+        self.data[idx, 0] = seeds
+        self.lengths[idx] = 1
+        self.dirs[idx] = 0
+
+    def append(self, idx: np.ndarray, points: np.ndarray):
+        """ Add a point at the end of the streamlines at `idx`.
+
+        Parameters
+        ----------
+        idx: `numpy.ndarray` of int
+            Rows of the buffer to grow.
+        points: `numpy.ndarray` of shape (len(idx), 3)
+            New last point of each streamline.
+        """
+        self.data[idx, self.lengths[idx]] = points
+        self.lengths[idx] += 1
+        self._update_last_dir(idx)
+
+    def replace_last(self, idx: np.ndarray, points: np.ndarray):
+        """ Overwrite the last point of the streamlines at `idx`.
+
+        Parameters
+        ----------
+        idx: `numpy.ndarray` of int
+            Rows of the buffer to modify.
+        points: `numpy.ndarray` of shape (len(idx), 3)
+            New last point of each streamline.
+        """
+        self.data[idx, self.lengths[idx] - 1] = points
+        self._update_last_dir(idx)
+
+    def _update_last_dir(self, idx: np.ndarray):
+        """ Store the last segment of the streamlines at `idx` in the ring
+        buffer of directions. The direction between points `i` and `i + 1`
+        goes in slot `i % n_dirs`.
+
+        Parameters
+        ----------
+        idx: `numpy.ndarray` of int
+            Rows of the buffer whose last point changed.
+        """
+        n_dirs = self.dirs.shape[1]
+        if n_dirs == 0:
+            return
+
+        lengths = self.lengths[idx]
+        self.dirs[idx, (lengths - 2) % n_dirs] = \
+            self.data[idx, lengths - 1] - self.data[idx, lengths - 2]
+
+
+class StreamlineView(object):
+    """ Subset of the streamlines of a `StreamlineBuffer`. The view does not
+    copy any coordinate until one of its accessors is called.
+    """
+
+    def __init__(self, buffer: StreamlineBuffer, idx: np.ndarray):
+        self.buffer = buffer
+        self.idx = idx
+
+    def __len__(self):
+        return len(self.idx)
+
+    def __getitem__(self, key):
+        return StreamlineView(self.buffer, self.idx[key])
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """ Number of points of each streamline in the view. """
+        return self.buffer.lengths[self.idx]
+
+    def last_points(self) -> np.ndarray:
+        """ Last point of each streamline.
+
+        Returns
+        -------
+        points: `numpy.ndarray` of shape (n_streamlines, 3)
+        """
+        return self.buffer.data[self.idx, self.lengths - 1]
+
+    def tail(self, k: int) -> np.ndarray:
+        """ Last `k` points of each streamline. Streamlines with fewer than
+        `k` points are padded at the front with their first point so that
+        missing segments have a length of zero.
+
+        Parameters
+        ----------
+        k: int
+            Number of points to fetch.
+
+        Returns
+        -------
+        points: `numpy.ndarray` of shape (n_streamlines, k, 3)
+        """
+        positions = self.lengths[:, None] - k + np.arange(k)[None, :]
+        np.clip(positions, 0, None, out=positions)
+        return self.buffer.data[self.idx[:, None], positions]
+
+    def previous_dirs(self) -> np.ndarray:
+        """ Last `n_dirs` directions of each streamline, the most recent
+        first. Directions before the seed are zero.
+
+        Returns
+        -------
+        dirs: `numpy.ndarray` of shape (n_streamlines, n_dirs, 3)
+        """
+        n_dirs = self.buffer.dirs.shape[1]
+        # Slots that were never written since the streamline started are
+        # zero, which takes care of the missing directions.
+        slots = (self.lengths[:, None] - 2 - np.arange(n_dirs)[None, :]) \
+            % n_dirs
+        return self.buffer.dirs[self.idx[:, None], slots]
+
+    def to_array_sequence(self, lengths: np.ndarray = None) -> ArraySequence:
+        """ Streamlines of the view as an `ArraySequence`, built with a
+        single gather of their points from the buffer.
+
+        Parameters
+        ----------
+        lengths: `numpy.ndarray` of int of shape (n_streamlines,)
+            Number of points to keep for each streamline, at most its own
+            length. Full streamlines are kept if not set.
+
+        Returns
+        -------
+        streamlines: ArraySequence
+            Copy of the (truncated) streamlines.
+        """
+        if lengths is None:
+            lengths = self.lengths
+        lengths = np.asarray(lengths, dtype=int)
+
+        # Index of every point to keep in the flattened buffer
+        max_nb_points = self.buffer.data.shape[1]
+        offsets = np.cumsum(lengths) - lengths
+        flat_idx = np.repeat(
+            self.idx.astype(np.int64) * max_nb_points - offsets, lengths) + \
+            np.arange(np.sum(lengths))
+
+        streamlines = ArraySequence()
+        streamlines._data = np.take(
+            self.buffer.data.reshape(-1, 3), flat_idx, axis=0)
+        streamlines._offsets = offsets
+        streamlines._lengths = lengths
+        return streamlines
+
+    def get(self) -> list:
+        """ Full streamlines, trimmed to their own length. The streamlines
+        are views into the buffer and are not copied.
+
+        Returns
+        -------
+        streamlines: list of `numpy.ndarray` of shape (n_points, 3)
+        """
+        return [self.buffer.data[i, :n]
+                for i, n in zip(self.idx, self.lengths)]
+
+
+class TorchStreamlineBuffer(StreamlineBuffer):
+    """ `StreamlineBuffer` whose coordinates and lengths are tensors living
+    on a torch device. Indexing it returns a `TorchStreamlineView`.
+    """
+
+    def __init__(
+        self,
+        n_streamlines: int,
+        max_nb_points: int,
+        n_dirs: int = 0,
+        dtype=torch.float32,
+        device: torch.device = 'cpu',
+    ):
+        """
+        Parameters
+        ----------
+        n_streamlines: int
+            Number of streamlines (rows) in the buffer.
+        max_nb_points: int
+            Maximum number of points a streamline can have.
+        n_dirs: int
+            Number of previous directions to keep for each streamline.
+        dtype: torch.dtype
+            Type of the coordinates.
+        device: torch.device
+            Device on which the buffer is allocated.
+        """
+        self.data = torch.zeros(
+            (n_streamlines, max_nb_points, 3), dtype=dtype, device=device)
+        self.lengths = torch.zeros(
+            n_streamlines, dtype=torch.long, device=device)
+        self.dirs = torch.zeros(
+            (n_streamlines, n_dirs, 3), dtype=dtype, device=device)
+
+    @classmethod
+    def from_seeds(
+        cls,
+        seeds: torch.Tensor,
+        max_nb_points: int,
+        n_dirs: int = 0,
+        dtype=torch.float32,
+    ):
+        """ Initialize a buffer where each streamline is only its seed. The
+        buffer is allocated on the same device as `seeds`.
+
+        Parameters
+        ----------
+        seeds: `torch.Tensor` of shape (n_streamlines, 3)
+            Seeds of the streamlines, in voxel space.
+        max_nb_points: int
+            Maximum number of points a streamline can have.
+        n_dirs: int
+            Number of previous directions to keep for each streamline.
+
+        Returns
+        -------
+        buffer: TorchStreamlineBuffer
+            Buffer containing the seeds as first points.
+        """
+        buffer = cls(len(seeds), max_nb_points, n_dirs, dtype, seeds.device)
+        buffer.data[:, 0, :] = seeds
+        buffer.lengths[:] = 1
+        return buffer
+
+    def __getitem__(self, idx):
+        return TorchStreamlineView(
+            self, torch.as_tensor(idx, device=self.lengths.device))
+
+
+class TorchStreamlineView(StreamlineView):
+    """ Subset of the streamlines of a `TorchStreamlineBuffer`. Accessors
+    return tensors on the device of the buffer, except for `get` which
+    copies the streamlines to the host.
+    """
+
+    def __getitem__(self, key):
+        return TorchStreamlineView(self.buffer, self.idx[key])
+
+    def tail(self, k: int) -> torch.Tensor:
+        """ See `StreamlineView.tail`.
+
+        Returns
+        -------
+        points: `torch.Tensor` of shape (n_streamlines, k, 3)
+        """
+        positions = self.lengths[:, None] - k + torch.arange(
+            k, device=self.idx.device)[None, :]
+        positions.clamp_(min=0)
+        return self.buffer.data[self.idx[:, None], positions]
+
+    def previous_dirs(self) -> torch.Tensor:
+        """ See `StreamlineView.previous_dirs`.
+
+        Returns
+        -------
+        dirs: `torch.Tensor` of shape (n_streamlines, n_dirs, 3)
+        """
+        n_dirs = self.buffer.dirs.shape[1]
+        slots = (self.lengths[:, None] - 2 - torch.arange(
+            n_dirs, device=self.idx.device)[None, :]) % n_dirs
+        return self.buffer.dirs[self.idx[:, None], slots]
+
+    def to_host(self) -> StreamlineView:
+        """ Copy the streamlines of the view to a NumPy `StreamlineBuffer`.
+        Only the points up to the longest streamline of the view are
+        transferred.
+
+        Returns
+        -------
+        view: StreamlineView
+            View over all the streamlines of the host buffer.
+        """
+        lengths = self.lengths
+        max_nb_points = int(lengths.max()) if len(self) > 0 else 0
+
+        data = self.buffer.data[self.idx, :max_nb_points].cpu().numpy()
+
+        buffer = StreamlineBuffer(
+            len(self), max_nb_points, dtype=data.dtype)
+        buffer.data[:] = data
+        buffer.lengths[:] = lengths.cpu().numpy()
+        return buffer[np.arange(len(self))]
+
+    def to_array_sequence(self, lengths: np.ndarray = None) -> ArraySequence:
+        """ See `StreamlineView.to_array_sequence`. The streamlines are
+        copied to the host.
+        """
+        return self.to_host().to_array_sequence(lengths)
+
+    def get(self) -> list:
+        """ Full streamlines, trimmed to their own length and copied to the
+        host.
+
+        Returns
+        -------
+        streamlines: list of `numpy.ndarray` of shape (n_points, 3)
+        """
+        return self.to_host().get()
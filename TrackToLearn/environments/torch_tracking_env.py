@@ -0,0 +1,343 @@
+import numpy as np
+import torch
+
+from functools import partial
+from typing import Callable, Dict, Tuple
+
+from nibabel.streamlines import Tractogram
+from scipy.ndimage import spline_filter
+
+from TrackToLearn.environments.interpolation import (
+    torch_spline_interpolation)
+from TrackToLearn.environments.local_reward import TorchPeaksAlignmentReward
+from TrackToLearn.environments.oracle_reward import OracleReward
+from TrackToLearn.environments.reward import TorchRewardFunction
+from TrackToLearn.environments.stopping_criteria import (
+    LengthStoppingCriterion, OracleStoppingCriterion, StoppingFlags,
+    TorchBinaryStoppingCriterion, TorchCurvatureStoppingCriterion)
+from TrackToLearn.environments.streamline_buffer import (
+    TorchStreamlineBuffer, TorchStreamlineView)
+from TrackToLearn.environments.tracking_env import TrackingEnvironment
+
+
+class HostWrapper(object):
+    """ Run a NumPy stopping criterion or reward factor on streamlines
+    living on a torch device. The streamlines are copied to the host and
+    the result is sent back to the device.
+
+    Used for the oracle, which resamples streamlines with dipy anyway.
+    """
+
+    def __init__(
+        self,
+        wrapped: Callable,
+        device: torch.device,
+    ):
+        """
+        Parameters
+        ----------
+        wrapped: Callable
+            Stopping criterion or reward factor taking a `StreamlineView`.
+        device: torch.device
+            Device on which to send the results.
+        """
+        self.wrapped = wrapped
+        self.name = getattr(wrapped, 'name', None)
+        self.device = device
+
+    def __call__(self, streamlines: TorchStreamlineView, *args):
+        args = [a.cpu().numpy() if torch.is_tensor(a) else a for a in args]
+        result = self.wrapped(streamlines.to_host(), *args)
+        return torch.as_tensor(result, device=self.device)
+
+    def reset(self):
+        self.wrapped.reset()
+
+
+class TorchTrackingEnvironment(TrackingEnvironment):
+    """ Tracking environment whose streamlines, previous directions,
+    stopping criteria and reward live as tensors on the device of the
+    agent. Actions are taken as tensors and states, rewards and dones are
+    returned as tensors, so tracking does not go back and forth between the
+    host and the device at every step. Streamlines are only copied to the
+    host when they are harvested with `get_streamlines`.
+
+    Gaussian noise can be added to the actions. It is drawn on the device,
+    so noisy streamlines differ from the ones of the environments on the
+    host. With an FA map, the noise is scaled by `1 - FA`, FA being
+    interpolated at the end of the streamlines. `NoisyTrackingEnvironment`
+    instead adds `(1 - FA) * noise` to the actions, without drawing any
+    noise, and reads FA at the voxel of the end of the streamlines.
+    """
+
+    def __init__(
+        self,
+        subject_data: str,
+        split_id: str,
+        env_dto: dict,
+    ):
+        """
+        Parameters
+        ----------
+        subject_data: str
+            Path to the dataset file or subject volumes.
+        split_id: str
+            Split id
+        env_dto: dict
+            Dict containing all arguments
+        """
+
+        super().__init__(subject_data, split_id, env_dto)
+
+        self.noise = env_dto['noise']
+        # The FA map is only prefiltered if noise is added
+        self.fa_map = None
+        if env_dto['fa_map']:
+            # Prefiltered before being cropped like the other volumes
+            self.fa_map = env_dto['fa_map'].derive(
+                partial(spline_filter, order=3))
+            if self.crop_margin is not None:
+                self.fa_map = self.fa_map.crop(self.volume_bbox)
+            self.fa_map = self.fa_map.derive(partial(
+                torch.as_tensor, dtype=torch.float32, device=self.device))
+
+        self.generator = torch.Generator(device=self.device)
+        self.generator.manual_seed(int(self.rng.randint(2 ** 31)))
+
+    def reseed(self, seed: int):
+        """ See `BaseEnv.reseed`. The noise generator is reseeded as well.
+        """
+
+        super().reseed(seed)
+        self.generator.manual_seed(int(self.rng.randint(2 ** 31)))
+
+    def _get_stopping_criteria(
+        self,
+        mask_data: np.ndarray,
+    ) -> Dict[StoppingFlags, Callable]:
+        """ See `BaseEnv._get_stopping_criteria`. """
+
+        stopping_criteria = {}
+
+        # Length criterion
+        stopping_criteria[StoppingFlags.STOPPING_LENGTH] = \
+            LengthStoppingCriterion(self.max_nb_steps)
+
+        # Angle between segment (curvature criterion)
+        stopping_criteria[StoppingFlags.STOPPING_CURVATURE] = \
+            TorchCurvatureStoppingCriterion(self.theta)
+
+        # Stopping criterion according to an oracle
+        if self.oracle_checkpoint and self.oracle_stopping_criterion:
+            # Scores streamlines straight from the buffer, on the device
+            stopping_criteria[StoppingFlags.STOPPING_ORACLE] = \
+                OracleStoppingCriterion(
+                    self.oracle_checkpoint,
+                    self.min_nb_steps * 5,
+                    self.affine_vox2oracle,
+                    self.device,
+                    self.oracle_cadence,
+                    self.oracle_inference,
+                    self.oracle_server)
+
+        # Mask criterion
+        stopping_criteria[StoppingFlags.STOPPING_MASK] = \
+            TorchBinaryStoppingCriterion(
+                mask_data,
+                self.binary_stopping_threshold,
+                self.device,
+                self.cache,
+                self.volume_origin,
+                self.grid_shape)
+
+        return stopping_criteria
+
+    def _get_reward_function(self) -> TorchRewardFunction:
+        """ See `BaseEnv._get_reward_function`. """
+
+        peaks_reward = TorchPeaksAlignmentReward(self.peaks, self.device)
+        oracle_reward = HostWrapper(
+            OracleReward(self.oracle_checkpoint,
+                         self.min_nb_steps,
+                         self.affine_vox2oracle,
+                         self.device,
+                         self.oracle_inference,
+                         self.oracle_server),
+            self.device)
+
+        return TorchRewardFunction(
+            [peaks_reward,
+             oracle_reward],
+            [self.alignment_weighting,
+             self.oracle_bonus],
+            self.device)
+
+    def _start_streamlines(self) -> torch.Tensor:
+        """ See `TrackingEnvironment._start_streamlines`. """
+
+        self.initial_points = torch.as_tensor(
+            self.initial_points, dtype=torch.float32, device=self.device)
+        N = self.initial_points.shape[0]
+
+        self.streamlines = TorchStreamlineBuffer.from_seeds(
+            self.initial_points, self.max_nb_steps + 1, self.n_dirs)
+        self.flags = torch.zeros(N, dtype=torch.long, device=self.device)
+
+        # Initialize rewards and done flags
+        self.dones = torch.zeros(N, dtype=torch.bool, device=self.device)
+        self.continue_idx = torch.arange(N, device=self.device)
+
+        self.state = self._allocate_state(N)
+        self._format_state(self.streamlines[self.continue_idx])
+
+        return self.state[self.continue_idx]
+
+    def _format_actions(
+        self,
+        actions: torch.Tensor,
+    ) -> torch.Tensor:
+        """ See `BaseEnv._format_actions`. """
+
+        norm = torch.linalg.norm(actions, dim=-1, keepdim=True)
+        return (actions / norm) * self.step_size
+
+    def _compute_stopping_flags(
+        self,
+        streamlines: TorchStreamlineView,
+        stopping_criteria: Dict[StoppingFlags, Callable]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """ See `BaseEnv._compute_stopping_flags`. """
+
+        N = len(streamlines)
+
+        should_stop = torch.zeros(N, dtype=torch.bool, device=self.device)
+        flags = torch.zeros(N, dtype=torch.long, device=self.device)
+
+        for flag, stopping_criterion in stopping_criteria.items():
+            stopped_by_criterion = stopping_criterion(streamlines)
+            flags[stopped_by_criterion] |= flag.value
+            should_stop |= stopped_by_criterion
+
+        return should_stop, flags
+
+    def step(
+        self,
+        actions: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, dict]:
+        """ See `TrackingEnvironment.step`. Actions may be a tensor on any
+        device or a `numpy.ndarray`.
+        """
+
+        actions = torch.as_tensor(
+            actions, dtype=torch.float32, device=self.device)
+
+        if self.noise > 0.:
+            noise = torch.randn(
+                actions.shape, generator=self.generator,
+                device=self.device) * self.noise
+            # Scale the noise down where FA is high
+            if self.fa_map is not None:
+                fa = torch_spline_interpolation(
+                    self.fa_map.data,
+                    self.streamlines[self.continue_idx].last_points() -
+                    self.signal_origin - 0.5)
+                noise *= (1. - fa)[:, None]
+            actions = actions + noise
+
+        directions = self._format_actions(actions)
+
+        # Grow streamlines one step forward
+        last_points = self.streamlines[self.continue_idx].last_points()
+        first_step = self.streamlines.lengths[self.continue_idx] == 1
+        self.streamlines.append(
+            self.continue_idx, last_points + directions)
+
+        # If the streamline goes out the tracking mask at the first
+        # step, flip it
+        first_idx = self.continue_idx[first_step]
+        if len(first_idx) > 0:
+
+            # Get stopping and keeping indexes
+            stopping, flags = \
+                self._is_stopping(self.streamlines[first_idx])
+
+            # Flip stopping trajectories
+            flipped = torch.nonzero(first_step).squeeze(1)[stopping]
+            directions[flipped] *= -1
+            self.streamlines.replace_last(
+                first_idx[stopping],
+                last_points[flipped] + directions[flipped])
+
+        # Get stopping and keeping indexes.
+        stopping, new_flags = \
+            self._is_stopping(
+                self.streamlines[self.continue_idx])
+
+        self.not_stopping = ~stopping
+        self.new_continue_idx, self.stopping_idx = \
+            (self.continue_idx[~stopping],
+             self.continue_idx[stopping])
+
+        # Keep the reason why tracking stopped
+        self.flags[self.stopping_idx] = new_flags[stopping]
+
+        # Keep which trajectory is over
+        self.dones[self.stopping_idx] = True
+
+        reward = torch.zeros(len(self.streamlines), device=self.device)
+        reward_info = {}
+        # Compute reward if wanted. At valid time, no need
+        # to compute it and slow down the tracking process
+        if self.compute_reward:
+            reward, reward_info = self.reward_function(
+                self.streamlines[self.continue_idx],
+                self.dones[self.continue_idx])
+
+        # Compute the state
+        self._format_state(self.streamlines[self.continue_idx])
+
+        return (
+            self.state[self.continue_idx],
+            reward, self.dones[self.continue_idx],
+            {'continue_idx': self.continue_idx,
+             'reward_info': reward_info})
+
+    def refill(
+        self,
+    ) -> Tuple[Tractogram, torch.Tensor]:
+        """ See `TrackingEnvironment.refill`. """
+
+        stopped_idx = self.stopping_idx
+        tractogram = self.get_streamlines(stopped_idx)
+
+        n_new = min(len(stopped_idx), self.last_seed - self.next_seed)
+        if n_new > 0:
+            slots = stopped_idx[:n_new]
+            seeds = torch.as_tensor(
+                self.seeds[self.next_seed:self.next_seed + n_new],
+                dtype=torch.float32, device=self.device)
+            self.next_seed += n_new
+
+            self.initial_points[slots] = seeds
+            self.streamlines.reset_rows(slots, seeds)
+            self._reset_stopping_criteria(slots)
+            self.flags[slots] = 0
+            self.dones[slots] = False
+
+            self.continue_idx, _ = torch.sort(
+                torch.cat((self.continue_idx, slots)))
+            self._format_state(self.streamlines[slots])
+
+        return tractogram, self.state[self.continue_idx]
+
+    def get_streamlines(self, idx: torch.Tensor = None) -> Tractogram:
+        """ See `TrackingEnvironment.get_streamlines`. The streamlines are
+        copied to the host.
+        """
+        if idx is None:
+            idx = torch.arange(len(self.streamlines), device=self.device)
+
+        return self._build_tractogram(
+            self.streamlines[idx].to_host(),
+            self.flags[idx].cpu().numpy(),
+            self.initial_points[idx].cpu().numpy())
@@ -8,6 +8,8 @@ from nibabel.streamlines import Tractogram
 from TrackToLearn.environments.env import BaseEnv
 from TrackToLearn.environments.stopping_criteria import (
     is_flag_set, StoppingFlags)
+from TrackToLearn.environments.streamline_buffer import (
+    StreamlineBuffer, StreamlineView)
 
 
 class TrackingEnvironment(BaseEnv):
@@ -21,14 +23,14 @@ class TrackingEnvironment(BaseEnv):
 
     def _is_stopping(
         self,
-        streamlines: np.ndarray
+        streamlines: StreamlineView
     ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
         """ Check which streamlines should stop or not according to the
         predefined stopping criteria
 
         Parameters
         ----------
-        streamlines : `numpy.ndarray` of shape (n_streamlines, n_points, 3)
+        streamlines : `StreamlineView`
             Streamlines that will be checked
 
         Returns
@@ -63,30 +65,21 @@ class TrackingEnvironment(BaseEnv):
 
         super().reset()
 
+        # Random seeds are spread over every block of the seed source,
+        # which would be generated again at each episode. The seeds are
+        # generated once instead, the first time they are sampled.
+        source, all_seeds = getattr(self, '_sampled_seeds', (None, None))
+        if source is not self.seeds:
+            all_seeds = self.seeds[:]
+            self._sampled_seeds = (self.seeds, all_seeds)
+
         # Heuristic to avoid duplicating seeds if fewer seeds than actors.
-        replace = n_seeds > len(self.seeds)
+        replace = n_seeds > len(all_seeds)
         seeds = np.random.choice(
-            np.arange(len(self.seeds)), size=n_seeds, replace=replace)
-        self.initial_points = self.seeds[seeds]
-
-        self.streamlines = np.zeros(
-            (n_seeds, self.max_nb_steps + 1, 3), dtype=np.float32)
-        self.streamlines[:, 0, :] = self.initial_points
-
-        self.flags = np.zeros(n_seeds, dtype=int)
-
-        self.lengths = np.ones(n_seeds, dtype=np.int32)
-
-        self.length = 1
+            np.arange(len(all_seeds)), size=n_seeds, replace=replace)
+        self.initial_points = all_seeds[seeds]
 
-        # Initialize rewards and done flags
-        self.dones = np.full(n_seeds, False)
-        self.continue_idx = np.arange(n_seeds)
-        self.state = self._format_state(
-            self.streamlines[self.continue_idx, :self.length])
-
-        # Setup input signal
-        return self.state[self.continue_idx]
+        return self._start_streamlines()
 
     def reset(self, start: int, end: int) -> np.ndarray:
         """ Initialize tracking seeds and streamlines. Will select
@@ -111,23 +104,30 @@ class TrackingEnvironment(BaseEnv):
 
         # Initialize seeds as streamlines
         self.initial_points = self.seeds[start:end]
+
+        return self._start_streamlines()
+
+    def _start_streamlines(self) -> np.ndarray:
+        """ Start tracking a streamline from each of `self.initial_points`.
+
+        Returns
+        -------
+        state: numpy.ndarray
+            Initial state for RL model
+        """
+
         N = self.initial_points.shape[0]
 
-        self.streamlines = np.zeros(
-            (N, self.max_nb_steps + 1, 3),
-            dtype=np.float32)
-        self.streamlines[:, 0, :] = self.initial_points
+        self.streamlines = StreamlineBuffer.from_seeds(
+            self.initial_points, self.max_nb_steps + 1, self.n_dirs)
         self.flags = np.zeros(N, dtype=int)
 
-        self.lengths = np.ones(N, dtype=np.int32)
-        self.length = 1
-
         # Initialize rewards and done flags
         self.dones = np.full(N, False)
         self.continue_idx = np.arange(N)
 
-        self.state = self._format_state(
-            self.streamlines[self.continue_idx, :self.length])
+        self.state = self._allocate_state(N)
+        self._format_state(self.streamlines[self.continue_idx])
 
         # Setup input signal
         return self.state[self.continue_idx]
@@ -160,32 +160,32 @@ class TrackingEnvironment(BaseEnv):
 
         directions = self._format_actions(actions)
 
+        # Grow streamlines one step forward
+        last_points = self.streamlines[self.continue_idx].last_points()
+        first_step = self.streamlines.lengths[self.continue_idx] == 1
+        self.streamlines.append(
+            self.continue_idx, last_points + directions)
+
         # If the streamline goes out the tracking mask at the first
         # step, flip it
-        if self.length == 1:
-            # Grow streamlines one step forward
-            streamlines = np.array(self.streamlines[self.continue_idx])
-            streamlines[:, self.length, :] = \
-                self.streamlines[self.continue_idx,
-                                 self.length-1, :] + directions
+        if np.any(first_step):
+            first_idx = self.continue_idx[first_step]
 
             # Get stopping and keeping indexes
             stopping, flags = \
-                self._is_stopping(
-                    streamlines[:, :self.length + 1])
+                self._is_stopping(self.streamlines[first_idx])
 
             # Flip stopping trajectories
-            directions[stopping] *= -1
-
-        # Grow streamlines one step forward
-        self.streamlines[self.continue_idx, self.length, :] = \
-            self.streamlines[self.continue_idx, self.length-1, :] + directions
-        self.length += 1
+            flipped = np.flatnonzero(first_step)[stopping]
+            directions[flipped] *= -1
+            self.streamlines.replace_last(
+                first_idx[stopping],
+                last_points[flipped] + directions[flipped])
 
         # Get stopping and keeping indexes.
         stopping, new_flags = \
             self._is_stopping(
-                self.streamlines[self.continue_idx, :self.length])
+                self.streamlines[self.continue_idx])
 
         # See which trajectory is stopping or continuing.
         # TODO: `investigate the use of `not_stopping`.
@@ -201,18 +201,17 @@ class TrackingEnvironment(BaseEnv):
         # Keep which trajectory is over
         self.dones[self.stopping_idx] = 1
 
-        reward = np.zeros(self.streamlines.shape[0])
+        reward = np.zeros(len(self.streamlines))
         reward_info = {}
         # Compute reward if wanted. At valid time, no need
         # to compute it and slow down the tracking process
         if self.compute_reward:
             reward, reward_info = self.reward_function(
-                self.streamlines[self.continue_idx, :self.length],
+                self.streamlines[self.continue_idx],
                 self.dones[self.continue_idx])
 
         # Compute the state
-        self.state[self.continue_idx] = self._format_state(
-            self.streamlines[self.continue_idx, :self.length])
+        self._format_state(self.streamlines[self.continue_idx])
 
         return (
             self.state[self.continue_idx],
@@ -234,8 +233,6 @@ class TrackingEnvironment(BaseEnv):
             Indexes of trajectories that did not stop.
         """
 
-        # Register the length of the streamlines that have stopped.
-        self.lengths[self.stopping_idx] = self.length
         # Set new "continue idx" based on the old idxes. This is to keep
         # the idxes "global".
         self.continue_idx = self.new_continue_idx
@@ -244,13 +241,90 @@ class TrackingEnvironment(BaseEnv):
         # TODO: investigate why `not_stopping` is returned.
         return self.state[self.continue_idx], self.not_stopping
 
-    def get_streamlines(self):
+    def continuous_reset(
+        self,
+        start: int,
+        end: int,
+        n_actor: int,
+    ) -> np.ndarray:
+        """ Initialize tracking for continuous batching. Seeds from `start`
+        to `end` form a pool; the first `n_actor` are tracked right away and
+        the others are used by `refill` to replace streamlines as they stop,
+        so the batch stays full until the pool is exhausted.
+
+        Parameters
+        ----------
+        start: int
+            Index of the first seed of the pool.
+        end: int
+            Index after the last seed of the pool.
+        n_actor: int
+            Number of streamlines to track at once.
+
+        Returns
+        -------
+        state: numpy.ndarray
+            Initial state for RL model
+        """
+
+        super().reset()
+
+        N = min(n_actor, end - start)
+        # Seeds of each slot will be replaced, so do not keep a view on the
+        # environment's seeds.
+        self.initial_points = np.array(self.seeds[start:start + N])
+        self.next_seed = start + N
+        self.last_seed = end
+
+        return self._start_streamlines()
+
+    def refill(
+        self,
+    ) -> Tuple[Tractogram, np.ndarray]:
+        """ Collect the streamlines that stopped at the last step and start
+        tracking the next seeds of the pool in their slots. Should be called
+        after `harvest` when tracking was started with `continuous_reset`.
+
+        Returns
+        -------
+        tractogram: Tractogram
+            Streamlines that stopped at the last step, in voxel space.
+        state: np.ndarray
+            States of the streamlines still being tracked, including the new
+            ones.
+        """
+
+        stopped_idx = self.stopping_idx
+        tractogram = self.get_streamlines(stopped_idx)
+
+        n_new = min(len(stopped_idx), self.last_seed - self.next_seed)
+        if n_new > 0:
+            slots = stopped_idx[:n_new]
+            seeds = self.seeds[self.next_seed:self.next_seed + n_new]
+            self.next_seed += n_new
+
+            self.initial_points[slots] = seeds
+            self.streamlines.reset_rows(slots, seeds)
+            self._reset_stopping_criteria(slots)
+            self.flags[slots] = 0
+            self.dones[slots] = False
+
+            self.continue_idx = np.sort(
+                np.concatenate((self.continue_idx, slots)))
+            self._format_state(self.streamlines[slots])
+
+        return tractogram, self.state[self.continue_idx]
+
+    def get_streamlines(self, idx: np.ndarray = None):
         """ Obtain tracked streamlines from the environment.
         The last point will be removed if it raised a curvature or mask
         stopping criterion.
 
         Parameters
         ----------
+        idx: np.ndarray, optional
+            Indexes of the streamlines to obtain. All streamlines
+            are returned if not set.
 
         Returns
         -------
@@ -258,20 +332,45 @@ class TrackingEnvironment(BaseEnv):
             Tracked streamlines in voxel space.
 
         """
-        # Harvest stopped streamlines and associated data
-        # stopped_seeds = self.first_points[self.stopping_idx]
-        stopped_streamlines = [self.streamlines[i, :self.lengths[i], :]
-                               for i in range(len(self.streamlines))]
+        if idx is None:
+            idx = np.arange(len(self.streamlines))
+
+        return self._build_tractogram(
+            self.streamlines[idx], self.flags[idx], self.initial_points[idx])
+
+    def _build_tractogram(
+        self,
+        streamlines: StreamlineView,
+        stopped_flags: np.ndarray,
+        stopped_seeds: np.ndarray,
+    ) -> Tractogram:
+        """ Build a tractogram from stopped streamlines, removing their last
+        point if it raised a curvature or mask stopping criterion.
+
+        Parameters
+        ----------
+        streamlines: StreamlineView
+            Stopped streamlines, in voxel space.
+        stopped_flags: np.ndarray
+            Stopping flags of each streamline.
+        stopped_seeds: np.ndarray
+            Seed of each streamline.
+
+        Returns
+        -------
+        tractogram: Tractogram
+            Tracked streamlines in voxel space.
+        """
 
         # If the last point triggered a stopping criterion based on
         # angle, remove it so as not to produce ugly kinked streamlines.
         curvature_flags = is_flag_set(
-            self.flags, StoppingFlags.STOPPING_CURVATURE)
+            stopped_flags, StoppingFlags.STOPPING_CURVATURE)
 
         # Reduce overreach by removing the last point if it triggered
         # a mask-based stopping criterion.
         mask_flags = is_flag_set(
-            self.flags, StoppingFlags.STOPPING_MASK)
+            stopped_flags, StoppingFlags.STOPPING_MASK)
 
         # Remove the last point if it triggered one of these two flags.
         flags = np.logical_or(curvature_flags, mask_flags)
@@ -280,15 +379,15 @@ class TrackingEnvironment(BaseEnv):
         # overestimate the tractogram if the last point is not included
         # since the last point (and segment) is what made it stop tracking.
         # **Therefore** the last point should be included as much as possible.
-        stopped_streamlines = [
-            s[:-1] if f else s for s, f in zip(stopped_streamlines, flags)]
+        lengths = streamlines.lengths - flags
 
-        stopped_seeds = self.initial_points
+        # Harvest stopped streamlines and associated data
+        stopped_streamlines = streamlines.to_array_sequence(lengths)
 
         # Harvested tractogram
         tractogram = Tractogram(
             streamlines=stopped_streamlines,
             data_per_streamline={"seeds": stopped_seeds,
-                                 "flags": self.flags})
+                                 "flags": stopped_flags})
 
         return tractogram
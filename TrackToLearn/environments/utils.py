@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 from dipy.tracking import metrics as tm
 from multiprocessing import Pool
 from scipy.ndimage import map_coordinates
@@ -173,6 +174,68 @@ def is_too_curvy(streamlines: np.ndarray, max_theta: float):
     return angles > max_theta_rad
 
 
+def to_oracle_space(streamlines, affine: np.ndarray):
+    """ Copy streamlines to the voxel-corner space of the reference of the
+    oracle, like a `StatefulTractogram` after `to_vox` and `to_corner`,
+    without building one.
+
+    The oracle only sees the directions between the points of the
+    streamlines, so only the linear part of the affine is applied and the
+    streamlines are not translated. When the voxel spaces only differ by a
+    translation, like the shift of the corner, streamlines are copied as
+    they are.
+
+    Parameters
+    ----------
+    streamlines : `StreamlineView` or `TorchStreamlineView`
+        Streamlines in the voxel space of the environment.
+    affine : `numpy.ndarray` of shape (4, 4)
+        Affine from the voxel space of the environment to the voxel-corner
+        space of the reference.
+
+    Returns
+    -------
+    streamlines : ArraySequence
+        Streamlines in the space of the oracle.
+    """
+    sequence = streamlines.to_array_sequence()
+    linear = affine[:3, :3]
+    if not np.allclose(linear, np.eye(3)):
+        sequence._data = np.dot(
+            sequence._data, linear.T.astype(sequence._data.dtype))
+    return sequence
+
+
+def torch_to_oracle_space(streamlines, affine: np.ndarray):
+    """ See `to_oracle_space`. The streamlines stay on their device, padded
+    like in the buffer.
+
+    Parameters
+    ----------
+    streamlines : `TorchStreamlineView`
+        Streamlines in the voxel space of the environment.
+    affine : `numpy.ndarray` of shape (4, 4)
+        Affine from the voxel space of the environment to the voxel-corner
+        space of the reference.
+
+    Returns
+    -------
+    points : `torch.Tensor` of shape (n_streamlines, n_points, 3)
+        Streamlines in the space of the oracle, padded after their last
+        point.
+    lengths : `torch.Tensor` of shape (n_streamlines,)
+        Number of points of each streamline.
+    """
+    lengths = streamlines.lengths
+    points = streamlines.buffer.data[
+        streamlines.idx, :int(lengths.max())]
+    linear = affine[:3, :3]
+    if not np.allclose(linear, np.eye(3)):
+        points = torch.matmul(points, torch.as_tensor(
+            linear.T, dtype=points.dtype, device=points.device))
+    return points, lengths
+
+
 def winding(nxyz: np.ndarray) -> np.ndarray:
     """ Project lines to best fitting planes. Calculate
     the cummulative signed angle between each segment for each line
@@ -3,6 +3,7 @@ import numpy as np
 
 from argparse import ArgumentParser
 from os.path import join as pjoin
+from threading import Thread
 from typing import Tuple
 
 from dipy.io.stateful_tractogram import Origin, Space, StatefulTractogram
@@ -15,6 +16,8 @@ from TrackToLearn.environments.tracking_env import (
     TrackingEnvironment)
 from TrackToLearn.environments.noisy_tracking_env import (
     NoisyTrackingEnvironment)
+from TrackToLearn.environments.torch_tracking_env import (
+    TorchTrackingEnvironment)
 from TrackToLearn.environments.stopping_criteria import (
     is_flag_set, StoppingFlags)
 from TrackToLearn.utils.utils import LossHistory
@@ -119,6 +122,9 @@ class Experiment(object):
             'oracle_bonus': self.oracle_bonus,
             'oracle_validator': self.oracle_validator,
             'oracle_stopping_criterion': self.oracle_stopping_criterion,
+            'oracle_cadence': getattr(self, 'oracle_cadence', 1),
+            'oracle_inference': getattr(self, 'oracle_inference', 'fp32'),
+            'oracle_server': getattr(self, 'oracle_server', None),
             'oracle_checkpoint': self.oracle_checkpoint,
             'scoring_data': self.scoring_data,
             'tractometer_validator': self.tractometer_validator,
@@ -126,9 +132,24 @@ class Experiment(object):
             'compute_reward': self.compute_reward,
             'device': self.device,
             'target_sh_order': self.target_sh_order if hasattr(self, 'target_sh_order') else None,
+            'cache_dir': getattr(self, 'cache_dir', None),
+            'cache_size': getattr(self, 'cache_size', 10.),
+            'seed_order': getattr(self, 'seed_order', 'random'),
+            'storage_precision': getattr(self, 'storage_precision', 'fp32'),
+            'state_sampler': getattr(self, 'state_sampler', 'dwi_ml'),
+            'max_stacked_size': getattr(self, 'max_stacked_size', 2.),
+            'sparse_volumes': getattr(self, 'sparse_volumes', False),
+            'crop_margin': getattr(self, 'crop_margin', None),
+            'num_processes': getattr(self, 'num_processes', 1),
+            'seed_batch_size': getattr(self, 'n_actor', None),
         }
 
-        if noisy:
+        if getattr(self, 'device_env', False):
+            # Handles noise itself
+            class_dict = {
+                'tracking_env': TorchTrackingEnvironment
+            }
+        elif noisy:
             class_dict = {
                 'tracking_env': NoisyTrackingEnvironment
             }
@@ -233,13 +254,17 @@ class Experiment(object):
             stats.update({f.name: set_pct})
         return stats
 
-    def score_tractogram(self, filename, env):
+    def score_tractogram(self, sft, env):
         """ Score a tractogram using the tractometer or the oracle.
 
         Parameters
         ----------
-        filename: str
-            Filename of the tractogram to score.
+        sft: StatefulTractogram or str
+            Tractogram to score, or filename of the tractogram to load.
+            A tractogram is left in RASMM space with a center origin, see
+            `build_rasmm_sft`.
+        env: BaseEnv
+            Environment the tractogram was generated in.
 
         """
         # Dict of scores
@@ -248,41 +273,51 @@ class Experiment(object):
         # Compute scores for the tractogram according
         # to each validator.
         for scorer in self.validators:
-            scores = scorer(filename, env)
+            if isinstance(sft, StatefulTractogram):
+                # Validators expect the tractogram as it would be loaded
+                # from disk.
+                sft.to_rasmm()
+                sft.to_center()
+            scores = scorer(sft, env)
             all_scores.update(scores)
 
+        if isinstance(sft, StatefulTractogram):
+            # Validators may have moved the tractogram, which is then
+            # saved as it is
+            sft.to_rasmm()
+            sft.to_center()
+
         return all_scores
 
-    def save_rasmm_tractogram(
+    def build_rasmm_sft(
         self,
         tractogram,
-        subject_id: str,
         affine: np.ndarray,
         reference: nib.Nifti1Image,
-        path_prefix: str = ''
-    ) -> str:
+    ) -> StatefulTractogram:
         """
-        Saves a non-stateful tractogram from the training/validation
-        trackers.
+        Builds a stateful tractogram in RASMM space from the
+        non-stateful tractogram of the training/validation trackers.
+        Streamlines that only have their seed are pruned. The tractogram
+        has a center origin, so that it can be scored and saved without
+        being moved again.
 
         Parameters
         ----------
         tractogram: Tractogram
-            Tractogram generated at validation time.
+            Tractogram generated at validation time, in voxel space. The
+            affine is applied to it in place.
+        affine: np.ndarray
+            Affine from voxel space to RASMM.
+        reference: nib.Nifti1Image
+            Reference anatomy of the tractogram.
 
         Returns:
         --------
-        filename: str
-            Filename of the saved tractogram.
+        sft: StatefulTractogram
+            The tractogram, in RASMM space with a center origin.
         """
 
-        # Save tractogram so it can be looked at, used by the tractometer
-        # and more
-        filename = pjoin(
-            path_prefix,
-            self.experiment_path,
-            "tractogram_{}_{}_{}.trk".format(self.experiment, self.name, subject_id))
-
         # Prune empty streamlines, keep only streamlines that have more
         # than the seed.
         indices = [i for (i, s) in enumerate(tractogram.streamlines)
@@ -301,13 +336,114 @@ class Experiment(object):
             origin=Origin.TRACKVIS,
             data_per_streamline=data_per_streamline,
             data_per_point=data_per_point)
+        sft.to_center()
+
+        return sft
+
+    def save_sft(
+        self,
+        sft: StatefulTractogram,
+        subject_id: str,
+        path_prefix: str = '',
+        background: bool = False,
+    ) -> str:
+        """
+        Saves a stateful tractogram to the experiment folder.
+
+        Parameters
+        ----------
+        sft: StatefulTractogram
+            Tractogram to save.
+        subject_id: str
+            Subject the tractogram was generated on.
+        path_prefix: str
+            Prefix of the experiment folder.
+        background: bool
+            If true, the tractogram is written by a background thread.
+            It is not copied, so it must not be moved nor modified until
+            the write is done, see `wait_for_save`. Score it first.
+
+        Returns:
+        --------
+        filename: str
+            Filename of the saved tractogram.
+        """
+
+        filename = pjoin(
+            path_prefix,
+            self.experiment_path,
+            "tractogram_{}_{}_{}.trk".format(self.experiment, self.name, subject_id))
 
+        # Never write the same file twice at once
+        self.wait_for_save()
+
+        # Tractograms are written in RASMM space with a center origin.
+        # Moved here, they are left as they are by the background write.
         sft.to_rasmm()
+        sft.to_center()
+
+        if not background:
+            save_tractogram(sft, filename, bbox_valid_check=False)
+            return filename
+
+        self._save_error = None
 
-        save_tractogram(sft, filename, bbox_valid_check=False)
+        def save():
+            try:
+                save_tractogram(sft, filename, bbox_valid_check=False)
+            except BaseException as e:
+                self._save_error = e
+
+        self._save_thread = Thread(target=save)
+        self._save_thread.start()
 
         return filename
 
+    def wait_for_save(self):
+        """
+        Waits for the background write started by `save_sft`, if any, and
+        raises the exception it failed with.
+        """
+
+        save_thread = getattr(self, '_save_thread', None)
+        if save_thread is None:
+            return
+        save_thread.join()
+        self._save_thread = None
+
+        error, self._save_error = self._save_error, None
+        if error is not None:
+            raise error
+
+    def save_rasmm_tractogram(
+        self,
+        tractogram,
+        subject_id: str,
+        affine: np.ndarray,
+        reference: nib.Nifti1Image,
+        path_prefix: str = ''
+    ) -> str:
+        """
+        Saves a non-stateful tractogram from the training/validation
+        trackers. See `build_rasmm_sft` and `save_sft`.
+
+        Parameters
+        ----------
+        tractogram: Tractogram
+            Tractogram generated at validation time.
+
+        Returns:
+        --------
+        filename: str
+            Filename of the saved tractogram.
+        """
+
+        # Save tractogram so it can be looked at, used by the tractometer
+        # and more
+        sft = self.build_rasmm_sft(tractogram, affine, reference)
+
+        return self.save_sft(sft, subject_id, path_prefix)
+
     def log(
         self,
         valid_tractogram: Tractogram,
@@ -409,6 +545,34 @@ def add_environment_args(parser: ArgumentParser):
         type=float, default=0.1,
         help='Lower limit for interpolation of tracking mask value.\n'
              'Tracking will stop below this threshold.')
+    parser.add_argument(
+        '--storage_precision', default='fp32',
+        choices=['fp32', 'fp16', 'bf16'],
+        help='Precision in which the input signal and peaks are\n'
+             'stored. Interpolation is still done in float32. bf16 '
+             'is\nonly used for the copy of the signal on the device '
+             '[%(default)s].')
+    parser.add_argument(
+        '--state_sampler', default='dwi_ml', choices=['dwi_ml', 'torch'],
+        help='Interpolation of the signal around streamlines. \'torch\' '
+             'uses\nan in-project sampler doing a single gather per step '
+             '[%(default)s].')
+    parser.add_argument(
+        '--max_stacked_size', type=float, default=2., metavar='GB',
+        help='With --state_sampler torch, precompute the corners of '
+             'every\nvoxel if they fit in this size (8 times the signal) '
+             '[%(default)s].')
+    parser.add_argument(
+        '--sparse_volumes', action='store_true',
+        help='Only store the voxels of the signal and the peaks that are '
+             'not\nempty, and the masks as uint8. Implies '
+             '--state_sampler torch.')
+    parser.add_argument(
+        '--crop_margin', type=int, default=None, metavar='VOX',
+        help='Crop the volumes to the bounding box of the masks, grown by '
+             'this\nmany voxels. Should cover how far out of the mask '
+             'streamlines\ncan go plus the support of the interpolation, '
+             'e.g. 8.\nVolumes are not cropped if not set.')
 
 
 def add_reward_args(parser: ArgumentParser):
@@ -469,5 +633,21 @@ def add_oracle_args(parser: ArgumentParser):
                         'monitor how the training is doing.')
     oracle.add_argument('--oracle_stopping_criterion', action='store_true',
                         help='Stop streamlines according to the Oracle.')
+    oracle.add_argument('--oracle_cadence', default=1, type=int,
+                        metavar='STEPS',
+                        help='Score streamlines with the Oracle stopping '
+                        'criterion every STEPS steps instead of at every '
+                        'step. Scores are kept in between.')
+    oracle.add_argument('--oracle_inference', default='fp32',
+                        choices=['fp32', 'bf16', 'int8'],
+                        help='Precision of the Oracle. bf16 and int8 '
+                        '(CPU only) are faster on CPUs that support them, '
+                        'see benchmarks/bench_oracle_inference.py for '
+                        'their agreement with fp32.')
+    oracle.add_argument('--oracle_server', default=None, type=str,
+                        metavar='ADDRESS',
+                        help='Score streamlines with the Oracle served at '
+                        'ADDRESS by ttl_oracle_server.py, shared with other '
+                        'processes, instead of loading it.')
     oracle.add_argument('--oracle_bonus', default=10, type=float,
                         help='Sparse oracle weighting for reward.')
@@ -4,27 +4,35 @@ from scilpy.tractanalysis.streamlines_metrics import compute_tract_counts_map
 
 from TrackToLearn.experiment.validators import Validator
 from TrackToLearn.oracles.oracle import OracleSingleton
+from TrackToLearn.oracles.oracle_server import OracleClient
 
 
 class OracleValidator(Validator):
 
-    def __init__(self, checkpoint, device):
+    def __init__(self, checkpoint, device, inference='fp32', server=None):
 
         self.name = 'Oracle'
 
         if checkpoint:
             self.checkpoint = checkpoint
-            self.model = OracleSingleton(checkpoint, device)
+            if server:
+                self.model = OracleClient(server)
+            else:
+                self.model = OracleSingleton(
+                    checkpoint, device, inference=inference)
         else:
             self.checkpoint = None
 
         self.device = device
 
-    def __call__(self, filename, env):
+    def __call__(self, sft, env):
 
-        # Bbox check=False, TractoInferno volume may be cropped really tight
-        sft = load_tractogram(filename, env.reference,
-                              bbox_valid_check=False, trk_header_check=True)
+        if isinstance(sft, str):
+            # Bbox check=False, TractoInferno volume may be cropped really
+            # tight
+            sft = load_tractogram(sft, env.reference,
+                                  bbox_valid_check=False,
+                                  trk_header_check=True)
         _, dimensions, _, _ = sft.space_attributes
         wm_mask = env.tracking_mask.data
         count = np.count_nonzero(wm_mask)
@@ -356,11 +356,17 @@ class TractometerValidator(Validator):
                 self.gt_dir,
                 False)
 
-    def __call__(self, filename, env):
-
-        logging.info("Loading tractogram.")
-        sft = load_tractogram(filename, env.reference,
-                              bbox_valid_check=True, trk_header_check=True)
+    def __call__(self, sft, env):
+
+        if isinstance(sft, str):
+            logging.info("Loading tractogram.")
+            sft = load_tractogram(sft, env.reference,
+                                  bbox_valid_check=True,
+                                  trk_header_check=True)
+        elif not sft.is_bbox_in_vox_valid():
+            raise ValueError('Bounding box is not valid in voxel space, '
+                             'cannot score a tractogram if some coordinates '
+                             'are invalid.')
         if len(sft.streamlines) == 0:
             return {}
 
@@ -4,6 +4,17 @@ class Validator(object):
 
         self.name = ''
 
-    def __call__(self, filename):
+    def __call__(self, sft, env):
+        """ Score a tractogram.
+
+        Parameters
+        ----------
+        sft: StatefulTractogram or str
+            Tractogram to score, in RASMM space with a center origin as
+            if loaded by `load_tractogram`, or its filename. The validator
+            may move the tractogram to another space.
+        env: BaseEnv
+            Environment the tractogram was generated in.
+        """
 
         assert False, 'not implemented'
@@ -1,5 +1,7 @@
 import numpy as np
 import torch
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dipy.tracking.streamline import set_number_of_points
 
 from TrackToLearn.oracles.transformer_oracle import TransformerOracle
@@ -8,6 +10,9 @@ import contextlib
 
 autocast_context = torch.cuda.amp.autocast if torch.cuda.is_available() else contextlib.nullcontext
 
+# Precisions in which the oracle can be run
+INFERENCE_MODES = ['fp32', 'bf16', 'int8']
+
 class OracleSingleton:
     _self = None
 
@@ -17,7 +22,10 @@ class OracleSingleton:
             cls._self = super().__new__(cls)
         return cls._self
 
-    def __init__(self, checkpoint: str, device: str, batch_size=4096):
+    def __init__(
+        self, checkpoint: str, device: str, batch_size=4096, num_workers=2,
+        inference='fp32'
+    ):
         self.checkpoint = torch.load(checkpoint, map_location=get_device())
 
         hyper_parameters = self.checkpoint["hyper_parameters"]
@@ -36,54 +44,245 @@ class OracleSingleton:
 
         self.device = device
 
+        self.inference = inference
+        self.model = self._freeze(self.model, inference, device)
+        self.input_dtype = torch.bfloat16 if inference == 'bf16' \
+            else torch.float
+
+        # Streamlines are resampled by a pool of threads while the model
+        # runs. With no workers, batches are resampled one after the other
+        # by the caller.
+        self.num_workers = num_workers
+        self.pool = ThreadPoolExecutor(num_workers) if num_workers else None
+        # Ring of staging buffers, in pinned memory to be copied to the GPU
+        # asynchronously. One more than the number of workers so that they
+        # can all fill a buffer while the model reads another.
+        self.staging = [
+            torch.zeros((batch_size, 127, 3),
+                        pin_memory=get_device_str() == "cuda")
+            for _ in range(num_workers + 1)]
+
+    @staticmethod
+    def _freeze(model, inference: str, device: str):
+        """ Prepare the model for inference in a given precision. Its
+        weights are frozen.
+
+        - 'fp32': the model is kept as is, with autocast on CUDA.
+        - 'bf16': weights are converted to bfloat16. Unlike autocast, this
+          keeps the fused fast path of the transformer layers.
+        - 'int8': linear layers are dynamically quantized to int8, on the
+          CPU only. Quantized layers cannot take the fused fast path.
+
+        Parameters
+        ----------
+        model: `torch.nn.Module`
+            Model loaded from the checkpoint, in eval mode.
+        inference: str
+            Precision, one of `INFERENCE_MODES`.
+        device: str
+            Device of the model.
+
+        Returns
+        -------
+        model: `torch.nn.Module`
+            Model to run.
+        """
+        if inference not in INFERENCE_MODES:
+            raise ValueError(
+                'Unknown oracle inference mode {}.'.format(inference))
+        model.requires_grad_(False)
+        if inference == 'bf16':
+            model = model.to(torch.bfloat16)
+        elif inference == 'int8':
+            if torch.device(device).type != 'cpu':
+                raise ValueError(
+                    'int8 oracle inference is only available on the CPU.')
+            model = torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8)
+        return model
+
+    def _inference_context(self):
+        """ Context in which the model is run. """
+        if self.inference == 'fp32':
+            return autocast_context()
+        if self.inference == 'int8':
+            return _no_fastpath()
+        return contextlib.nullcontext()
+
+    @staticmethod
+    def _featurize(streamlines, buffer: torch.Tensor) -> int:
+        """ Resample streamlines to 128 points and write the directions
+        between their points in a staging buffer.
+
+        Parameters
+        ----------
+        streamlines: `ArraySequence` or list of `numpy.ndarray`
+            Batch of streamlines, at most as many as the buffer holds.
+        buffer: `torch.Tensor` of shape (batch_size, 127, 3)
+            Buffer to write the features in.
+
+        Returns
+        -------
+        n: int
+            Number of streamlines written in the buffer.
+        """
+        # Resample streamlines to fixed number of point to set all
+        # sequences to same length
+        data = np.asarray(set_number_of_points(streamlines, 128))
+        n = len(data)
+        # Streamline features are the directions between points
+        np.subtract(data[:, 1:], data[:, :-1], out=buffer.numpy()[:n])
+        return n
+
     def predict(self, streamlines):
         # Total number of predictions to return
         N = len(streamlines)
-        # Placeholders for input and output data
-        placeholder = torch.zeros(
-            (self.batch_size, 127, 3), pin_memory=get_device_str() == "cuda")
         result = torch.zeros((N), dtype=torch.float, device=self.device)
+        if N == 0:
+            return result.cpu().numpy()
 
-        # Get the first batch
-        batch = streamlines[:self.batch_size]
-        N_batch = len(batch)
-        # Resample streamlines to fixed number of point to set all
-        # sequences to same length
-        data = set_number_of_points(batch, 128)
-        # Compute streamline features as the directions between points
-        dirs = np.diff(data, axis=1)
-        # Send the directions to pinned memory
-        placeholder[:N_batch] = torch.from_numpy(dirs)
-        # Send the pinned memory to GPU asynchronously
-        input_data = placeholder[:N_batch].to(
-            self.device, non_blocking=True, dtype=torch.float)
-        i = 0
-
-        while i <= N // self.batch_size:
-            start = (i+1) * self.batch_size
+        starts = range(0, N, self.batch_size)
+        n_slots = len(self.staging)
+
+        def prepare(b):
+            start = starts[b]
+            buffer = self.staging[b % n_slots]
+            batch = streamlines[start:start + self.batch_size]
+            if self.pool is None:
+                return self._featurize(batch, buffer)
+            return self.pool.submit(self._featurize, batch, buffer)
+
+        # Start resampling as many batches as there are staging buffers
+        pending = deque(prepare(b) for b in range(min(n_slots, len(starts))))
+
+        for b, start in enumerate(starts):
+            n = pending.popleft()
+            if self.pool is not None:
+                n = n.result()
+            # Send the staging buffer to the device asynchronously
+            input_data = self.staging[b % n_slots][:n].to(
+                self.device, non_blocking=True, dtype=self.input_dtype)
+            copied = torch.cuda.Event() if input_data.is_cuda else None
+            if copied is not None:
+                copied.record()
+
+            with self._inference_context():
+                with torch.inference_mode():
+                    predictions = self.model(input_data)
+                    result[start:start + n] = predictions
+
+            # The buffer can be refilled once it was copied to the device,
+            # while the model is still running on the GPU
+            if b + n_slots < len(starts):
+                if copied is not None:
+                    copied.synchronize()
+                pending.append(prepare(b + n_slots))
+
+        return result.cpu().numpy()
+
+    def predict_padded(self, points: torch.Tensor, lengths: torch.Tensor):
+        """ Score streamlines held in a padded tensor, like the buffer of a
+        `TorchTrackingEnvironment`. Streamlines are resampled with
+        `torch_set_number_of_points` on the device of the model instead of
+        with dipy on the host.
+
+        Parameters
+        ----------
+        points: `torch.Tensor` of shape (n_streamlines, n_points, 3)
+            Streamlines, padded after their last point.
+        lengths: `torch.Tensor` of int of shape (n_streamlines,)
+            Number of points of each streamline, at least 2.
+
+        Returns
+        -------
+        scores: `numpy.ndarray` of shape (n_streamlines,)
+            Score of each streamline.
+        """
+        N = len(points)
+        result = torch.zeros((N), dtype=torch.float, device=self.device)
+
+        for start in range(0, N, self.batch_size):
             end = min(start + self.batch_size, N)
-            # Prefetch the next batch
-            if start < end:
-                batch = streamlines[start:end]
-                # Resample streamlines to fixed number of point to set all
-                # sequences to same length
-                data = set_number_of_points(batch, 128)
-                # Compute streamline features as the directions between points
-                dirs = np.diff(data, axis=1)
-                # Put the directions in pinned memory
-                placeholder[:end-start] = torch.from_numpy(dirs)
-
-            with autocast_context():
-                with torch.no_grad():
+            batch_lengths = lengths[start:end].to(self.device)
+            batch = points[start:end, :int(batch_lengths.max())].to(
+                self.device, dtype=torch.float)
+            resampled = torch_set_number_of_points(batch, batch_lengths, 128)
+            input_data = (resampled[:, 1:] - resampled[:, :-1]).to(
+                self.input_dtype)
+
+            with self._inference_context():
+                with torch.inference_mode():
                     predictions = self.model(input_data)
-                    result[
-                        i * self.batch_size:
-                        (i * self.batch_size) + self.batch_size] = predictions
-            i += 1
-            if i >= N // self.batch_size:
-                break
-            # Send the pinned memory to GPU asynchronously
-            input_data = placeholder[:end-start].to(
-                self.device, non_blocking=True, dtype=torch.float)
+                    result[start:end] = predictions
 
         return result.cpu().numpy()
+
+
+def torch_set_number_of_points(
+    points: torch.Tensor,
+    lengths: torch.Tensor,
+    nb_points: int,
+) -> torch.Tensor:
+    """ Resample a padded batch of streamlines to the same number of points,
+    equally spaced along their arc length, like dipy's
+    `set_number_of_points`.
+
+    Parameters
+    ----------
+    points: `torch.Tensor` of shape (n_streamlines, n_points, 3)
+        Streamlines, padded after their last point.
+    lengths: `torch.Tensor` of int of shape (n_streamlines,)
+        Number of points of each streamline, at least 2.
+    nb_points: int
+        Number of points of the resampled streamlines.
+
+    Returns
+    -------
+    resampled: `torch.Tensor` of shape (n_streamlines, nb_points, 3)
+        Resampled streamlines.
+    """
+    N, L, _ = points.shape
+    lengths = lengths.long()
+
+    # Arc length at each point. Segments past the end of a streamline are
+    # empty, so the arc length stays at the total length in the padding.
+    segments = torch.linalg.norm(points[:, 1:] - points[:, :-1], dim=-1)
+    in_streamline = torch.arange(L - 1, device=points.device)[None] < \
+        (lengths[:, None] - 1)
+    segments = segments * in_streamline
+    arc = torch.cat(
+        (torch.zeros((N, 1), dtype=points.dtype, device=points.device),
+         torch.cumsum(segments, dim=1)), dim=1)
+    total = arc[:, -1:]
+
+    # Segment in which each new point falls, and where along it
+    targets = total * torch.linspace(
+        0, 1, nb_points, dtype=points.dtype, device=points.device)[None]
+    idx = torch.searchsorted(arc, targets, right=True) - 1
+    idx = torch.minimum(idx.clamp_(min=0), lengths[:, None] - 2)
+    start = torch.gather(arc, 1, idx)
+    length = torch.gather(arc, 1, idx + 1) - start
+    ratio = torch.where(
+        length > 0, (targets - start) / length, torch.zeros_like(length))
+
+    idx = idx[..., None].expand(-1, -1, 3)
+    p0 = torch.gather(points, 1, idx)
+    p1 = torch.gather(points, 1, idx + 1)
+    resampled = p0 + ratio[..., None] * (p1 - p0)
+    # Both ends are kept as they are
+    resampled[:, 0] = points[:, 0]
+    resampled[:, -1] = points[torch.arange(N), lengths - 1]
+    return resampled
+
+
+@contextlib.contextmanager
+def _no_fastpath():
+    """ Disable the fused fast path of the transformer layers, which reads
+    the weights of their linear layers as tensors.
+    """
+    enabled = torch.backends.mha.get_fastpath_enabled()
+    torch.backends.mha.set_fastpath_enabled(False)
+    try:
+        yield
+    finally:
+        torch.backends.mha.set_fastpath_enabled(enabled)
@@ -0,0 +1,169 @@
+import queue
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+import torch
+
+from TrackToLearn.oracles.oracle import OracleSingleton
+
+
+class OracleServer(object):
+    """ Keep one oracle warm and score streamlines for several processes
+    on the same node, e.g. shards of a tracking, parallel validations or
+    training runs, instead of each of them loading its own copy.
+
+    Clients connect with an `OracleClient` to a Unix socket. Their
+    requests are merged in large batches before being scored, and the
+    scores are sent back to each of them. Streamlines are sent as raw
+    arrays, no object is unpickled from the clients.
+    """
+
+    def __init__(
+        self,
+        checkpoint: str,
+        address: str,
+        device: str,
+        batch_size: int = 4096,
+        num_workers: int = 2,
+        inference: str = 'fp32',
+        max_wait: float = 0.005,
+    ):
+        """
+        Parameters
+        ----------
+        checkpoint: str
+            Checkpoint of the oracle.
+        address: str
+            Path of the Unix socket to listen on.
+        device: str
+            Device of the oracle.
+        batch_size: int
+            Batch size of the oracle. Requests are merged until they
+            reach it.
+        num_workers: int
+            Number of threads resampling streamlines, see
+            `OracleSingleton`.
+        inference: str
+            Precision of the oracle, see `OracleSingleton`.
+        max_wait: float
+            Time, in seconds, to wait for other requests to merge with
+            the first one before scoring them.
+        """
+        self.model = OracleSingleton(
+            checkpoint, device, batch_size, num_workers, inference)
+        self.address = address
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+
+        self.requests = queue.Queue()
+        # Number of merged batches and of streamlines scored, for
+        # statistics
+        self.n_batches = 0
+        self.n_scored = 0
+
+    def serve_forever(self):
+        """ Accept clients until interrupted. """
+        scorer = threading.Thread(target=self._score, daemon=True)
+        scorer.start()
+        with Listener(self.address, 'AF_UNIX') as listener:
+            print('Oracle listening on {}.'.format(self.address))
+            while True:
+                connection = listener.accept()
+                threading.Thread(
+                    target=self._receive, args=(connection,),
+                    daemon=True).start()
+
+    def _receive(self, connection):
+        """ Queue the requests of a client until it disconnects. """
+        with connection:
+            while True:
+                try:
+                    lengths = np.frombuffer(
+                        connection.recv_bytes(), dtype=np.int64)
+                    points = np.frombuffer(
+                        connection.recv_bytes(), dtype=np.float32)
+                except (EOFError, OSError):
+                    return
+                self.requests.put(
+                    (connection, lengths, points.reshape(-1, 3)))
+
+    def _score(self):
+        """ Merge queued requests, score them and answer each client. """
+        while True:
+            pending = [self.requests.get()]
+            n = len(pending[0][1])
+            # Gather other requests that come in meanwhile, up to a batch
+            deadline = time.perf_counter() + self.max_wait
+            while n < self.batch_size:
+                try:
+                    pending.append(self.requests.get(
+                        timeout=max(deadline - time.perf_counter(), 0)))
+                except queue.Empty:
+                    break
+                n += len(pending[-1][1])
+
+            lengths = np.concatenate([p[1] for p in pending])
+            points = np.concatenate([p[2] for p in pending])
+            streamlines = np.split(points, np.cumsum(lengths)[:-1])
+            scores = self.model.predict(streamlines).astype(np.float32)
+            self.n_batches += 1
+            self.n_scored += len(scores)
+
+            start = 0
+            for connection, request_lengths, _ in pending:
+                end = start + len(request_lengths)
+                try:
+                    connection.send_bytes(scores[start:end].tobytes())
+                except OSError:
+                    # The client left, its scores are dropped
+                    pass
+                start = end
+
+
+class OracleClient(object):
+    """ Score streamlines with an oracle held by an `OracleServer`,
+    through the same interface as `OracleSingleton`.
+    """
+
+    def __init__(self, address: str):
+        """
+        Parameters
+        ----------
+        address: str
+            Path of the Unix socket of the server.
+        """
+        self.address = address
+        self.connection = Client(address, 'AF_UNIX')
+
+    def predict(self, streamlines):
+        """ Score streamlines.
+
+        Parameters
+        ----------
+        streamlines: `ArraySequence` or list of `numpy.ndarray`
+            Streamlines in the voxel-corner space of the oracle.
+
+        Returns
+        -------
+        scores: `numpy.ndarray` of shape (n_streamlines,)
+            Score of each streamline.
+        """
+        if len(streamlines) == 0:
+            return np.zeros(0, dtype=np.float32)
+
+        lengths = np.asarray([len(s) for s in streamlines], dtype=np.int64)
+        points = np.concatenate(list(streamlines)).astype(np.float32)
+        self.connection.send_bytes(lengths.tobytes())
+        self.connection.send_bytes(points.tobytes())
+        return np.frombuffer(
+            self.connection.recv_bytes(), dtype=np.float32).copy()
+
+    def predict_padded(self, points: torch.Tensor, lengths: torch.Tensor):
+        """ Score streamlines held in a padded tensor. They are copied to
+        the host and resampled by the server, see
+        `OracleSingleton.predict_padded`.
+        """
+        points, lengths = points.cpu().numpy(), lengths.cpu().numpy()
+        return self.predict([p[:n] for p, n in zip(points, lengths)])
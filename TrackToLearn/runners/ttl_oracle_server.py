@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+import argparse
+
+from argparse import RawTextHelpFormatter
+
+from TrackToLearn.oracles.oracle import INFERENCE_MODES
+from TrackToLearn.oracles.oracle_server import OracleServer
+from TrackToLearn.utils.torch_utils import get_device
+
+
+def parse_args():
+    """ Serve an oracle to the tracking, validation and training processes
+    of a node, which share it by passing the address of the server to
+    `--oracle_server`. Requests of all clients are merged in large batches.
+    """
+    parser = argparse.ArgumentParser(
+        description=parse_args.__doc__,
+        formatter_class=RawTextHelpFormatter)
+
+    parser.add_argument('oracle_checkpoint', type=str,
+                        help='Checkpoint file (.ckpt) of the Oracle')
+    parser.add_argument('address', type=str,
+                        help='Path of the Unix socket to listen on.')
+    parser.add_argument('--oracle_inference', default='fp32',
+                        choices=INFERENCE_MODES,
+                        help='Precision of the Oracle.')
+    parser.add_argument('--batch_size', default=4096, type=int,
+                        help='Number of streamlines scored at once.')
+    parser.add_argument('--num_workers', default=2, type=int,
+                        help='Number of threads resampling streamlines.')
+    parser.add_argument('--max_wait', default=0.005, type=float,
+                        help='Time, in seconds, to wait for requests to '
+                        'merge in a batch.')
+
+    arguments = parser.parse_args()
+    return arguments
+
+
+def main():
+    """ Main oracle server script """
+    args = parse_args()
+    server = OracleServer(
+        args.oracle_checkpoint, args.address, get_device(),
+        args.batch_size, args.num_workers, args.oracle_inference,
+        args.max_wait)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Scored {} streamlines in {} batches.'.format(
+            server.n_scored, server.n_batches))
+
+
+if __name__ == '__main__':
+    main()
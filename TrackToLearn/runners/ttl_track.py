@@ -1,17 +1,21 @@
 #!/usr/bin/env python3
 import argparse
 import json
+import multiprocessing
 import nibabel as nib
 import numpy as np
 import os
 import random
+import tempfile
 import torch
 
 from argparse import RawTextHelpFormatter
+from concurrent.futures import ProcessPoolExecutor
 from os.path import join
 
 from dipy.io.utils import get_reference_info, create_tractogram_header
 from nibabel.streamlines import detect_format
+from nibabel.streamlines.tractogram import LazyTractogram, TractogramItem
 from scilpy.io.utils import (add_overwrite_arg,
                              add_sh_basis_args,
                              assert_inputs_exist, assert_outputs_exist,
@@ -19,6 +23,7 @@ from scilpy.io.utils import (add_overwrite_arg,
 from scilpy.tracking.utils import verify_streamline_length_options
 
 from TrackToLearn.algorithms.sac_auto import SACAuto
+from TrackToLearn.datasets.cache import VolumeCache
 from TrackToLearn.datasets.utils import MRIDataVolume
 
 from TrackToLearn.experiment.experiment import Experiment
@@ -46,6 +51,8 @@ class TrackToLearnTrack(Experiment):
         """
         """
 
+        self.track_dto = track_dto
+
         self.in_odf = track_dto['in_odf']
         self.wm_file = track_dto['in_mask']
 
@@ -63,15 +70,32 @@ class TrackToLearnTrack(Experiment):
 
         self.binary_stopping_threshold = \
             track_dto['binary_stopping_threshold']
+        self.storage_precision = track_dto['storage_precision']
+        self.state_sampler = track_dto['state_sampler']
+        self.max_stacked_size = track_dto['max_stacked_size']
+        self.sparse_volumes = track_dto['sparse_volumes']
+        self.crop_margin = track_dto['crop_margin']
 
         self.n_actor = track_dto['n_actor']
+        self.n_workers = track_dto['n_workers']
+        # Processes extracting the peaks. Shard workers split the CPUs
+        # between them, see `_track_sharded`.
+        self.num_processes = track_dto.get(
+            'num_processes', multiprocessing.cpu_count())
+        self.checkpoint_dir = track_dto['checkpoint_dir']
+        self.chunk_size = track_dto['chunk_size']
+        self.continuous_batching = track_dto['continuous_batching']
+        self.device_env = track_dto['device_env']
         self.npv = track_dto['npv']
+        self.seed_order = track_dto['seed_order']
         self.min_length = track_dto['min_length']
         self.max_length = track_dto['max_length']
 
         self.compress = track_dto['compress'] or 0.0
         self.sh_basis = track_dto['sh_basis']
         self.save_seeds = track_dto['save_seeds']
+        self.cache_dir = track_dto['cache_dir']
+        self.cache_size = track_dto['cache_size']
 
         # Tractometer parameters
         self.tractometer_validator = False
@@ -87,8 +111,8 @@ class TrackToLearnTrack(Experiment):
             fa_image = nib.load(
                 track_dto['fa_map_file'])
             self.fa_map = MRIDataVolume(
-                data=fa_image.get_fdata(),
-                affine_vox2rasmm=fa_image.affine)
+                affine_vox2rasmm=fa_image.affine,
+                compute=fa_image.get_fdata)
 
         self.agent = track_dto['agent']
         self.hyperparameters = track_dto['hyperparameters']
@@ -118,9 +142,19 @@ class TrackToLearnTrack(Experiment):
 
         self.comet_experiment = None
 
-    def run(self):
-        """
-        Main method where the magic happens
+    def get_step_size_mm(self, verbose=True):
+        """ Step size such that the agent traverses the same "quantity" of
+        voxels per step as during training.
+
+        Parameters
+        ----------
+        verbose: bool
+            Print the new step size if it differs from the training one.
+
+        Returns
+        -------
+        step_size_mm: float
+            Step size, in mm.
         """
         # Presume iso vox
         ref_img = nib.load(self.reference_file)
@@ -134,17 +168,74 @@ class TrackToLearnTrack(Experiment):
                 float(tracking_voxel_size) / float(self.voxel_size)) * \
                 self.step_size
 
-            print("Agent was trained on a voxel size of {}mm and a "
-                  "step size of {}mm.".format(self.voxel_size, self.step_size))
+            if verbose:
+                print("Agent was trained on a voxel size of {}mm and a "
+                      "step size of {}mm.".format(
+                          self.voxel_size, self.step_size))
+
+                print("Subject has a voxel size of {}mm, setting step size "
+                      "to {}mm.".format(tracking_voxel_size, step_size_mm))
 
-            print("Subject has a voxel size of {}mm, setting step size to "
-                  "{}mm.".format(tracking_voxel_size, step_size_mm))
+        return step_size_mm
+
+    def run(self):
+        """
+        Main method where the magic happens
+        """
+        step_size_mm = self.get_step_size_mm()
 
         # Instanciate environment. Actions will be fed to it and new
         # states will be returned. The environment updates the streamline
         env = self.get_tracking_env()
         env.step_size_mm = step_size_mm
 
+        filetype = detect_format(self.out_tractogram)
+        reference = get_reference_info(self.reference_file)
+        header = create_tractogram_header(filetype, *reference)
+
+        if self.checkpoint_dir:
+            tractogram = self._track_resumable(env, filetype)
+            nib.streamlines.save(
+                tractogram, self.out_tractogram, header=header)
+            self._clear_checkpoint()
+            return
+
+        if self.n_workers > 1:
+            env.load_subject()
+            with tempfile.TemporaryDirectory(
+                dir=os.path.dirname(os.path.abspath(self.out_tractogram))
+            ) as tmp_dir:
+                shard_files = self._track_sharded(
+                    env.seeds, filetype, tmp_dir, self.random_seed)
+                tractogram = self._merge_parts(
+                    shard_files, env.affine_vox2rasmm)
+                nib.streamlines.save(
+                    tractogram, self.out_tractogram, header=header)
+            return
+
+        tracker = self._get_tracker(env)
+
+        # Run tracking
+        env.load_subject()
+        tractogram = tracker.track(env, filetype)
+
+        # Use generator to save the streamlines on-the-fly
+        nib.streamlines.save(tractogram, self.out_tractogram, header=header)
+
+    def _get_tracker(self, env):
+        """ Load the agent and build the tracker.
+
+        Parameters
+        ----------
+        env: BaseEnv
+            Environment the agent will track in.
+
+        Returns
+        -------
+        tracker: Tracker
+            Tracker using the pretrained agent.
+        """
+
         # Get example state to define NN input size
         example_state = env.reset(0, 1)
         self.input_size = example_state.shape[1]
@@ -169,21 +260,362 @@ class TrackToLearnTrack(Experiment):
 
         # Initialize Tracker, which will handle streamline generation
 
-        tracker = Tracker(
+        return Tracker(
             alg, self.n_actor, compress=self.compress,
             min_length=self.min_length, max_length=self.max_length,
-            save_seeds=self.save_seeds)
+            save_seeds=self.save_seeds,
+            continuous=self.continuous_batching)
+
+    def _track_sharded(
+        self, seeds, filetype, out_dir, rng_seed, prefix='shard'
+    ):
+        """ Split the seeds into `n_workers` shards and track each of them
+        in its own process. Each worker writes its streamlines to a file in
+        `out_dir`. For a given `rng_seed`, the output does not depend on
+        which worker finishes first.
+
+        Parameters
+        ----------
+        seeds: SeedSource
+            Seeds to track.
+        filetype: TrkFile or TckFile
+            Output format.
+        out_dir: str
+            Directory in which workers write their shard.
+        rng_seed: int
+            Random seed of the first worker. Worker `i` uses
+            `rng_seed + i`.
+        prefix: str
+            Prefix of the names of the shard files.
+
+        Returns
+        -------
+        shard_files: list of str
+            Files of the shards, in order. See `_merge_parts`.
+        """
+
+        # Workers generate the seeds of their shard themselves
+        shards = seeds.split(self.n_workers)
+
+        # Split the threads of the node between the workers
+        n_threads = max(1, torch.get_num_threads() // self.n_workers)
+
+        jobs = []
+        for i, shard in enumerate(shards):
+            shard_dto = dict(self.track_dto, rng_seed=rng_seed + i,
+                             num_processes=n_threads)
+            jobs.append((shard_dto, shard, filetype,
+                         os.path.join(
+                             out_dir, '{}_{}.part'.format(prefix, i)),
+                         n_threads))
+
+        # Workers do not share the agent or CUDA state with this process.
+        # If a worker dies, the executor raises instead of hanging.
+        with ProcessPoolExecutor(
+            self.n_workers,
+            mp_context=multiprocessing.get_context('spawn')
+        ) as executor:
+            shard_files = list(executor.map(_track_shard, *zip(*jobs)))
+
+        return shard_files
+
+    def _merge_parts(self, part_files, affine):
+        """ Read back the streamlines written by `_save_part`, one batch
+        at a time.
+
+        Parameters
+        ----------
+        part_files: list of str
+            Files to read, in order.
+        affine: `numpy.ndarray`
+            Voxel to RASMM affine of the tractogram.
+
+        Returns
+        -------
+        tractogram: LazyTractogram
+            Streamlines of all files, in the order of the files.
+        """
+
+        def merge_generator():
+            for part_file in part_files:
+                for points, lengths, seeds in _load_part(part_file):
+                    if len(lengths) == 0:
+                        continue
+                    offsets = np.cumsum(lengths)[:-1]
+                    streamlines = np.split(points, offsets)
+                    for i, streamline in enumerate(streamlines):
+                        seed_dict = {}
+                        if self.save_seeds:
+                            seed_dict = {'seeds': seeds[i]}
+                        yield TractogramItem(streamline, seed_dict, {})
+
+        tractogram = LazyTractogram.from_data_func(merge_generator)
+        tractogram.affine_to_rasmm = affine
+
+        return tractogram
+
+    def _track_resumable(self, env, filetype):
+        """ Track the seeds in chunks of `chunk_size` seeds and write the
+        streamlines of each chunk to `checkpoint_dir` as soon as it is
+        done. A manifest records the range of seeds of every completed
+        chunk, so that an interrupted run started again with the same
+        arguments only tracks the remaining chunks.
+
+        Each chunk is tracked with its own random seed, derived from
+        `--rng_seed`, so a resumed run gives the same tractogram as an
+        uninterrupted one.
+
+        Parameters
+        ----------
+        env: BaseEnv
+            Environment whose seeds will be tracked.
+        filetype: TrkFile or TckFile
+            Output format.
+
+        Returns
+        -------
+        tractogram: LazyTractogram
+            Streamlines of all chunks, in the order of the chunks.
+        """
 
-        # Run tracking
         env.load_subject()
-        filetype = detect_format(self.out_tractogram)
-        tractogram = tracker.track(env, filetype)
+        # Seeds only depend on the seeding mask and `--rng_seed`, so they
+        # are the same when resuming
+        seeds = env.seeds
+
+        manifest = self._load_manifest(self._resume_key(seeds, filetype))
+
+        tracker = None
+        for c, start in enumerate(range(0, len(seeds), self.chunk_size)):
+            if str(c) in manifest['chunks']:
+                continue
+
+            end = min(start + self.chunk_size, len(seeds))
+            print('Tracking chunk {} (seeds {} to {}).'.format(c, start, end))
+
+            if self.n_workers > 1:
+                part_files = self._track_sharded(
+                    seeds.subset(start, end), filetype, self.checkpoint_dir,
+                    self.random_seed + c * self.n_workers,
+                    prefix='chunk_{}'.format(c))
+            else:
+                if tracker is None:
+                    tracker = self._get_tracker(env)
+                chunk_seed = self.random_seed + c
+                torch.manual_seed(chunk_seed)
+                env.reseed(chunk_seed)
+                env.seeds = seeds.subset(start, end)
+                part_files = [_save_part(
+                    tracker, env, filetype, os.path.join(
+                        self.checkpoint_dir, 'chunk_{}.part'.format(c)))]
+
+            manifest['chunks'][str(c)] = {
+                'seeds': [start, end],
+                'files': [os.path.basename(f) for f in part_files]}
+            self._save_manifest(manifest)
+
+        part_files = [
+            os.path.join(self.checkpoint_dir, f)
+            for c in range(len(manifest['chunks']))
+            for f in manifest['chunks'][str(c)]['files']]
+
+        return self._merge_parts(part_files, env.affine_vox2rasmm)
+
+    def _resume_key(self, seeds, filetype):
+        """ Key of the inputs and of the arguments deciding which
+        streamlines are tracked from which seeds. Chunks are tracked with
+        random seeds depending on `n_workers`, so it is part of the key as
+        well.
+
+        Parameters
+        ----------
+        seeds: SeedSource
+            Seeds to track.
+        filetype: TrkFile or TckFile
+            Output format.
+
+        Returns
+        -------
+        key: str
+            Key of the run, see `VolumeCache.key`.
+        """
 
-        reference = get_reference_info(self.reference_file)
-        header = create_tractogram_header(filetype, *reference)
+        input_files = [
+            self.in_odf, self.in_seed, self.in_mask, self.hyperparameters,
+            os.path.join(self.agent, 'last_model_state_actor.pth')]
+        if self.track_dto.get('fa_map'):
+            input_files.append(self.track_dto['fa_map'])
+
+        return VolumeCache.key(
+            [VolumeCache.hash_file(f) for f in input_files],
+            seeds.voxels, seeds.random_seed, seeds.npv, self.random_seed,
+            self.seed_order, filetype.__name__, self.noise, self.compress,
+            self.min_length, self.max_length, self.save_seeds,
+            self.chunk_size, self.n_actor, self.n_workers,
+            self.continuous_batching, self.device_env, self.input_wm,
+            self.sh_basis, self.binary_stopping_threshold,
+            self.storage_precision, self.state_sampler,
+            self.max_stacked_size, self.sparse_volumes, self.crop_margin)
+
+    def _load_manifest(self, key):
+        """ Load the manifest of `checkpoint_dir`, or start a new one.
+
+        Parameters
+        ----------
+        key: str
+            Key of the seeds and of the arguments changing the streamlines.
+            A manifest written with another key belongs to another run.
+
+        Returns
+        -------
+        manifest: dict
+            Key of the run and completed chunks.
+        """
 
-        # Use generator to save the streamlines on-the-fly
-        nib.streamlines.save(tractogram, self.out_tractogram, header=header)
+        manifest_file = os.path.join(self.checkpoint_dir, 'manifest.json')
+        if not os.path.exists(manifest_file):
+            os.makedirs(self.checkpoint_dir, exist_ok=True)
+            return {'key': key, 'chunks': {}}
+
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+
+        if manifest['key'] != key:
+            raise ValueError(
+                '{} was written by a run with other seeds or arguments. '
+                'Use another --checkpoint_dir or delete it.'.format(
+                    manifest_file))
+
+        print('Resuming from {} ({} chunks done).'.format(
+            manifest_file, len(manifest['chunks'])))
+        return manifest
+
+    def _save_manifest(self, manifest):
+        """ Write the manifest of `checkpoint_dir`. The previous manifest is
+        only replaced once the new one is complete.
+
+        Parameters
+        ----------
+        manifest: dict
+            Key of the run and completed chunks.
+        """
+
+        manifest_file = os.path.join(self.checkpoint_dir, 'manifest.json')
+        with open(manifest_file + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_file + '.tmp', manifest_file)
+
+    def _clear_checkpoint(self):
+        """ Delete the manifest and chunks of `checkpoint_dir` once the
+        output is written.
+        """
+
+        manifest_file = os.path.join(self.checkpoint_dir, 'manifest.json')
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+
+        for chunk in manifest['chunks'].values():
+            for f in chunk['files']:
+                os.remove(os.path.join(self.checkpoint_dir, f))
+        os.remove(manifest_file)
+
+
+def _track_shard(track_dto, seeds, filetype, shard_file, n_threads):
+    """ Track a shard of the seeds in a worker process and save the
+    resulting streamlines (and their seeds) to `shard_file`.
+
+    Parameters
+    ----------
+    track_dto: dict
+        Tracking arguments.
+    seeds: SeedSource
+        Seeds of the shard.
+    filetype: TrkFile or TckFile
+        Output format.
+    shard_file: str
+        Path of the file to write, see `_save_part`.
+    n_threads: int
+        Number of threads torch can use in this worker.
+
+    Returns
+    -------
+    shard_file: str
+        Path of the written file.
+    """
+    torch.set_num_threads(n_threads)
+
+    experiment = TrackToLearnTrack(track_dto)
+    env = experiment.get_tracking_env()
+    env.step_size_mm = experiment.get_step_size_mm(verbose=False)
+    tracker = experiment._get_tracker(env)
+
+    env.load_subject()
+    env.seeds = seeds
+
+    return _save_part(tracker, env, filetype, shard_file)
+
+
+def _save_part(tracker, env, filetype, part_file):
+    """ Track the seeds of the environment, in order, and save the
+    resulting streamlines (and their seeds) to `part_file`. The file only
+    appears once it is completely written.
+
+    Each batch is appended to the file as soon as it is tracked, as three
+    `.npy` arrays: the points, the lengths and the seeds of its
+    streamlines. Streamlines are never all held in memory.
+
+    Parameters
+    ----------
+    tracker: Tracker
+        Tracker to use.
+    env: BaseEnv
+        Environment whose seeds will be tracked.
+    filetype: TrkFile or TckFile
+        Output format.
+    part_file: str
+        Path of the file to write.
+
+    Returns
+    -------
+    part_file: str
+        Path of the written file.
+    """
+
+    with open(part_file + '.tmp', 'wb') as f:
+        for chunk in tracker.track_chunks(env, filetype):
+            seeds = np.zeros((0, 3))
+            if tracker.save_seeds:
+                seeds = chunk.data_per_streamline['seeds']
+            np.save(f, chunk.streamlines.get_data())
+            np.save(f, chunk.streamlines._lengths)
+            np.save(f, seeds)
+    os.replace(part_file + '.tmp', part_file)
+
+    return part_file
+
+
+def _load_part(part_file):
+    """ Read the batches written by `_save_part`, one at a time.
+
+    Parameters
+    ----------
+    part_file: str
+        Path of the file to read.
+
+    Yields
+    ------
+    points: `numpy.ndarray` of shape (n_points, 3)
+        Points of the streamlines of a batch.
+    lengths: `numpy.ndarray` of shape (n_streamlines,)
+        Number of points of each streamline.
+    seeds: `numpy.ndarray` of shape (n_streamlines, 3)
+        Seeds of the streamlines, empty if they were not saved.
+    """
+
+    with open(part_file, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        while f.tell() < size:
+            yield np.load(f), np.load(f), np.load(f)
 
 
 def add_mandatory_options_tracking(p):
@@ -247,10 +679,40 @@ def add_track_args(parser):
                              'ly.\nLimited by the size of your GPU and RAM. A '
                              'higher value\nwill speed up tracking up to a '
                              'point [%(default)s].')
+    agent_group.add_argument('--continuous_batching', action='store_true',
+                             help='Start tracking from a new seed as soon as a'
+                             ' streamline\nstops instead of waiting for the '
+                             'whole batch to be done.\nKeeps the GPU busy '
+                             'when streamline lengths vary a lot.')
+    agent_group.add_argument('--device_env', action='store_true',
+                             help='Keep streamlines, stopping criteria and '
+                             'states on the\ndevice of the agent (e.g. GPU) '
+                             'while tracking instead\nof copying them to '
+                             'and from the host at every step.\nWith '
+                             '--noise, the noise is drawn on the device '
+                             'and the\nstreamlines differ from the ones '
+                             'tracked on the host.')
+    agent_group.add_argument('--n_workers', type=int, default=1,
+                             help='Split the seeds between this many '
+                             'processes, each with its own\nagent and a '
+                             'share of the CPU threads. The output does '
+                             'not\ndepend on the order in which workers '
+                             'finish. Use with\n--cache_dir so workers do '
+                             'not each recompute the inputs\n'
+                             '[%(default)s].')
 
     seed_group = parser.add_argument_group('Seeding options')
     seed_group.add_argument('--npv', type=int, default=1,
                             help='Number of seeds per voxel [%(default)s].')
+    seed_group.add_argument('--seed_order', default='random',
+                            choices=['random', 'morton'],
+                            help='Order in which seeds are tracked. '
+                            '\'morton\' groups the seeds of each\nbatch '
+                            'spatially along a Morton curve (the order of '
+                            'the\nbatches stays random) so that their '
+                            'interpolations hit the\nsame part of the '
+                            'memory. Faster on large volumes\n'
+                            '[%(default)s].')
     track_g = parser.add_argument_group('Tracking options')
     track_g.add_argument('--min_length', type=float, default=10.,
                          metavar='m',
@@ -273,9 +735,64 @@ def add_track_args(parser):
         type=float, default=0.1,
         help='Lower limit for interpolation of tracking mask value.\n'
              'Tracking will stop below this threshold.')
+    track_g.add_argument(
+        '--storage_precision', default='fp32',
+        choices=['fp32', 'fp16', 'bf16'],
+        help='Precision in which the input signal and peaks are\n'
+             'stored. Interpolation is still done in float32. bf16 '
+             'is\nonly used for the copy of the signal on the device '
+             '[%(default)s].')
+    track_g.add_argument(
+        '--state_sampler', default='dwi_ml', choices=['dwi_ml', 'torch'],
+        help='Interpolation of the signal around streamlines. \'torch\' '
+             'uses\nan in-project sampler doing a single gather per step '
+             '[%(default)s].')
+    track_g.add_argument(
+        '--max_stacked_size', type=float, default=2., metavar='GB',
+        help='With --state_sampler torch, precompute the corners of '
+             'every\nvoxel if they fit in this size (8 times the signal) '
+             '[%(default)s].')
+    track_g.add_argument(
+        '--sparse_volumes', action='store_true',
+        help='Only store the voxels of the signal and the peaks that are '
+             'not\nempty, and the masks as uint8. Implies '
+             '--state_sampler torch.')
+    track_g.add_argument(
+        '--crop_margin', type=int, default=None, metavar='VOX',
+        help='Crop the volumes to the bounding box of the masks, grown by '
+             'this\nmany voxels. Should cover how far out of the mask '
+             'streamlines\ncan go plus the support of the interpolation, '
+             'e.g. 8.\nVolumes are not cropped if not set.')
     parser.add_argument('--rng_seed', default=1337, type=int,
                         help='Random number generator seed [%(default)s].')
 
+    checkpoint_g = parser.add_argument_group('Checkpoint options')
+    checkpoint_g.add_argument('--checkpoint_dir', type=str, default=None,
+                              help='If set, track the seeds in chunks and '
+                              'write the streamlines of\neach chunk to this '
+                              'directory as soon as it is done.\nAn '
+                              'interrupted run started again with the same '
+                              'arguments\nonly tracks the remaining chunks. '
+                              'The chunks are deleted\nonce the output is '
+                              'written.')
+    checkpoint_g.add_argument('--chunk_size', type=int, default=1000000,
+                              metavar='N',
+                              help='Number of seeds per chunk '
+                              '[%(default)s].')
+
+    cache_g = parser.add_argument_group('Cache options')
+    cache_g.add_argument('--cache_dir', type=str, default=None,
+                         help='Directory in which to cache volumes derived '
+                         'from the inputs\n(converted SH, peaks, '
+                         'prefiltered mask). Repeated runs on\nthe same '
+                         'subject will load them instead of recomputing '
+                         'them.')
+    cache_g.add_argument('--cache_size', type=float, default=10.,
+                         metavar='GB',
+                         help='Maximum size of the cache. The least recently '
+                         'used volumes\nare deleted beyond it '
+                         '[%(default)s].')
+
 
 def verify_agent_option(parser, args):
 
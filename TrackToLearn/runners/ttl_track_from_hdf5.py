@@ -61,6 +61,9 @@ class TrackToLearnValidation(Experiment):
         self.oracle_validator = valid_dto['oracle_validator']
         self.oracle_stopping_criterion = \
             valid_dto['oracle_stopping_criterion']
+        self.oracle_cadence = valid_dto['oracle_cadence']
+        self.oracle_inference = valid_dto['oracle_inference']
+        self.oracle_server = valid_dto['oracle_server']
 
         # Tractometer parameters
         self.tractometer_validator = valid_dto['tractometer_validator']
@@ -75,8 +78,8 @@ class TrackToLearnValidation(Experiment):
             fa_image = nib.load(
                 valid_dto['fa_map'])
             self.fa_map = MRIDataVolume(
-                data=fa_image.get_fdata(),
-                affine_vox2rasmm=fa_image.affine)
+                affine_vox2rasmm=fa_image.affine,
+                compute=fa_image.get_fdata)
 
         with open(valid_dto['hyperparameters'], 'r') as json_file:
             hyperparams = json.load(json_file)
@@ -6,9 +6,9 @@ from tqdm import tqdm
 from typing import Tuple
 
 from dipy.tracking.streamlinespeed import compress_streamlines, length
-from nibabel.streamlines import Tractogram
+from nibabel.streamlines import ArraySequence, Tractogram
+from nibabel.streamlines.array_sequence import concatenate
 from nibabel.streamlines.tractogram import LazyTractogram
-from nibabel.streamlines.tractogram import TractogramItem
 
 from TrackToLearn.algorithms.rl import RLAlgorithm
 from TrackToLearn.algorithms.shared.utils import add_to_means
@@ -29,7 +29,8 @@ class Tracker(object):
         compress: float = 0.0,
         min_length: float = 20,
         max_length: float = 200,
-        save_seeds: bool = False
+        save_seeds: bool = False,
+        continuous: bool = False,
     ):
         """
 
@@ -49,6 +50,9 @@ class Tracker(object):
             Maximum length of a streamline.
         save_seeds: bool
             Save seeds in the tractogram.
+        continuous: bool
+            Replace streamlines by new seeds as soon as they stop instead of
+            waiting for the whole batch to be done.
         """
 
         self.alg = alg
@@ -58,11 +62,150 @@ class Tracker(object):
         self.min_length = min_length
         self.max_length = max_length
         self.save_seeds = save_seeds
+        self.continuous = continuous
+
+    def _track_batches(
+        self,
+        env: BaseEnv,
+    ):
+        """ Track every seed in the environment, batch by batch.
+
+        Arguments
+        ---------
+        env : BaseEnv
+            Environment to track in.
+
+        Yields
+        ------
+        tractogram: Tractogram
+            Streamlines tracked in the batch, in voxel space.
+        reward: float
+            Reward obtained while tracking the batch.
+        """
+
+        if self.continuous:
+            if len(env.seeds) == 0:
+                return
+
+            # Actors are refilled with new seeds as soon as their streamline
+            # stops, so "batches" are the streamlines stopping at each step.
+            with tqdm(total=len(env.seeds)) as pbar:
+                state = env.continuous_reset(
+                    0, len(env.seeds), self.n_actor)
+                for batch_tractogram, reward in \
+                        self.alg.continuous_validation_episode(
+                            state, env, self.prob):
+                    pbar.update(len(batch_tractogram))
+                    yield batch_tractogram, reward
+        else:
+            # Track for every seed in the environment. Batches might not be
+            # "full", at the end of the seeds or of a block of seeds.
+            for start, end in tqdm(env.seeds.batches(self.n_actor)):
+                state = env.reset(start, end)
+
+                # Track forward
+                reward = self.alg.validation_episode(
+                    state, env, self.prob)
+
+                yield env.get_streamlines(), reward
+
+    def _postprocess(
+        self,
+        tractogram: Tractogram,
+        affine: np.ndarray,
+        tracts_format,
+    ) -> Tractogram:
+        """ Filter a batch of streamlines by length, compress them and move
+        them to the space expected by the output format. The whole batch is
+        processed at once instead of one streamline at a time.
+
+        Arguments
+        ---------
+        tractogram : Tractogram
+            Batch of streamlines, in voxel space.
+        affine : `numpy.ndarray`
+            Voxel to RASMM affine.
+        tracts_format : TrkFile or TckFile
+            Tractogram format.
+
+        Returns
+        -------
+        tractogram: Tractogram
+            Streamlines of the batch kept and transformed, with their seed
+            if `save_seeds` is set.
+        """
+
+        # Presume iso vox
+        vox_size = np.mean(np.abs(affine)[np.diag_indices(4)][:3])
+        scaled_min_length = self.min_length / vox_size
+        scaled_max_length = self.max_length / vox_size
+
+        compress_th_vox = self.compress / vox_size
+
+        # dipy computes the length of every streamline in a single call
+        streamlines = tractogram.streamlines
+        lengths = length(streamlines)
+        keep = np.logical_and(scaled_min_length <= lengths,
+                              lengths <= scaled_max_length)
+
+        if self.compress:
+            streamlines = ArraySequence(compress_streamlines(
+                list(streamlines[keep]), compress_th_vox))
+        else:
+            streamlines = streamlines[keep].copy()
+
+        points = streamlines.get_data()
+        if tracts_format is TrkFile:
+            points += 0.5
+            points *= vox_size
+        else:
+            # Streamlines are dumped in true world space with
+            # origin center as expected by .tck files.
+            points = np.dot(points, affine[:3, :3]) + affine[:3, 3]
+        streamlines._data = points
+
+        data_per_streamline = {}
+        if self.save_seeds:
+            seeds = tractogram.data_per_streamline['seeds'][keep]
+            data_per_streamline = {'seeds': seeds - 0.5}
+
+        return Tractogram(
+            streamlines, data_per_streamline=data_per_streamline)
+
+    def track_chunks(
+        self,
+        env: BaseEnv,
+        tracts_format,
+    ):
+        """ Track every seed in the environment and yield the streamlines
+        batch by batch, ready to be written. See `track`.
+
+        Arguments
+        ---------
+        env : BaseEnv
+            Environment to track in.
+        tracts_format : TrkFile or TckFile
+            Tractogram format.
+
+        Yields
+        ------
+        tractogram: Tractogram
+            Streamlines of a batch, filtered by length, compressed and
+            moved to the space expected by `tracts_format`.
+        """
+
+        self.alg.agent.eval()
+
+        for batch_tractogram, _ in self._track_batches(env):
+            if len(batch_tractogram) == 0:
+                continue
+            yield self._postprocess(
+                batch_tractogram, env.affine_vox2rasmm, tracts_format)
 
     def track(
         self,
         env: BaseEnv,
-        tracts_format
+        tracts_format,
     ):
         """ Actual tracking function. Use this if you just want streamlines.
 
@@ -84,65 +227,16 @@ class Tracker(object):
 
         """
 
-        batch_size = self.n_actor
-
         self.alg.agent.eval()
         affine = env.affine_vox2rasmm
 
-        # Shuffle seeds so that massive tractograms wont load "sequentially"
-        # when partially displayed
-        np.random.shuffle(env.seeds)
+        # Seeds already come in random order (see `SeedSource`) so that
+        # massive tractograms wont load "sequentially" when partially
+        # displayed
 
         def tracking_generator():
-            # Presume iso vox
-            vox_size = np.mean(
-                np.abs(affine)[np.diag_indices(4)][:3])
-            scaled_min_length = self.min_length / vox_size
-            scaled_max_length = self.max_length / vox_size
-
-            compress_th_vox = self.compress / vox_size
-
-            # Track for every seed in the environment
-            for start in tqdm(range(0, len(env.seeds), batch_size)):
-                # Last batch might not be "full"
-                end = min(start + batch_size, len(env.seeds))
-
-                state = env.reset(start, end)
-
-                # Track forward
-                self.alg.validation_episode(
-                    state, env, self.prob)
-
-                batch_tractogram = env.get_streamlines()
-
-                for item in batch_tractogram:
-                    streamline = item.streamline
-                    if scaled_min_length <= length(streamline) \
-                            <= scaled_max_length:
-
-                        if self.compress:
-                            streamline = compress_streamlines(
-                                streamline, compress_th_vox)
-
-                        if tracts_format is TrkFile:
-                            streamline += 0.5
-                            streamline *= vox_size
-                        else:
-                            # Streamlines are dumped in true world space with
-                            # origin center as expected by .tck files.
-                            streamline = np.dot(
-                                streamline,
-                                affine[:3, :3]) + \
-                                affine[:3, 3]
-
-                        # flag = item.data_for_streamline['flags']
-                        seed_dict = {}
-                        if self.save_seeds:
-                            seed = item.data_for_streamline['seeds']
-                            seed_dict = {'seeds': seed-0.5}
-
-                        yield TractogramItem(
-                            streamline, seed_dict, {})
+            for chunk in self.track_chunks(env, tracts_format):
+                yield from chunk
 
         tractogram = LazyTractogram.from_data_func(tracking_generator)
         tractogram.affine_to_rasmm = affine
@@ -224,36 +318,28 @@ class Tracker(object):
         # Switch policy to eval mode so no gradients are computed
         self.alg.agent.eval()
 
-        # Initialize tractogram
-        tractogram = None
+        # Streamlines and data of each batch, only concatenated once at the
+        # end instead of growing the tractogram at every batch
+        streamlines = []
+        data_per_streamline = defaultdict(list)
 
         # Reward gotten during validation
         cummulative_reward = 0
 
-        def _generate_streamlines_and_rewards():
-
-            # Track for every seed in the environment
-            for i, start in enumerate(
-                    tqdm(range(0, len(env.seeds), self.n_actor))):
-
-                # Last batch might not be "full"
-                end = min(start + self.n_actor, len(env.seeds))
-
-                state = env.reset(start, end)
-
-                # Track forward
-                reward = self.alg.validation_episode(
-                    state, env, self.prob)
-
-                batch_tractogram = env.get_streamlines()
-
-                yield batch_tractogram, reward
-
-        for t, r in _generate_streamlines_and_rewards():
-            if tractogram is None and len(t) > 0:
-                tractogram = t
-            elif len(t) > 0:
-                tractogram += t
+        for t, r in self._track_batches(env):
+            if len(t) > 0:
+                streamlines.append(t.streamlines)
+                for key, value in t.data_per_streamline.items():
+                    data_per_streamline[key].append(value)
             cummulative_reward += r
 
+        # Initialize tractogram
+        tractogram = None
+        if len(streamlines) > 0:
+            tractogram = Tractogram(
+                concatenate(streamlines, axis=0),
+                data_per_streamline={
+                    key: np.concatenate(values)
+                    for key, values in data_per_streamline.items()})
+
         return tractogram,  cummulative_reward
@@ -70,6 +70,11 @@ class TrackToLearnTraining(Experiment):
         self.min_length = train_dto['min_length']
         self.max_length = train_dto['max_length']
         self.binary_stopping_threshold = train_dto['binary_stopping_threshold']
+        self.storage_precision = train_dto['storage_precision']
+        self.state_sampler = train_dto['state_sampler']
+        self.max_stacked_size = train_dto['max_stacked_size']
+        self.sparse_volumes = train_dto['sparse_volumes']
+        self.crop_margin = train_dto['crop_margin']
 
         # Reward parameters
         self.alignment_weighting = train_dto['alignment_weighting']
@@ -86,6 +91,9 @@ class TrackToLearnTraining(Experiment):
         self.oracle_bonus = train_dto['oracle_bonus']
         self.oracle_validator = train_dto['oracle_validator']
         self.oracle_stopping_criterion = train_dto['oracle_stopping_criterion']
+        self.oracle_cadence = train_dto['oracle_cadence']
+        self.oracle_inference = train_dto['oracle_inference']
+        self.oracle_server = train_dto['oracle_server']
 
         # Tractometer parameters
         self.tractometer_validator = train_dto['tractometer_validator']
@@ -146,6 +154,9 @@ class TrackToLearnTraining(Experiment):
             'oracle_bonus': self.oracle_bonus,
             'oracle_checkpoint': self.oracle_checkpoint,
             'oracle_stopping_criterion': self.oracle_stopping_criterion,
+            'oracle_cadence': self.oracle_cadence,
+            'oracle_inference': self.oracle_inference,
+            'oracle_server': self.oracle_server,
         }
 
     def save_hyperparameters(self):
@@ -222,7 +233,8 @@ class TrackToLearnTraining(Experiment):
                 dilate_endpoints=self.tractometer_dilate))
         if self.oracle_validator:
             self.validators.append(OracleValidator(
-                self.oracle_checkpoint, self.device))
+                self.oracle_checkpoint, self.device, self.oracle_inference,
+                self.oracle_server))
 
         # Run tracking before training to see what an untrained network does
         valid_env.load_subject()
@@ -234,11 +246,11 @@ class TrackToLearnTraining(Experiment):
             if self.use_comet:
                 self.comet_monitor.log_losses(stopping_stats, i_episode)
 
-            filename = self.save_rasmm_tractogram(valid_tractogram,
-                                                  valid_env.subject_id,
-                                                  valid_env.affine_vox2rasmm,
-                                                  valid_env.reference)
-            scores = self.score_tractogram(filename, valid_env)
+            sft = self.build_rasmm_sft(valid_tractogram,
+                                       valid_env.affine_vox2rasmm,
+                                       valid_env.reference)
+            scores = self.score_tractogram(sft, valid_env)
+            self.save_sft(sft, valid_env.subject_id, background=True)
             print(scores)
 
             if self.use_comet:
@@ -309,11 +321,11 @@ class TrackToLearnTraining(Experiment):
 
                 if self.use_comet:
                     self.comet_monitor.log_losses(stopping_stats, i_episode)
-                filename = self.save_rasmm_tractogram(
-                    valid_tractogram, valid_env.subject_id,
-                    valid_env.affine_vox2rasmm, valid_env.reference)
-                scores = self.score_tractogram(
-                    filename, valid_env)
+                sft = self.build_rasmm_sft(
+                    valid_tractogram, valid_env.affine_vox2rasmm,
+                    valid_env.reference)
+                scores = self.score_tractogram(sft, valid_env)
+                self.save_sft(sft, valid_env.subject_id, background=True)
                 print(scores)
 
                 # Display what the network is capable-of "now"
@@ -333,11 +345,11 @@ class TrackToLearnTraining(Experiment):
         if self.use_comet:
             self.comet_monitor.log_losses(stopping_stats, i_episode)
 
-        filename = self.save_rasmm_tractogram(valid_tractogram,
-                                              valid_env.subject_id,
-                                              valid_env.affine_vox2rasmm,
-                                              valid_env.reference)
-        scores = self.score_tractogram(filename, valid_env)
+        sft = self.build_rasmm_sft(valid_tractogram,
+                                   valid_env.affine_vox2rasmm,
+                                   valid_env.reference)
+        scores = self.score_tractogram(sft, valid_env)
+        self.save_sft(sft, valid_env.subject_id, background=True)
         print(scores)
 
         # Display what the network is capable-of "now"
@@ -348,6 +360,7 @@ class TrackToLearnTraining(Experiment):
             self.comet_monitor.log_losses(scores, i_episode)
 
         self.save_model(alg)
+        self.wait_for_save()
 
     def run(self):
         """ Prepare the environment, algorithm and trackers and run the
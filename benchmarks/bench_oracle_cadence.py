@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from bench_oracle_predict import random_checkpoint
+
+from TrackToLearn.environments.stopping_criteria import \
+    OracleStoppingCriterion
+from TrackToLearn.environments.streamline_buffer import StreamlineBuffer
+
+
+def track(criterion, n_streamlines, n_steps, rng):
+    """ Random-walk streamlines, stopping them with the oracle criterion.
+    Returns the number of predict calls, the time spent in the criterion
+    and the final lengths of the streamlines.
+    """
+    calls = [0]
+    predict = criterion.model.predict
+
+    def counted_predict(streamlines):
+        calls[0] += 1
+        return predict(streamlines)
+
+    criterion.model.predict = counted_predict
+
+    seeds = rng.uniform(40, 60, (n_streamlines, 3))
+    buffer = StreamlineBuffer.from_seeds(seeds, n_steps + 1)
+    idx = np.arange(n_streamlines)
+    t_oracle = 0.
+    for _ in range(n_steps):
+        if len(idx) == 0:
+            break
+        steps = rng.normal(size=(len(idx), 3))
+        steps *= 0.75 / np.linalg.norm(steps, axis=-1, keepdims=True)
+        buffer.append(idx, buffer[idx].last_points() + steps)
+
+        t = time.perf_counter()
+        stopping = criterion(buffer[idx])
+        t_oracle += time.perf_counter() - t
+        idx = idx[~stopping]
+
+    criterion.model.predict = predict
+    return calls[0], t_oracle, buffer.lengths
+
+
+def main():
+    """ Count how many times the oracle stopping criterion scores each
+    tracked streamline, and how long it takes, for several cadences.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='Oracle to use, one with random weights if '
+                             'not given.')
+    parser.add_argument('--n_streamlines', type=int, default=1000)
+    parser.add_argument('--n_steps', type=int, default=100)
+    parser.add_argument('--min_nb_steps', type=int, default=10)
+    parser.add_argument('--cadences', type=int, nargs='+',
+                        default=[1, 2, 5, 10])
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        checkpoint = args.checkpoint
+        if checkpoint is None:
+            checkpoint = os.path.join(tmp, 'oracle.ckpt')
+            random_checkpoint(checkpoint, 4, 4, bias=2.)
+
+        for cadence in args.cadences:
+            criterion = OracleStoppingCriterion(
+                checkpoint, args.min_nb_steps, np.eye(4), args.device,
+                cadence)
+            calls, t, lengths = track(
+                criterion, args.n_streamlines, args.n_steps,
+                np.random.RandomState(0))
+            print('cadence {:>3}: {:.2f} scores and {:.3f} predict calls '
+                  'per streamline, {:.1f}s, mean length {:.1f}'.format(
+                      cadence, criterion.n_scored / args.n_streamlines,
+                      calls / args.n_streamlines, t, np.mean(lengths)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from dipy.io.streamline import load_tractogram
+from nibabel.streamlines import ArraySequence
+
+from bench_oracle_predict import random_checkpoint
+
+from TrackToLearn.oracles.oracle import INFERENCE_MODES, OracleSingleton
+
+
+def main():
+    """ Compare the oracle run in reduced precision to fp32 on a held-out
+    tractogram: agreement of the decisions (score > 0.5), largest
+    difference of the scores and throughput.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='Oracle to use, one with random weights if '
+                             'not given.')
+    parser.add_argument('--tractogram', type=str, default=None,
+                        help='Held-out tractogram, random walks if not '
+                             'given.')
+    parser.add_argument('--reference', type=str, default='same',
+                        help='Reference of the tractogram.')
+    parser.add_argument('--n_streamlines', type=int, default=10000,
+                        help='Number of streamlines to score.')
+    parser.add_argument('--modes', type=str, nargs='+',
+                        default=INFERENCE_MODES, choices=INFERENCE_MODES)
+    parser.add_argument('--batch_size', type=int, default=4096)
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+
+    if args.tractogram:
+        sft = load_tractogram(args.tractogram, args.reference,
+                              bbox_valid_check=False)
+        sft.to_vox()
+        sft.to_corner()
+        streamlines = sft.streamlines[:args.n_streamlines]
+    else:
+        rng = np.random.RandomState(0)
+        streamlines = []
+        for length in rng.randint(20, 200, args.n_streamlines):
+            steps = rng.normal(size=(length, 3))
+            steps *= 0.75 / np.linalg.norm(steps, axis=-1, keepdims=True)
+            streamlines.append(np.cumsum(steps, axis=0).astype(np.float32))
+        streamlines = ArraySequence(streamlines)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        checkpoint = args.checkpoint
+        if checkpoint is None:
+            checkpoint = os.path.join(tmp, 'oracle.ckpt')
+            random_checkpoint(checkpoint, 4, 4)
+
+        reference = None
+        for mode in ['fp32'] + [m for m in args.modes if m != 'fp32']:
+            oracle = OracleSingleton(
+                checkpoint, args.device, args.batch_size, inference=mode)
+            oracle.predict(streamlines[:args.batch_size])
+            t = time.perf_counter()
+            scores = oracle.predict(streamlines)
+            t = time.perf_counter() - t
+            if reference is None:
+                reference = scores
+            print('{:>4}: {:>7.0f} streamlines/s, agreement {:.4f}, '
+                  'max difference {:.4f}'.format(
+                      mode, len(streamlines) / t,
+                      np.mean((scores > 0.5) == (reference > 0.5)),
+                      np.max(np.abs(scores - reference))))
+
+
+if __name__ == '__main__':
+    main()
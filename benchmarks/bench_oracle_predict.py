@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from nibabel.streamlines import ArraySequence
+
+from TrackToLearn.oracles.oracle import OracleSingleton
+from TrackToLearn.oracles.transformer_oracle import TransformerOracle
+
+
+def random_checkpoint(path, n_head, n_layers, bias=0.):
+    """ Save an oracle with random weights. The bias of its head shifts
+    its scores, a large bias making it accept most streamlines.
+    """
+    model = TransformerOracle(127 * 3, 1, n_head, n_layers, 1e-3)
+    torch.nn.init.constant_(model.head.bias, bias)
+    torch.save({'hyper_parameters': {
+        'name': 'TransformerOracle', 'input_size': 127 * 3,
+        'output_size': 1, 'n_head': n_head, 'n_layers': n_layers,
+        'lr': 1e-3}, 'state_dict': model.state_dict()}, path)
+
+
+def main():
+    """ Measure the throughput of `OracleSingleton.predict` for several
+    batch sizes, with streamlines resampled by the caller between batches
+    (0 workers) or by a pool of threads while the model runs.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='Oracle to use, one with random weights if '
+                             'not given.')
+    parser.add_argument('--n_head', type=int, default=4)
+    parser.add_argument('--n_layers', type=int, default=4)
+    parser.add_argument('--n_streamlines', type=int, default=50000)
+    parser.add_argument('--batch_sizes', type=int, nargs='+',
+                        default=[512, 1024, 4096, 8192])
+    parser.add_argument('--num_workers', type=int, nargs='+',
+                        default=[0, 1, 2, 4])
+    parser.add_argument('--n_repeats', type=int, default=3)
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    # Random walks of 20 to 200 steps of 0.75 voxel
+    streamlines = []
+    for length in rng.randint(20, 200, args.n_streamlines):
+        steps = rng.normal(size=(length, 3))
+        steps *= 0.75 / np.linalg.norm(steps, axis=-1, keepdims=True)
+        streamlines.append(np.cumsum(steps, axis=0).astype(np.float32))
+    streamlines = ArraySequence(streamlines)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        checkpoint = args.checkpoint
+        if checkpoint is None:
+            checkpoint = os.path.join(tmp, 'oracle.ckpt')
+            random_checkpoint(checkpoint, args.n_head, args.n_layers)
+
+        for batch_size in args.batch_sizes:
+            for num_workers in args.num_workers:
+                oracle = OracleSingleton(
+                    checkpoint, args.device, batch_size, num_workers)
+                oracle.predict(streamlines[:batch_size])
+                times = []
+                for _ in range(args.n_repeats):
+                    t = time.perf_counter()
+                    oracle.predict(streamlines)
+                    times.append(time.perf_counter() - t)
+                print('batch size {:>5}, {} workers: {:>8.0f} '
+                      'streamlines/s'.format(
+                          batch_size, num_workers,
+                          len(streamlines) / min(times)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+import argparse
+import multiprocessing as mp
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from nibabel.streamlines import ArraySequence
+
+from bench_oracle_predict import random_checkpoint
+
+from TrackToLearn.oracles.oracle import OracleSingleton
+from TrackToLearn.oracles.oracle_server import OracleClient, OracleServer
+
+
+def random_walks(n_streamlines, seed):
+    """ Random walks of 20 to 200 steps of 0.75 voxel. """
+    rng = np.random.RandomState(seed)
+    streamlines = []
+    for length in rng.randint(20, 200, n_streamlines):
+        steps = rng.normal(size=(length, 3))
+        steps *= 0.75 / np.linalg.norm(steps, axis=-1, keepdims=True)
+        streamlines.append(np.cumsum(steps, axis=0).astype(np.float32))
+    return ArraySequence(streamlines)
+
+
+def client(oracle, args, seed, start, times):
+    """ Score streamlines in small requests, like a tracking process
+    scoring the streamlines it tracks.
+    """
+    if oracle is None:
+        oracle = OracleClient(args.address)
+    else:
+        oracle = OracleSingleton(oracle, args.device, args.batch_size)
+    streamlines = random_walks(args.n_streamlines, seed)
+    start.wait()
+    t = time.perf_counter()
+    for i in range(0, len(streamlines), args.request_size):
+        oracle.predict(streamlines[i:i + args.request_size])
+    times.put(time.perf_counter() - t)
+
+
+def run(checkpoint, args):
+    """ Run the clients together, each with its own oracle if a checkpoint
+    is given or with the server otherwise. Returns the wall time.
+    """
+    ctx = mp.get_context('spawn')
+    start, times = ctx.Event(), ctx.Queue()
+    clients = [ctx.Process(target=client,
+                           args=(checkpoint, args, seed, start, times))
+               for seed in range(args.n_clients)]
+    for p in clients:
+        p.start()
+    # Let the clients load their oracle before starting the clock
+    time.sleep(args.warmup)
+    start.set()
+    t = max(times.get() for _ in clients)
+    for p in clients:
+        p.join()
+    return t
+
+
+def main():
+    """ Compare several processes scoring streamlines each with their own
+    oracle to the same processes sharing an `OracleServer`, which merges
+    their requests in larger batches.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='Oracle to use, one with random weights if '
+                             'not given.')
+    parser.add_argument('--n_clients', type=int, default=4)
+    parser.add_argument('--n_streamlines', type=int, default=5000,
+                        help='Number of streamlines scored by each client.')
+    parser.add_argument('--request_size', type=int, default=500,
+                        help='Number of streamlines per request.')
+    parser.add_argument('--batch_size', type=int, default=4096)
+    parser.add_argument('--warmup', type=float, default=10.,
+                        help='Time, in seconds, given to the clients to '
+                             'load their oracle.')
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        checkpoint = args.checkpoint
+        if checkpoint is None:
+            checkpoint = os.path.join(tmp, 'oracle.ckpt')
+            random_checkpoint(checkpoint, 4, 4)
+        # Outside of the temporary directory, the server removes its
+        # socket when the benchmark exits
+        args.address = os.path.join(
+            tempfile.gettempdir(), 'oracle_{}.sock'.format(os.getpid()))
+
+        n = args.n_clients * args.n_streamlines
+        t = run(checkpoint, args)
+        print('{:>2} oracles: {:>7.0f} streamlines/s'.format(
+            args.n_clients, n / t))
+
+        server = OracleServer(
+            checkpoint, args.address, args.device, args.batch_size)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        while not os.path.exists(args.address):
+            time.sleep(0.1)
+        t = run(None, args)
+        print(' 1 server:  {:>7.0f} streamlines/s, {:.0f} streamlines per '
+              'batch'.format(n / t, server.n_scored / server.n_batches))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from dwi_ml.data.processing.space.neighborhood import \
+    get_neighborhood_vectors_axes
+from dwi_ml.data.processing.volume.interpolation import \
+    interpolate_volume_in_neighborhood
+
+from TrackToLearn.environments.seed_source import SeedSource
+from TrackToLearn.environments.stopping_criteria import \
+    BinaryStoppingCriterion
+from TrackToLearn.environments.streamline_buffer import StreamlineBuffer
+
+
+def bench(volume, criterion, neighborhood, seeds, n_actor, n_steps, rng):
+    """ Time the state interpolation and the mask criterion while
+    random-walking from every batch of seeds.
+    """
+    t_state = t_mask = 0.
+    for start in range(0, len(seeds), n_actor):
+        batch = seeds[start:start + n_actor]
+        buffer = StreamlineBuffer.from_seeds(batch, n_steps + 1)
+        idx = np.arange(len(batch))
+        for _ in range(n_steps):
+            steps = rng.normal(size=(len(batch), 3))
+            steps *= 0.75 / np.linalg.norm(steps, axis=-1, keepdims=True)
+            buffer.append(idx, buffer[idx].last_points() + steps)
+
+            t = time.perf_counter()
+            coords = torch.as_tensor(buffer[idx].last_points())
+            interpolate_volume_in_neighborhood(volume, coords, neighborhood)
+            t_state += time.perf_counter() - t
+
+            t = time.perf_counter()
+            criterion(buffer[idx])
+            t_mask += time.perf_counter() - t
+
+    return t_state, t_mask
+
+
+def main():
+    """ Compare the time spent interpolating the state and the tracking
+    mask when seeds are tracked in random order or grouped spatially along
+    a Morton curve (see `SeedSource`).
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--shape', type=int, nargs=3, default=[128] * 3)
+    parser.add_argument('--n_coefs', type=int, default=28)
+    parser.add_argument('--npv', type=int, default=1)
+    parser.add_argument('--n_actor', type=int, default=10000)
+    parser.add_argument('--n_steps', type=int, default=10)
+    parser.add_argument('--n_seeds', type=int, default=200000,
+                        help='Only track the first seeds.')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    grid = np.stack(np.meshgrid(
+        *[np.arange(s) for s in args.shape], indexing='ij'), -1)
+    radius = np.linalg.norm(
+        (grid - np.asarray(args.shape) / 2.) / np.asarray(args.shape), axis=-1)
+    mask = (radius < 0.45).astype(float)
+
+    volume = torch.from_numpy(rng.rand(
+        *args.shape, args.n_coefs).astype(np.float32))
+    criterion = BinaryStoppingCriterion(mask, 0.5)
+    neighborhood = torch.cat((torch.zeros((1, 3)),
+                              get_neighborhood_vectors_axes(1, 1.)))
+
+    for order in ['random', 'morton']:
+        source = SeedSource(mask, args.npv, random_seed=0, order=order,
+                            block_size=max(1, args.n_actor // args.npv))
+        seeds = source[:args.n_seeds]
+        t_state, t_mask = bench(
+            volume, criterion, neighborhood, seeds, args.n_actor,
+            args.n_steps, np.random.RandomState(1))
+        print('{:>7}: state {:.3f}s, mask {:.3f}s'.format(
+            order, t_state, t_mask))
+
+
+if __name__ == '__main__':
+    main()
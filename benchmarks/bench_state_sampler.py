@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from dwi_ml.data.processing.space.neighborhood import \
+    get_neighborhood_vectors_axes
+from dwi_ml.data.processing.volume.interpolation import \
+    interpolate_volume_in_neighborhood
+
+from TrackToLearn.environments.interpolation import NeighborhoodSampler
+
+
+def timeit(fn, coords, n_repeats):
+    """ Best time of `n_repeats` calls. """
+    fn(coords)
+    times = []
+    for _ in range(n_repeats):
+        if coords.is_cuda:
+            torch.cuda.synchronize()
+        t = time.perf_counter()
+        fn(coords)
+        if coords.is_cuda:
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - t)
+    return min(times)
+
+
+def main():
+    """ Time the interpolation of the state of a batch of streamlines with
+    dwi_ml and with `NeighborhoodSampler`, with and without stacking the
+    corners of the volume.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--shape', type=int, nargs=3, default=[128] * 3)
+    parser.add_argument('--n_coefs', type=int, default=28)
+    parser.add_argument('--n_actor', type=int, default=10000)
+    parser.add_argument('--n_repeats', type=int, default=20)
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    rng = np.random.RandomState(0)
+    volume = torch.from_numpy(rng.rand(
+        *args.shape, args.n_coefs).astype(np.float32)).to(device)
+    neighborhood = torch.cat((
+        torch.zeros((1, 3)),
+        get_neighborhood_vectors_axes(1, 0.375))).to(device)
+    coords = torch.from_numpy(rng.uniform(
+        0, np.asarray(args.shape), (args.n_actor, 3)).astype(
+            np.float32)).to(device)
+
+    samplers = {
+        'dwi_ml': lambda c: interpolate_volume_in_neighborhood(
+            volume, c, neighborhood)[0],
+        'torch': NeighborhoodSampler(volume, neighborhood),
+    }
+    t = time.perf_counter()
+    samplers['stacked'] = NeighborhoodSampler(
+        volume, neighborhood, float('inf'))
+    print('stacking: {:.3f}s'.format(time.perf_counter() - t))
+
+    for name, sampler in samplers.items():
+        print('{:>8}: {:.2f}ms per step'.format(
+            name, 1000 * timeit(sampler, coords, args.n_repeats)))
+
+
+if __name__ == '__main__':
+    main()
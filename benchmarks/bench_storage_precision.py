@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+import argparse
+
+import nibabel as nib
+import numpy as np
+import torch
+
+from TrackToLearn.datasets.utils import MRIDataVolume
+from TrackToLearn.environments.env import STORAGE_DTYPES
+from TrackToLearn.environments.tracking_env import TrackingEnvironment
+
+
+def make_subject(shape, n_coefs, dtype, rng):
+    """ Spherical mask filled with a smooth random signal. """
+    grid = np.stack(np.meshgrid(
+        *[np.arange(s) for s in shape], indexing='ij'), -1)
+    radius = np.linalg.norm(
+        (grid - np.asarray(shape) / 2.) / np.asarray(shape), axis=-1)
+    mask = (radius < 0.45).astype(float)
+    # Sum of a few low frequency waves per coefficient
+    signal = np.zeros((*shape, n_coefs), dtype=np.float32)
+    for _ in range(4):
+        freq = rng.uniform(0, 0.3, (3, n_coefs))
+        phase = rng.uniform(0, 2 * np.pi, n_coefs)
+        signal += np.sin(grid @ freq + phase)
+    signal *= mask[..., None]
+    peaks = rng.randn(*shape, 15).astype(np.float32) * mask[..., None]
+
+    if dtype is not None:
+        signal, peaks = signal.astype(dtype), peaks.astype(dtype)
+    seeding = (radius < 0.4) & (radius > 0.35)
+    return (MRIDataVolume(signal, np.eye(4)), MRIDataVolume(mask, np.eye(4)),
+            MRIDataVolume(seeding.astype(float), np.eye(4)),
+            MRIDataVolume(peaks, np.eye(4)),
+            nib.Nifti1Image(mask.astype(np.float32), np.eye(4)))
+
+
+def track(env, weights, n_actor):
+    """ Track all seeds with a fixed linear policy. """
+    streamlines = []
+    for start in range(0, len(env.seeds), n_actor):
+        state = env.reset(start, min(start + n_actor, len(env.seeds)))
+        while len(state) > 0:
+            actions = torch.tanh(state.cpu() @ weights)
+            env.step(actions.numpy())
+            state, _ = env.harvest()
+        streamlines.extend(env.get_streamlines().streamlines)
+    return streamlines
+
+
+def main():
+    """ Track with the input signal stored in each precision and report
+    the memory of the signal and how much the streamlines moved compared to
+    float32.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--shape', type=int, nargs=3, default=[64] * 3)
+    parser.add_argument('--n_coefs', type=int, default=28)
+    parser.add_argument('--npv', type=int, default=1)
+    parser.add_argument('--n_actor', type=int, default=10000)
+    args = parser.parse_args()
+
+    results = {}
+    for precision in ['fp32', 'fp16', 'bf16']:
+        rng = np.random.RandomState(0)
+        subject = make_subject(
+            args.shape, args.n_coefs, STORAGE_DTYPES[precision][0], rng)
+        env_dto = {
+            'dataset_file': None, 'fa_map': None, 'n_dirs': 4,
+            'step_size': 0.75, 'theta': 30, 'min_length': 2.,
+            'max_length': 100., 'noise': 0., 'npv': args.npv,
+            'rng': np.random.RandomState(1), 'alignment_weighting': 1.,
+            'oracle_bonus': 0., 'oracle_validator': False,
+            'oracle_stopping_criterion': False, 'oracle_checkpoint': None,
+            'scoring_data': None, 'tractometer_validator': False,
+            'binary_stopping_threshold': 0.1, 'compute_reward': False,
+            'device': torch.device('cpu'), 'target_sh_order': None,
+            'storage_precision': precision}
+        env = TrackingEnvironment(subject, 'testing', env_dto)
+        weights = torch.from_numpy(np.random.RandomState(2).randn(
+            env.get_state_size(), 3).astype(np.float32)) * 0.3
+        env.load_subject()
+
+        memory = env.data_volume.element_size() * env.data_volume.nelement()
+        results[precision] = track(env, weights, args.n_actor)
+
+        reference = results['fp32']
+        same_length = [len(s) == len(r)
+                       for s, r in zip(results[precision], reference)]
+        # Distance between points, up to the shortest of both streamlines
+        distances = np.concatenate([
+            np.linalg.norm(s[:len(r)] - r[:len(s)], axis=-1)
+            for s, r in zip(results[precision], reference)])
+        print('{}: signal {:.1f} MB, {:.1%} of streamlines with the same '
+              'length, mean distance {:.2e} vox, median {:.2e} vox'.format(
+                  precision, memory / 1024 ** 2, np.mean(same_length),
+                  np.mean(distances), np.median(distances)))
+
+
+if __name__ == '__main__':
+    main()
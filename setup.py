@@ -88,6 +88,7 @@ setup(
     entry_points={
         'console_scripts': [
             "ttl_track.py=TrackToLearn.runners.ttl_track:main",
+            "ttl_oracle_server.py=TrackToLearn.runners.ttl_oracle_server:main", # noqa E501
             "ttl_track_from_hdf5.py=TrackToLearn.runners.ttl_track_from_hdf5:main"] # noqa E501
     },
     include_package_data=True,
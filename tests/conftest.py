@@ -0,0 +1,107 @@
+import nibabel as nib
+import numpy as np
+import pytest
+import torch
+
+from dipy.tracking.streamline import set_number_of_points
+
+from TrackToLearn.environments.streamline_buffer import (
+    StreamlineBuffer, TorchStreamlineBuffer)
+from TrackToLearn.oracles.transformer_oracle import TransformerOracle
+
+
+def _random_buffers(rng, shape, n_streamlines=200, max_nb_points=6):
+    # Random walks of various lengths, in both buffer flavours
+    seeds = rng.uniform(1, np.asarray(shape) - 1, (n_streamlines, 3))
+    steps = rng.normal(0, 0.5, (n_streamlines, max_nb_points - 1, 3))
+    points = np.cumsum(
+        np.concatenate((seeds[:, None], steps), axis=1), axis=1)
+    lengths = rng.randint(1, max_nb_points + 1, n_streamlines)
+
+    buffer = StreamlineBuffer(n_streamlines, max_nb_points)
+    buffer.data[:] = points
+    buffer.lengths[:] = lengths
+
+    torch_buffer = TorchStreamlineBuffer(n_streamlines, max_nb_points)
+    torch_buffer.data[:] = torch.from_numpy(buffer.data)
+    torch_buffer.lengths[:] = torch.from_numpy(lengths)
+
+    idx = np.arange(n_streamlines)
+    return buffer[idx], torch_buffer[idx]
+
+
+@pytest.fixture
+def random_buffers():
+    """ Factory of views of random walks, see `_random_buffers`. """
+    return _random_buffers
+
+
+def _random_oracle(path, streamlines=None):
+    # Checkpoint of an oracle with random weights. With `streamlines`, its
+    # bias is set so that it scores about half of them below 0.5.
+    torch.manual_seed(0)
+    model = TransformerOracle(127 * 3, 1, 4, 1, 1e-3).eval()
+    if streamlines is not None:
+        with torch.no_grad():
+            scores = model(torch.as_tensor(np.diff(np.asarray(
+                set_number_of_points(list(streamlines), 128)), axis=1),
+                dtype=torch.float32))
+            model.head.bias -= torch.logit(torch.median(scores))
+    torch.save({'hyper_parameters': {
+        'name': 'TransformerOracle', 'input_size': 127 * 3,
+        'output_size': 1, 'n_head': 4, 'n_layers': 1, 'lr': 1e-3},
+        'state_dict': model.state_dict()}, path)
+    return str(path)
+
+
+@pytest.fixture
+def random_oracle(tmp_path):
+    """ Factory of oracle checkpoints in `tmp_path`, see `_random_oracle`.
+    """
+    def random_oracle(streamlines=None, name='oracle.ckpt'):
+        return _random_oracle(tmp_path / name, streamlines)
+    return random_oracle
+
+
+def _tracking_subject(rng):
+    # Sphere of random signal and peaks, seeded on a shell
+    from TrackToLearn.datasets.utils import MRIDataVolume
+
+    grid = np.stack(np.meshgrid(*[np.arange(20)] * 3, indexing='ij'), -1)
+    radius = np.linalg.norm(grid - 10., axis=-1)
+    mask = (radius < 8).astype(float)
+    signal = rng.rand(20, 20, 20, 28).astype(np.float32) * mask[..., None]
+    peaks = rng.randn(20, 20, 20, 15).astype(np.float32) * mask[..., None]
+    return (
+        MRIDataVolume(signal, np.eye(4)), MRIDataVolume(mask, np.eye(4)),
+        MRIDataVolume((radius > 6) * mask, np.eye(4)),
+        MRIDataVolume(peaks, np.eye(4)),
+        nib.Nifti1Image(mask.astype(np.float32), np.eye(4)))
+
+
+def _env_dto(**kwargs):
+    # Arguments of the test environments, without noise nor oracle
+    env_dto = {
+        'dataset_file': None, 'fa_map': None, 'n_dirs': 2,
+        'step_size': 0.75, 'theta': 30, 'min_length': 2.,
+        'max_length': 20., 'noise': 0., 'npv': 1,
+        'rng': np.random.RandomState(1), 'alignment_weighting': 1.,
+        'oracle_bonus': 0., 'oracle_validator': False,
+        'oracle_stopping_criterion': False, 'oracle_checkpoint': None,
+        'scoring_data': None, 'tractometer_validator': False,
+        'binary_stopping_threshold': 0.1, 'compute_reward': True,
+        'device': torch.device('cpu'), 'target_sh_order': None}
+    env_dto.update(kwargs)
+    return env_dto
+
+
+@pytest.fixture
+def tracking_subject():
+    """ Factory of subjects to track in, see `_tracking_subject`. """
+    return _tracking_subject
+
+
+@pytest.fixture
+def env_dto():
+    """ Factory of environment arguments, see `_env_dto`. """
+    return _env_dto
@@ -0,0 +1,107 @@
+import os
+
+import numpy as np
+import pytest
+
+from TrackToLearn.datasets.cache import VolumeCache
+
+
+def test_get(tmp_path):
+    # A miss should compute and store the volume, a hit should load it
+    # without computing it again
+    cache = VolumeCache(str(tmp_path / 'cache'))
+    volume = np.random.RandomState(0).rand(4, 5, 6)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return volume
+
+    key = cache.key('volume')
+    assert np.array_equal(cache.get(key, compute), volume)
+    cached = cache.get(key, compute)
+    assert len(calls) == 1
+    assert isinstance(cached, np.memmap)
+    assert np.array_equal(cached, volume)
+
+    # A partially written file is computed again
+    with open(cache._path(key), 'wb') as f:
+        f.write(b'\x93NUMPY')
+    assert np.array_equal(cache.get(key, compute), volume)
+    assert len(calls) == 2
+
+
+def test_key(tmp_path):
+    # Keys should change with the contents of the inputs and the crop of
+    # the volume
+    for name, content in [('a', b'signal'), ('b', b'signal'),
+                          ('c', b'other')]:
+        (tmp_path / name).write_bytes(content)
+    a, b, c = (VolumeCache.hash_file(str(tmp_path / name))
+               for name in 'abc')
+    assert a == b != c
+
+    bbox = (slice(1, 5), slice(0, 4), slice(2, 6))
+    other = (slice(1, 5), slice(0, 4), slice(2, 7))
+    assert VolumeCache.key(a, 'peaks', bbox) == \
+        VolumeCache.key(b, 'peaks', bbox)
+    assert len({VolumeCache.key(a, 'peaks'), VolumeCache.key(c, 'peaks'),
+                VolumeCache.key(a, 'peaks', bbox),
+                VolumeCache.key(a, 'peaks', other)}) == 4
+
+    mask = np.zeros((4, 4))
+    assert VolumeCache.key(mask) != VolumeCache.key(mask.astype(np.uint8))
+    assert VolumeCache.key(mask) != VolumeCache.key(mask.reshape(2, 8))
+
+
+def test_atomic_write(tmp_path, monkeypatch):
+    # Volumes should be written to a temporary file and moved in place,
+    # so that a failed write never leaves a volume to load
+    cache = VolumeCache(str(tmp_path))
+    key = cache.key('volume')
+    replaced = []
+    replace = os.replace
+
+    def checked(src, dst):
+        assert os.path.dirname(src) == str(tmp_path)
+        assert dst == cache._path(key) and not os.path.exists(dst)
+        replaced.append(dst)
+        replace(src, dst)
+
+    monkeypatch.setattr(os, 'replace', checked)
+    cache.get(key, lambda: np.ones(3))
+    assert replaced == [cache._path(key)]
+    assert os.listdir(str(tmp_path)) == [os.path.basename(replaced[0])]
+
+    def failing(*args):
+        raise OSError
+
+    monkeypatch.setattr(os, 'replace', failing)
+    other = cache.key('other')
+    with pytest.raises(OSError):
+        cache.get(other, lambda: np.ones(3))
+    assert not os.path.exists(cache._path(other))
+
+
+def test_evict(tmp_path):
+    # Over its maximum size, the cache should delete the least recently
+    # used volumes first
+    volume = np.zeros(1000)
+    cache = VolumeCache(str(tmp_path))
+    cache.get('size', lambda: volume)
+    size = os.path.getsize(cache._path('size'))
+    os.remove(cache._path('size'))
+    # Room for two volumes
+    cache.max_size = int(2.5 * size)
+
+    for i, key in enumerate('abc'):
+        cache.get(key, lambda: volume)
+        os.utime(cache._path(key), (i, i))
+    assert not os.path.exists(cache._path('a'))
+
+    # Loading b makes c the least recently used
+    cache.get('b', lambda: volume)
+    cache.get('d', lambda: volume)
+    assert os.path.exists(cache._path('b'))
+    assert not os.path.exists(cache._path('c'))
+    assert os.path.exists(cache._path('d'))
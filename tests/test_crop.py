@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip('scilpy')
+
+from TrackToLearn.datasets.utils import (  # noqa: E402
+    MRIDataVolume, bounding_box)
+from TrackToLearn.environments.interpolation import (  # noqa: E402
+    NeighborhoodSampler)
+from TrackToLearn.environments.local_reward import (  # noqa: E402
+    PeaksAlignmentReward)
+from TrackToLearn.environments.stopping_criteria import (  # noqa: E402
+    BinaryStoppingCriterion)
+
+
+def test_crop(random_buffers):
+    # Volumes cropped around the mask should give the same values as the
+    # whole ones for streamlines inside the mask
+    rng = np.random.RandomState(0)
+    mask = np.zeros((16, 16, 16))
+    mask[4:11, 5:12, 3:10] = rng.rand(7, 7, 7) > 0.2
+    volume = rng.randn(16, 16, 16, 15).astype(np.float32)
+    bbox = bounding_box(mask, margin=2)
+    cropped_mask = MRIDataVolume(mask).crop(bbox)
+    cropped = MRIDataVolume(volume).crop(bbox)
+    assert cropped.shape == (11, 11, 11, 15)
+    assert np.array_equal(cropped_mask.origin, [2, 3, 1])
+
+    view, _ = random_buffers(rng, (5, 5, 5))
+    view.buffer.data[:] += [5, 6, 4]
+
+    neighborhood = torch.tensor([[0., 0., 0.], [0.4, 0., 0.]])
+    coords = torch.from_numpy(view.last_points()).float()
+    sampler = NeighborhoodSampler(torch.from_numpy(volume), neighborhood)
+    cropped_sampler = NeighborhoodSampler(
+        torch.from_numpy(cropped.data), neighborhood,
+        origin=torch.from_numpy(cropped.origin))
+    assert np.array_equal(sampler(coords), cropped_sampler(coords))
+
+    binary = BinaryStoppingCriterion(mask, 0.5)
+    cropped_binary = BinaryStoppingCriterion(
+        cropped_mask.data, 0.5, origin=cropped_mask.origin,
+        grid_shape=cropped_mask.grid_shape)
+    assert np.array_equal(binary(view), cropped_binary(view))
+
+    dones = np.zeros(len(view), dtype=bool)
+    rewards = PeaksAlignmentReward(MRIDataVolume(volume))(view, dones)
+    cropped_rewards = PeaksAlignmentReward(cropped)(view, dones)
+    assert np.array_equal(rewards, cropped_rewards)
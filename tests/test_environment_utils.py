@@ -0,0 +1,59 @@
+import nibabel as nib
+import numpy as np
+import pytest
+import torch
+
+from dipy.io.stateful_tractogram import Space, StatefulTractogram
+from dipy.tracking.streamline import set_number_of_points
+from nibabel.streamlines import Tractogram
+from scipy.spatial.transform import Rotation
+
+pytest.importorskip('scilpy')
+
+from TrackToLearn.environments.utils import (  # noqa: E402
+    to_oracle_space, torch_to_oracle_space)
+from TrackToLearn.oracles.oracle import (  # noqa: E402
+    torch_set_number_of_points)
+
+
+def _affine(rng, zooms):
+    # Rotated, anisotropic and translated affine
+    affine = np.eye(4)
+    affine[:3, :3] = Rotation.random(random_state=rng).as_matrix() * zooms
+    affine[:3, 3] = rng.uniform(-50, 50, 3)
+    return affine
+
+
+def _features(streamlines):
+    # What the oracle sees of the streamlines
+    return np.diff(np.asarray(set_number_of_points(streamlines, 128)), axis=1)
+
+
+def test_to_oracle_space(random_buffers):
+    # The oracle should see the same streamlines as when they were moved to
+    # the voxel-corner space of the reference through a StatefulTractogram
+    rng = np.random.RandomState(0)
+    affine_vox2rasmm = _affine(rng, [1.25, 1.25, 2.5])
+    reference = nib.Nifti1Image(
+        np.zeros((20, 20, 20), dtype=np.float32), _affine(rng, [1., 2., 1.]))
+    affine_vox2oracle = np.dot(
+        np.linalg.inv(reference.affine), affine_vox2rasmm)
+    affine_vox2oracle[:3, 3] += 0.5
+
+    view, torch_view = random_buffers(rng, (10, 10, 10))
+    longer = view.lengths > 1
+    view, torch_view = view[longer], torch_view[torch.from_numpy(longer)]
+
+    tractogram = Tractogram(view.to_array_sequence())
+    tractogram.apply_affine(affine_vox2rasmm)
+    sft = StatefulTractogram(tractogram.streamlines, reference, Space.RASMM)
+    sft.to_vox()
+    sft.to_corner()
+    expected = _features(sft.streamlines)
+
+    features = _features(to_oracle_space(view, affine_vox2oracle))
+    assert np.allclose(features, expected, atol=1e-4)
+
+    points, lengths = torch_to_oracle_space(torch_view, affine_vox2oracle)
+    resampled = torch_set_number_of_points(points, lengths, 128).numpy()
+    assert np.allclose(np.diff(resampled, axis=1), expected, atol=1e-4)
@@ -0,0 +1,84 @@
+from types import SimpleNamespace
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from dipy.io.stateful_tractogram import Origin, Space
+from dipy.tracking.streamline import set_number_of_points
+from nibabel.streamlines import Tractogram
+
+pytest.importorskip('scilpy')
+
+from TrackToLearn.datasets.utils import MRIDataVolume  # noqa: E402
+from TrackToLearn.experiment.experiment import Experiment  # noqa: E402
+from TrackToLearn.experiment.oracle_validator import (  # noqa: E402
+    OracleValidator)
+
+
+def _experiment(tmp_path):
+    experiment = Experiment()
+    experiment.experiment_path = str(tmp_path)
+    experiment.experiment = 'test'
+    experiment.name = 'test'
+    return experiment
+
+
+def _tractogram(rng):
+    # Random walks inside a 20x20x20 volume, in voxel space
+    walks = np.cumsum(rng.normal(0, 0.5, (100, 20, 3)), axis=1) + 10.
+    return Tractogram(np.clip(walks, 1., 19.).astype(np.float32),
+                      affine_to_rasmm=np.eye(4))
+
+
+def test_score_tractogram(tmp_path, random_oracle):
+    # Validators should score a tractogram in memory as they would once
+    # saved and reloaded, and leave it in the space it is saved in
+    rng = np.random.RandomState(0)
+    affine = np.diag([2., 2., 2., 1.])
+    mask = np.ones((20, 20, 20), dtype=np.float32)
+    env = SimpleNamespace(
+        reference=nib.Nifti1Image(mask, affine),
+        tracking_mask=MRIDataVolume(mask, affine))
+
+    experiment = _experiment(tmp_path)
+    validator = OracleValidator(random_oracle(), 'cpu')
+    experiment.validators = [validator]
+
+    sft = experiment.build_rasmm_sft(
+        _tractogram(rng), affine, env.reference)
+    assert sft.space == Space.RASMM and sft.origin == Origin.NIFTI
+    streamlines = sft.streamlines.copy()
+
+    scores = experiment.score_tractogram(sft, env)
+    assert sft.space == Space.RASMM and sft.origin == Origin.NIFTI
+    assert np.allclose(sft.streamlines.get_data(), streamlines.get_data(),
+                       atol=1e-4)
+
+    filename = experiment.save_sft(sft, 'subject', background=True)
+    experiment.wait_for_save()
+    assert scores == experiment.score_tractogram(filename, env)
+
+    # The oracle saw the streamlines in the voxel-corner space
+    sft.to_vox()
+    sft.to_corner()
+    predictions = validator.model.predict(
+        set_number_of_points(sft.streamlines, 128))
+    assert scores['Oracle'] == np.mean(predictions > 0.5)
+
+
+def test_save_sft_error(tmp_path):
+    # An error of the background write should be raised when it is waited
+    # for
+    rng = np.random.RandomState(0)
+    affine = np.eye(4)
+    reference = nib.Nifti1Image(np.ones((20, 20, 20), np.float32), affine)
+
+    experiment = _experiment(tmp_path / 'missing')
+    sft = experiment.build_rasmm_sft(_tractogram(rng), affine, reference)
+    experiment.save_sft(sft, 'subject', background=True)
+
+    with pytest.raises(FileNotFoundError):
+        experiment.wait_for_save()
+    # Only raised once
+    experiment.wait_for_save()
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from dipy.core.sphere import HemiSphere
+from dipy.data import get_sphere
+from dipy.direction.peaks import reshape_peaks_for_visualization
+from dipy.reconst.shm import sh_to_sf_matrix
+
+pytest.importorskip('scilpy')
+
+from scilpy.reconst.utils import get_maximas  # noqa: E402
+
+from TrackToLearn.environments.env import BaseEnv  # noqa: E402
+
+
+def _peaks_per_voxel(data, npeaks=5):
+    # Peaks as they were computed before `extract_peaks`, one voxel at a
+    # time with scilpy
+    sphere = HemiSphere.from_sphere(get_sphere("repulsion724")).subdivide(0)
+    b_matrix, _ = sh_to_sf_matrix(sphere, 8, "descoteaux07")
+
+    peak_dirs = np.zeros((data.shape[:-1] + (npeaks, 3)))
+    peak_values = np.zeros((data.shape[:-1] + (npeaks, )))
+    for idx in np.argwhere(np.sum(data, axis=-1)):
+        idx = tuple(idx)
+        directions, values, indices = get_maximas(
+            data[idx], sphere, b_matrix, 0.1, 0)
+        if values.shape[0] != 0:
+            n = min(npeaks, values.shape[0])
+            peak_dirs[idx][:n] = directions[:n]
+            peak_values[idx][:n] = values[:n]
+
+    peak_values = np.divide(peak_values, peak_values[..., 0, None],
+                            out=np.zeros_like(peak_values),
+                            where=peak_values[..., 0, None] != 0)
+    peak_dirs[...] *= peak_values[..., :, None]
+    return reshape_peaks_for_visualization(peak_dirs)
+
+
+def test_compute_peaks():
+    # Should give exactly the peaks of the per-voxel loop, with or without
+    # a pool of processes. Large enough to be split in two chunks.
+    rng = np.random.RandomState(0)
+    data = rng.randn(16, 16, 12, 45).astype(np.float32)
+    data[rng.rand(16, 16, 12) > 0.7] = 0
+
+    expected = _peaks_per_voxel(data)
+
+    assert np.array_equal(BaseEnv._compute_peaks(data), expected)
+    assert np.array_equal(
+        BaseEnv._compute_peaks(data, num_processes=2), expected)
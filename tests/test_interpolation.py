@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+import torch
+
+from scipy.ndimage import map_coordinates, spline_filter
+
+pytest.importorskip('scilpy')
+
+from TrackToLearn.environments.interpolation import (  # noqa: E402
+    NeighborhoodSampler, torch_spline_interpolation)
+
+
+def test_torch_spline_interpolation():
+    # Should match scipy, including around and outside the edges
+    rng = np.random.RandomState(0)
+    volume = (rng.rand(6, 7, 5) > 0.5).astype(float)
+    coefficients = spline_filter(volume, order=3)
+    coords = rng.uniform(-1.5, 7.5, (1000, 3))
+
+    expected = map_coordinates(coefficients, coords.T, prefilter=False)
+    values = torch_spline_interpolation(
+        torch.from_numpy(coefficients), torch.from_numpy(coords))
+
+    assert np.allclose(values.numpy(), expected)
+
+
+def test_neighborhood_sampler():
+    # Should match trilinear interpolation with scipy, with and without
+    # stacking the corners, including around and outside the edges
+    rng = np.random.RandomState(0)
+    volume = rng.rand(6, 7, 5, 4).astype(np.float32)
+    neighborhood = torch.tensor(
+        [[0., 0., 0.], [0.4, 0., 0.], [-0.4, 0., 0.], [0., 0.4, 0.],
+         [0., -0.4, 0.], [0., 0., 0.4], [0., 0., -0.4]])
+    coords = rng.uniform(-2, 9, (1000, 3)).astype(np.float32)
+
+    points = (coords[:, None] + neighborhood.numpy()[None]).reshape(-1, 3)
+    expected = np.stack(
+        [map_coordinates(volume[..., c], (points - 0.5).T, order=1,
+                         mode='nearest') for c in range(4)], axis=-1)
+    expected = expected.reshape(len(coords), -1)
+
+    for max_stacked_size in [0., 1.]:
+        sampler = NeighborhoodSampler(
+            torch.from_numpy(volume), neighborhood, max_stacked_size)
+        assert (sampler.stacked is not None) == (max_stacked_size > 0)
+        values = sampler(torch.from_numpy(coords))
+        assert np.allclose(values.numpy(), expected, atol=1e-6)
+
+    # Should give the same state as dwi_ml
+    pytest.importorskip('dwi_ml')
+    from dwi_ml.data.processing.volume.interpolation import \
+        interpolate_volume_in_neighborhood
+    signal, _ = interpolate_volume_in_neighborhood(
+        torch.from_numpy(volume), torch.from_numpy(coords), neighborhood)
+    assert np.allclose(values.numpy(), signal.numpy(), atol=1e-6)
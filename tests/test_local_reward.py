@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip('scilpy')
+
+from TrackToLearn.datasets.utils import MRIDataVolume  # noqa: E402
+from TrackToLearn.environments.local_reward import (  # noqa: E402
+    PeaksAlignmentReward, TorchPeaksAlignmentReward)
+
+
+def test_torch_peaks_alignment_reward(random_buffers):
+    rng = np.random.RandomState(0)
+    peaks = MRIDataVolume(rng.randn(10, 10, 10, 15), np.eye(4))
+    view, torch_view = random_buffers(rng, (10, 10, 10))
+    dones = np.zeros(len(view), dtype=bool)
+
+    rewards = PeaksAlignmentReward(peaks)(view, dones)
+    torch_rewards = TorchPeaksAlignmentReward(peaks)(
+        torch_view, torch.from_numpy(dones))
+
+    assert np.allclose(rewards, torch_rewards.numpy(), atol=1e-5)
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+import torch
+
+from dipy.tracking.streamline import set_number_of_points
+
+from TrackToLearn.oracles.oracle import (
+    OracleSingleton, _no_fastpath, torch_set_number_of_points)
+
+
+def _walks(rng, n):
+    # Random walks of various lengths
+    return [np.cumsum(rng.normal(0, 0.5, (rng.randint(2, 30), 3)), axis=0)
+            for _ in range(n)]
+
+
+def test_torch_set_number_of_points():
+    # Should match dipy on padded streamlines of various lengths
+    rng = np.random.RandomState(0)
+    lengths = rng.randint(2, 30, 100)
+    points = np.cumsum(rng.normal(0, 0.5, (100, 30, 3)), axis=1)
+
+    expected = set_number_of_points(
+        [p[:n] for p, n in zip(points, lengths)], 128)
+    resampled = torch_set_number_of_points(
+        torch.from_numpy(points), torch.from_numpy(lengths), 128)
+
+    assert np.allclose(resampled.numpy(), np.asarray(expected))
+
+
+@pytest.mark.parametrize('num_workers', [0, 2])
+@pytest.mark.parametrize('n', [0, 5, 16, 37, 100])
+def test_predict(random_oracle, num_workers, n):
+    # Batches resampled by the pool should give the scores of one forward
+    # pass over every streamline, including the last partial batch
+    streamlines = _walks(np.random.RandomState(0), n)
+    oracle = OracleSingleton(
+        random_oracle(), 'cpu', batch_size=16, num_workers=num_workers)
+
+    scores = oracle.predict(streamlines)
+    assert scores.shape == (n,)
+    if n == 0:
+        return
+
+    features = np.diff(np.asarray(
+        set_number_of_points(streamlines, 128)), axis=1)
+    with torch.no_grad():
+        expected = oracle.model(
+            torch.as_tensor(features, dtype=torch.float32)).numpy()
+    assert np.allclose(scores, expected, atol=1e-6)
+
+
+@pytest.mark.parametrize('inference', ['bf16', 'int8'])
+def test_inference_modes(random_oracle, inference):
+    # Reduced precisions should score streamlines close to fp32
+    streamlines = _walks(np.random.RandomState(0), 50)
+    checkpoint = random_oracle(streamlines)
+    expected = OracleSingleton(checkpoint, 'cpu').predict(streamlines)
+    scores = OracleSingleton(
+        checkpoint, 'cpu', inference=inference).predict(streamlines)
+    assert np.allclose(scores, expected, atol=1e-2)
+
+
+def test_inference_mode_errors(random_oracle):
+    # Unknown modes and int8 off the CPU should be refused
+    model = OracleSingleton(random_oracle(), 'cpu').model
+    with pytest.raises(ValueError):
+        OracleSingleton._freeze(model, 'fp8', 'cpu')
+    with pytest.raises(ValueError):
+        OracleSingleton._freeze(model, 'int8', 'cuda')
+
+
+@pytest.mark.parametrize('enabled', [True, False])
+def test_no_fastpath(enabled):
+    # The fast path should be disabled inside and restored after, even if
+    # the model fails
+    default = torch.backends.mha.get_fastpath_enabled()
+    torch.backends.mha.set_fastpath_enabled(enabled)
+    try:
+        with pytest.raises(RuntimeError):
+            with _no_fastpath():
+                assert not torch.backends.mha.get_fastpath_enabled()
+                raise RuntimeError
+        assert torch.backends.mha.get_fastpath_enabled() == enabled
+    finally:
+        torch.backends.mha.set_fastpath_enabled(default)
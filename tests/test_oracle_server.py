@@ -0,0 +1,47 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+from TrackToLearn.oracles.oracle_server import OracleClient, OracleServer
+
+
+def test_oracle_server(tmp_path, random_oracle):
+    # Requests of several clients merged by the server should be scored
+    # as if each was scored alone, and come back to their client in order
+    address = str(tmp_path / 'oracle.sock')
+    server = OracleServer(
+        random_oracle(), address, 'cpu',
+        batch_size=256, num_workers=0, max_wait=0.1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    while not os.path.exists(address):
+        time.sleep(0.01)
+
+    rng = np.random.RandomState(0)
+    requests = [
+        [np.cumsum(rng.normal(0, 0.5, (rng.randint(2, 30), 3)), axis=0)
+         for _ in range(n)]
+        for n in [1, 10, 50, 100]]
+    expected = [server.model.predict(r) for r in requests]
+
+    results = [[] for _ in range(3)]
+
+    def score(client_results):
+        client = OracleClient(address)
+        for request in requests:
+            client_results.append(client.predict(request))
+
+    clients = [threading.Thread(target=score, args=(r,)) for r in results]
+    n_batches = server.n_batches
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+
+    for client_results in results:
+        assert len(client_results) == len(expected)
+        for scores, expected_scores in zip(client_results, expected):
+            np.testing.assert_allclose(scores, expected_scores, atol=1e-6)
+    # Some of the requests were merged
+    assert server.n_batches - n_batches < len(results) * len(requests)
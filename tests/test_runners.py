@@ -20,3 +20,11 @@ def test_sac_auto_train(script_runner):
     ret = script_runner.run('TrackToLearn/trainers/sac_auto_train.py',
                             '--help')
     assert ret.success
+
+
+def test_ttl_oracle_server(script_runner):
+    # Call 'ttl_oracle_server.py' from the command line and assert that it
+    # runs without errors
+
+    ret = script_runner.run('ttl_oracle_server.py', '--help')
+    assert ret.success
@@ -0,0 +1,63 @@
+import numpy as np
+
+from TrackToLearn.environments.seed_source import SeedSource
+
+
+def test_seed_source():
+    # Any range or subset of the seeds should give the same seeds as
+    # generating all of them, and every voxel should get `npv` seeds
+    rng = np.random.RandomState(0)
+    mask = rng.rand(10, 12, 14) > 0.6
+    source = SeedSource(mask, npv=3, random_seed=5, block_size=50)
+    seeds = source[:]
+
+    assert seeds.shape == (np.count_nonzero(mask) * 3, 3)
+    assert np.array_equal(source[123:456], seeds[123:456])
+
+    idx = rng.randint(0, len(source), 100)
+    assert np.array_equal(source[idx], seeds[idx])
+
+    subsets = source.split(7)
+    assert np.array_equal(
+        np.concatenate([s[:] for s in subsets]), seeds)
+
+    voxels = np.round(seeds).astype(int)
+    assert np.all(mask[tuple(voxels.T)])
+    counts = np.bincount(np.ravel_multi_index(tuple(voxels.T), mask.shape))
+    assert np.all(counts[np.flatnonzero(mask)] == 3)
+
+    assert np.array_equal(
+        SeedSource(mask, npv=3, random_seed=5, block_size=50)[:], seeds)
+
+
+def test_seed_source_batches():
+    # With a Morton order, batches should cover the seeds in order without
+    # spanning two blocks, also when the source is split, even if the
+    # number of seeds per voxel does not divide the batch size
+    rng = np.random.RandomState(0)
+    mask = rng.rand(10, 12, 14) > 0.6
+    n_actor, npv = 100, 3
+    source = SeedSource(mask, npv=npv, random_seed=5,
+                        block_size=n_actor // npv, order='morton')
+    block_len = source.block_size * npv
+
+    for subset in [source] + source.split(3):
+        batches = subset.batches(n_actor)
+        assert [a for a, _ in batches[1:]] == [b for _, b in batches[:-1]]
+        assert batches[0][0] == 0 and batches[-1][1] == len(subset)
+        for a, b in batches:
+            assert 0 < b - a <= n_actor
+            assert (subset.start + a) // block_len == \
+                (subset.start + b - 1) // block_len
+
+    # Full batches hold every seed of their voxels
+    for a, b in source.batches(n_actor)[:-1]:
+        voxels = np.round(source[a:b]).astype(int)
+        _, counts = np.unique(voxels, axis=0, return_counts=True)
+        assert np.all(counts == npv)
+
+    # Without a Morton order, batches are only cut every `n_actor` seeds
+    source = SeedSource(mask, npv=npv, random_seed=5, block_size=50)
+    assert source.batches(n_actor) == [
+        (a, min(a + n_actor, len(source)))
+        for a in range(0, len(source), n_actor)]
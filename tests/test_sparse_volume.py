@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip('scilpy')
+
+from TrackToLearn.datasets.utils import (  # noqa: E402
+    MRIDataVolume, SparseVolume)
+from TrackToLearn.environments.interpolation import (  # noqa: E402
+    NeighborhoodSampler)
+from TrackToLearn.environments.local_reward import (  # noqa: E402
+    PeaksAlignmentReward, TorchPeaksAlignmentReward)
+
+
+def test_sparse_volume(random_buffers):
+    # Sparse volumes should give the same values as the dense ones to the
+    # state sampler and the peaks reward
+    rng = np.random.RandomState(0)
+    mask = rng.rand(10, 10, 10) > 0.6
+    volume = rng.randn(10, 10, 10, 15).astype(np.float32) * mask[..., None]
+    sparse = SparseVolume.from_dense(volume, chunk_size=3)
+    assert len(sparse.values) == np.count_nonzero(mask) + 1
+    assert np.array_equal(sparse.to_dense(), volume)
+
+    neighborhood = torch.tensor([[0., 0., 0.], [0.4, 0., 0.]])
+    coords = torch.from_numpy(rng.uniform(-1, 11, (500, 3)))
+    sampler = NeighborhoodSampler(torch.from_numpy(volume), neighborhood)
+    sparse_sampler = NeighborhoodSampler(sparse.to_torch(), neighborhood)
+    assert np.array_equal(sampler(coords), sparse_sampler(coords))
+
+    view, torch_view = random_buffers(rng, mask.shape)
+    dones = np.zeros(len(view), dtype=bool)
+    for reward in [PeaksAlignmentReward, TorchPeaksAlignmentReward]:
+        view = view if reward is PeaksAlignmentReward else torch_view
+        rewards = reward(MRIDataVolume(volume))(view, dones)
+        sparse_rewards = reward(MRIDataVolume(sparse))(view, dones)
+        assert np.array_equal(rewards, sparse_rewards)
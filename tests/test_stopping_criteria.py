@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('scilpy')
+
+from TrackToLearn.environments.stopping_criteria import (  # noqa: E402
+    BinaryStoppingCriterion, CurvatureStoppingCriterion,
+    OracleStoppingCriterion, TorchBinaryStoppingCriterion,
+    TorchCurvatureStoppingCriterion)
+from TrackToLearn.environments.streamline_buffer import (  # noqa: E402
+    StreamlineBuffer)
+from TrackToLearn.environments.utils import to_oracle_space  # noqa: E402
+
+
+def test_torch_stopping_criteria(random_buffers):
+    # Torch criteria should stop the same streamlines as the NumPy ones
+    rng = np.random.RandomState(0)
+    mask = (rng.rand(10, 10, 10) > 0.3).astype(float)
+    view, torch_view = random_buffers(rng, mask.shape)
+
+    curvature = CurvatureStoppingCriterion(30)
+    torch_curvature = TorchCurvatureStoppingCriterion(30)
+    assert np.array_equal(
+        curvature(view), torch_curvature(torch_view).numpy())
+
+    binary = BinaryStoppingCriterion(mask, 0.5)
+    torch_binary = TorchBinaryStoppingCriterion(mask, 0.5)
+    assert np.array_equal(binary(view), torch_binary(torch_view).numpy())
+
+
+def test_oracle_stopping_criterion(random_oracle):
+    # With a cadence of 1, should stop the same streamlines as scoring
+    # every streamline long enough at every step, across restarted rows
+    # and episodes
+    rng = np.random.RandomState(0)
+    walks = np.cumsum(rng.normal(0, 0.5, (50, 10, 3)), axis=1)
+    criterion = OracleStoppingCriterion(
+        random_oracle(walks), 0, np.eye(4), 'cpu')
+    n_dones = 0
+
+    for _ in range(2):
+        criterion.reset()
+        buffer = StreamlineBuffer.from_seeds(
+            rng.uniform(0, 10, (50, 3)), 11)
+        idx = np.arange(50)
+        for _ in range(10):
+            steps = rng.normal(0, 0.5, (len(idx), 3))
+            buffer.append(idx, buffer[idx].last_points() + steps)
+            view = buffer[idx]
+
+            expected = criterion.model.predict(
+                to_oracle_space(view, np.eye(4))) < 0.5
+            dones = criterion(view)
+            assert np.array_equal(dones, expected)
+            n_dones += np.count_nonzero(dones)
+
+            # Start new streamlines in the rows of the stopped ones
+            restarted = idx[dones]
+            buffer.reset_rows(
+                restarted, rng.uniform(0, 10, (len(restarted), 3)))
+            criterion.reset(restarted)
+
+    assert n_dones > 0
+
+
+def test_oracle_stopping_criterion_cadence(random_oracle):
+    # With a cadence of 3, a streamline should be scored again only once
+    # it grew by 3 points, its last score deciding in between, so that
+    # fewer streamlines are scored than with a cadence of 1
+    rng = np.random.RandomState(0)
+    walks = np.cumsum(rng.normal(0, 0.5, (50, 10, 3)), axis=1)
+    checkpoint = random_oracle(walks)
+    criterion = OracleStoppingCriterion(
+        checkpoint, 0, np.eye(4), 'cpu', cadence=3)
+    every_step = OracleStoppingCriterion(checkpoint, 0, np.eye(4), 'cpu')
+
+    scores = np.ones(50, dtype=np.float32)
+    scored_lengths = np.zeros(50, dtype=int)
+    n_scored = n_dones = n_cached = 0
+
+    buffer = StreamlineBuffer.from_seeds(rng.uniform(0, 10, (50, 3)), 21)
+    idx = np.arange(50)
+    for _ in range(20):
+        steps = rng.normal(0, 0.5, (len(idx), 3))
+        buffer.append(idx, buffer[idx].last_points() + steps)
+        view = buffer[idx]
+
+        # Streamlines that grew by 3 points since they were last scored
+        lengths = view.lengths
+        to_score = lengths - scored_lengths >= 3
+        scores[to_score] = criterion.model.predict(
+            to_oracle_space(view[to_score], np.eye(4)))
+        scored_lengths[to_score] = lengths[to_score]
+        n_scored += np.count_nonzero(to_score)
+
+        dones = criterion(view)
+        assert np.array_equal(dones, scores < 0.5)
+        assert criterion.n_scored == n_scored
+        # Decisions that differ from the current score of the streamline
+        n_cached += np.count_nonzero(every_step(view) != dones)
+        n_dones += np.count_nonzero(dones)
+
+        restarted = idx[dones]
+        buffer.reset_rows(restarted, rng.uniform(0, 10, (len(restarted), 3)))
+        for c in [criterion, every_step]:
+            c.reset(restarted)
+        scores[restarted] = 1.
+        scored_lengths[restarted] = 0
+
+    assert n_dones > 0 and n_cached > 0
+    assert criterion.n_scored < every_step.n_scored / 2
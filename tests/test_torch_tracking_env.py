@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip('scilpy')
+
+from TrackToLearn.datasets.utils import MRIDataVolume  # noqa: E402
+
+
+def _track(env, weights):
+    # Track the first 50 seeds with a fixed linear policy
+    from TrackToLearn.environments.torch_tracking_env import (
+        TorchTrackingEnvironment)
+
+    rewards = []
+    state = env.reset(0, 50)
+    while len(state) > 0:
+        actions = torch.tanh(torch.as_tensor(state) @ weights + 0.5)
+        if not isinstance(env, TorchTrackingEnvironment):
+            actions = actions.numpy()
+        _, reward, *_ = env.step(actions)
+        rewards.append(np.asarray(reward))
+        state, _ = env.harvest()
+    return env.get_streamlines(), np.concatenate(rewards)
+
+
+def test_torch_tracking_env(tracking_subject, env_dto):
+    # Tracking with the same actions should give the same streamlines in
+    # both environments
+    pytest.importorskip('dwi_ml')
+
+    from TrackToLearn.environments.tracking_env import TrackingEnvironment
+    from TrackToLearn.environments.torch_tracking_env import (
+        TorchTrackingEnvironment)
+
+    rng = np.random.RandomState(0)
+    subject = tracking_subject(rng)
+
+    env = TrackingEnvironment(subject, 'testing', env_dto())
+    torch_env = TorchTrackingEnvironment(subject, 'testing', env_dto())
+    torch_env.seeds = env.seeds
+
+    weights = torch.from_numpy(
+        rng.randn(env.get_state_size(), 3).astype(np.float32))
+
+    tractogram, rewards = _track(env, weights)
+    torch_tractogram, torch_rewards = _track(torch_env, weights)
+
+    assert len(tractogram) == len(torch_tractogram)
+    for s, torch_s in zip(tractogram.streamlines,
+                          torch_tractogram.streamlines):
+        assert np.allclose(s, torch_s, atol=1e-4)
+    assert np.array_equal(tractogram.data_per_streamline['flags'],
+                          torch_tractogram.data_per_streamline['flags'])
+    assert np.allclose(rewards, torch_rewards, atol=1e-5)
+
+
+def test_torch_tracking_env_noise(tracking_subject, env_dto):
+    # Noise is drawn on the device and scaled by 1 - FA, so an FA of 1
+    # removes it and an FA of 0 leaves it as without an FA map. See the
+    # docstring of `TorchTrackingEnvironment` for how it differs from
+    # `NoisyTrackingEnvironment`.
+    pytest.importorskip('dwi_ml')
+
+    from TrackToLearn.environments.torch_tracking_env import (
+        TorchTrackingEnvironment)
+
+    rng = np.random.RandomState(0)
+    subject = tracking_subject(rng)
+    shape = subject[0].data.shape[:3]
+
+    def track(**kwargs):
+        env = TorchTrackingEnvironment(
+            subject, 'testing', env_dto(**kwargs))
+        weights = torch.from_numpy(np.random.RandomState(2).randn(
+            env.get_state_size(), 3).astype(np.float32))
+        return _track(env, weights)[0].streamlines
+
+    def same(streamlines, other):
+        return len(streamlines) == len(other) and all(
+            s.shape == o.shape and np.allclose(s, o, atol=1e-4)
+            for s, o in zip(streamlines, other))
+
+    streamlines = track()
+    noisy = track(noise=0.3)
+    assert not same(streamlines, noisy)
+
+    fa = MRIDataVolume(np.ones(shape), np.eye(4))
+    assert same(streamlines, track(noise=0.3, fa_map=fa))
+
+    fa = MRIDataVolume(np.zeros(shape), np.eye(4))
+    assert same(noisy, track(noise=0.3, fa_map=fa))
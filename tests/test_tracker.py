@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip('dwi_ml')
+
+from TrackToLearn.algorithms.sac_auto import SACAuto  # noqa: E402
+from TrackToLearn.environments.tracking_env import (  # noqa: E402
+    TrackingEnvironment)
+from TrackToLearn.environments.torch_tracking_env import (  # noqa: E402
+    TorchTrackingEnvironment)
+from TrackToLearn.tracking.tracker import Tracker  # noqa: E402
+
+
+def _by_seed(batches):
+    # Streamlines of tracked batches, by seed
+    streamlines = {}
+    for tractogram, _ in batches:
+        for s, seed in zip(tractogram.streamlines,
+                           tractogram.data_per_streamline['seeds']):
+            key = np.asarray(seed, dtype=np.float32).tobytes()
+            assert key not in streamlines
+            streamlines[key] = s
+    return streamlines
+
+
+@pytest.mark.parametrize(
+    'env_class', [TrackingEnvironment, TorchTrackingEnvironment])
+def test_continuous_batching(tracking_subject, env_dto, env_class):
+    # Without noise, continuous batching should track every seed once and
+    # give the same streamline for each seed as tracking batch by batch
+    env = env_class(
+        tracking_subject(np.random.RandomState(0)), 'testing', env_dto())
+    env.seeds = env.seeds.subset(0, 300)
+
+    alg = SACAuto(env.get_state_size(), 3, '32-32', n_actors=50,
+                  replay_size=100, rng=np.random.RandomState(0),
+                  device=torch.device('cpu'))
+    batched = _by_seed(Tracker(alg, 50, prob=0.)._track_batches(env))
+    continuous = _by_seed(
+        Tracker(alg, 50, prob=0., continuous=True)._track_batches(env))
+
+    seeds = {np.asarray(s, dtype=np.float32).tobytes()
+             for s in env.seeds[:]}
+    assert len(seeds) == len(env.seeds)
+    assert set(batched) == set(continuous) == seeds
+    for key, streamline in batched.items():
+        assert np.allclose(continuous[key], streamline, atol=1e-5)
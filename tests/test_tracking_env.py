@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip('dwi_ml')
+
+from TrackToLearn.environments.seed_source import SeedSource  # noqa: E402
+from TrackToLearn.environments.tracking_env import (  # noqa: E402
+    TrackingEnvironment)
+
+
+def test_nreset(tracking_subject, env_dto, monkeypatch):
+    # Seeds sampled for training should be generated once, not at every
+    # episode, and be seeds of the source
+    env = TrackingEnvironment(
+        tracking_subject(np.random.RandomState(0)), 'training', env_dto())
+    seeds = env.seeds[:]
+
+    block = SeedSource._block
+    n_blocks = []
+
+    def counted(self, b):
+        n_blocks.append(b)
+        return block(self, b)
+
+    monkeypatch.setattr(SeedSource, '_block', counted)
+    for _ in range(3):
+        env.nreset(20)
+        assert all(np.any(np.all(seeds == p, axis=1))
+                   for p in env.initial_points)
+    assert len(n_blocks) == -(-len(env.seeds.voxels) // env.seeds.block_size)
+
+
+@pytest.mark.parametrize('state_sampler', ['dwi_ml', 'torch'])
+@pytest.mark.parametrize('storage_precision, dtype', [
+    ('fp16', torch.float16), ('bf16', torch.bfloat16)])
+def test_storage_precision(tracking_subject, env_dto, state_sampler,
+                           storage_precision, dtype):
+    # A signal stored in half precision should be interpolated in float32
+    # and give states close to the ones of a signal stored in float32
+    subject = tracking_subject(np.random.RandomState(0))
+    env = TrackingEnvironment(subject, 'testing', env_dto(
+        state_sampler=state_sampler))
+    half_env = TrackingEnvironment(subject, 'testing', env_dto(
+        state_sampler=state_sampler, storage_precision=storage_precision))
+    assert half_env.data_volume.dtype == dtype
+
+    state = env.reset(0, 50)
+    half_state = half_env.reset(0, 50)
+    assert half_state.dtype == state.dtype == torch.float32
+    if state_sampler == 'torch':
+        coords = torch.as_tensor(half_env.streamlines[np.arange(50)]
+                                 .last_points(), dtype=torch.float32)
+        assert half_env.neighborhood_sampler(coords).dtype == torch.float32
+
+    # The signal is in [0, 1), bf16 keeps 8 bits of mantissa
+    assert np.allclose(half_state, state, atol=1e-2)
+    assert not np.array_equal(half_state, state)
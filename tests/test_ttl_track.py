@@ -0,0 +1,123 @@
+import json
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip('scilpy')
+
+from TrackToLearn.algorithms.sac_auto import SACAuto  # noqa: E402
+from TrackToLearn.runners.ttl_track import TrackToLearnTrack  # noqa: E402
+
+
+def _track_dto(tmp_path, **kwargs):
+    # Sphere of random fODFs, seeded on a shell, and an agent with random
+    # weights
+    shape = (16, 16, 16)
+    grid = np.stack(np.meshgrid(
+        *[np.arange(s) for s in shape], indexing='ij'), axis=-1)
+    radius = np.linalg.norm(grid - 7.5, axis=-1)
+    mask = (radius < 6).astype(np.float32)
+    seeding = ((radius < 6) & (radius > 4)).astype(np.float32)
+    odf = np.random.RandomState(0).rand(*shape, 45).astype(np.float32)
+    affine = np.diag([2., 2., 2., 1.])
+    for name, volume in [('odf', odf * mask[..., None]), ('mask', mask),
+                         ('seed', seeding)]:
+        nib.save(nib.Nifti1Image(volume, affine),
+                 str(tmp_path / '{}.nii.gz'.format(name)))
+
+    with open(tmp_path / 'hyperparameters.json', 'w') as f:
+        json.dump({'algorithm': 'SACAuto', 'step_size': 0.75,
+                   'voxel_size': 2.0, 'max_angle': 30,
+                   'hidden_dims': '32-32', 'n_dirs': 2,
+                   'target_sh_order': 6}, f)
+
+    track_dto = dict(
+        in_odf=str(tmp_path / 'odf.nii.gz'),
+        in_seed=str(tmp_path / 'seed.nii.gz'),
+        in_mask=str(tmp_path / 'mask.nii.gz'),
+        out_tractogram=str(tmp_path / 'out.trk'),
+        input_wm=False, noise=0.1, fa_map=None,
+        binary_stopping_threshold=0.1, storage_precision='fp32',
+        state_sampler='dwi_ml', max_stacked_size=2., sparse_volumes=False,
+        crop_margin=None, n_actor=50, n_workers=1, checkpoint_dir=None,
+        chunk_size=300, continuous_batching=False, device_env=False,
+        npv=2, seed_order='random', min_length=2., max_length=100.,
+        compress=None, sh_basis='descoteaux07', save_seeds=True,
+        cache_dir=None, cache_size=1., agent=str(tmp_path),
+        hyperparameters=str(tmp_path / 'hyperparameters.json'),
+        rng_seed=1)
+    track_dto.update(kwargs)
+
+    if not os.path.exists(tmp_path / 'last_model_state_actor.pth'):
+        env = TrackToLearnTrack(track_dto).get_tracking_env()
+        env.load_subject()
+        input_size = env.reset(0, 1).shape[1]
+        alg = SACAuto(input_size, 3, '32-32', n_actors=50,
+                      rng=np.random.RandomState(0),
+                      device=torch.device('cpu'))
+        alg.agent.save(str(tmp_path), 'last_model_state')
+
+    return track_dto
+
+
+def _load(out_tractogram):
+    tractogram = nib.streamlines.load(out_tractogram).tractogram
+    return (list(tractogram.streamlines),
+            tractogram.data_per_streamline['seeds'])
+
+
+def test_resume(tmp_path, monkeypatch):
+    # A run interrupted after two chunks and resumed should give the same
+    # tractogram as an uninterrupted one
+    track_dto = _track_dto(tmp_path)
+
+    TrackToLearnTrack(dict(
+        track_dto, out_tractogram=str(tmp_path / 'full.trk'),
+        checkpoint_dir=str(tmp_path / 'full'))).run()
+
+    resumed_dto = dict(track_dto, checkpoint_dir=str(tmp_path / 'resumed'))
+    save_manifest = TrackToLearnTrack._save_manifest
+
+    def interrupted(self, manifest):
+        save_manifest(self, manifest)
+        if len(manifest['chunks']) == 2:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(TrackToLearnTrack, '_save_manifest', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        TrackToLearnTrack(resumed_dto).run()
+    monkeypatch.undo()
+
+    # The chunks of the interrupted run cannot be joined to a run with
+    # other arguments
+    with pytest.raises(ValueError):
+        TrackToLearnTrack(dict(resumed_dto, n_actor=20)).run()
+
+    TrackToLearnTrack(resumed_dto).run()
+
+    streamlines, seeds = _load(tmp_path / 'full.trk')
+    resumed_streamlines, resumed_seeds = _load(tmp_path / 'out.trk')
+    assert len(streamlines) == len(resumed_streamlines) > 0
+    assert all(np.array_equal(s, r)
+               for s, r in zip(streamlines, resumed_streamlines))
+    assert np.array_equal(seeds, resumed_seeds)
+
+
+def test_sharded(tmp_path):
+    # Without noise, the shards of the seeds tracked by several workers
+    # and merged in order should give the tractogram of a single process
+    track_dto = _track_dto(tmp_path, noise=0.)
+
+    TrackToLearnTrack(dict(
+        track_dto, out_tractogram=str(tmp_path / 'single.trk'))).run()
+    TrackToLearnTrack(dict(track_dto, n_workers=2)).run()
+
+    streamlines, seeds = _load(tmp_path / 'single.trk')
+    sharded_streamlines, sharded_seeds = _load(tmp_path / 'out.trk')
+    assert len(streamlines) == len(sharded_streamlines) > 0
+    assert all(np.allclose(s, r)
+               for s, r in zip(streamlines, sharded_streamlines))
+    assert np.array_equal(seeds, sharded_seeds)